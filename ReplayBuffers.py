@@ -1,48 +1,792 @@
 import numpy as np 
-from collections import deque, namedtuple
+from collections import deque
+import os
+import json
+import shutil
 import random
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import torch
 
 
+class ArrayStorage(object):
+    """
+    Preallocated columnar ring storage for transitions.
+
+    Every field lives in its own NumPy array of length `capacity`, so writing a
+    transition is a handful of slice assignments and gathering a batch is one
+    fancy-index per field. The arrays are allocated on the first add because the
+    observation shape is only known once the environment produced one.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.pos = 0
+        self.size = 0
+        self.fields = None
+
+    def _alloc(self, name, shape, dtype):
+        return np.zeros((self.capacity,) + tuple(shape), dtype=dtype)
+
+    def _allocate(self, state):
+        state = np.asarray(state)
+        obs_dtype = np.float32 if np.issubdtype(state.dtype, np.floating) else state.dtype
+        self.fields = {"states": self._alloc("states", state.shape, obs_dtype),
+                       "actions": self._alloc("actions", (), np.int32),
+                       "rewards": self._alloc("rewards", (), np.float32),
+                       "next_states": self._alloc("next_states", state.shape, obs_dtype),
+                       "dones": self._alloc("dones", (), np.bool_)}
+
+    def encode(self, states, next_states):
+        """
+        Hook called on every env step before the n-step window with the observations of
+        all parallel envs stacked along the first dimension: returns what the window keeps
+        for them. Plain arrays here, backends that store observations elsewhere hand out keys.
+        """
+        return states, next_states
+
+    def add(self, states, actions, rewards, next_states, dones):
+        """Writes a batch of transitions into the oldest slots and returns their indices."""
+        if self.fields is None:
+            self._allocate(states[0])
+        n = len(actions)
+        indices = (self.pos + np.arange(n)) % self.capacity
+        self.fields["states"][indices] = states
+        self.fields["actions"][indices] = actions
+        self.fields["rewards"][indices] = rewards
+        self.fields["next_states"][indices] = next_states
+        self.fields["dones"][indices] = dones
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        return indices
+
+    def sample_indices(self, batch_size, rng=None):
+        """Draws batch_size slot indices uniformly from the filled part of the storage, with rng or the global NumPy RNG."""
+        return _randint(rng, self.size, batch_size)
+
+    def gather(self, indices):
+        """Returns (states, actions, rewards, next_states, dones) arrays for the given slots."""
+        f = self.fields
+        return (f["states"][indices].astype(np.float32, copy=False),
+                f["actions"][indices].astype(np.int64),
+                f["rewards"][indices],
+                f["next_states"][indices].astype(np.float32, copy=False),
+                f["dones"][indices].astype(np.float32))
+
+    def stats(self):
+        """Backend specific numbers worth logging, keyed by short names."""
+        return {}
+
+    def external_writes(self):
+        """Slots filled by other processes since the last call, only shared storages have those."""
+        return np.zeros(0, dtype=np.int64)
+
+    def guard_slots(self):
+        """Written slots that must not be sampled right now, only shared storages have those."""
+        return np.zeros(0, dtype=np.int64)
+
+    def _snapshot(self):
+        """Returns the arrays and the scalar state that make up the storage contents."""
+        arrays = dict(self.fields) if self.fields is not None else {}
+        return arrays, {"capacity": self.capacity, "pos": int(self.pos), "size": int(self.size)}
+
+    def _restore(self, arrays, meta):
+        assert meta["capacity"] == self.capacity, "snapshot capacity {} does not match {}".format(meta["capacity"], self.capacity)
+        self.pos = meta["pos"]
+        self.size = meta["size"]
+        names = ("states", "actions", "rewards", "next_states", "dones")
+        self.fields = {name: arrays[name] for name in names} if "states" in arrays else None
+
+    def save(self, directory):
+        """Writes every array as a raw .npy file plus a small json with the ring position."""
+        arrays, meta = self._snapshot()
+        _save_arrays(directory, arrays, meta)
+
+    def load(self, directory, mmap=True):
+        """
+        Restores a snapshot written by save(). With mmap the in-memory storages map the arrays
+        copy-on-write, so nothing is decoded up front and the snapshot files stay untouched by
+        new writes. MemmapStorage copies the snapshot into its own files instead.
+        """
+        arrays, meta = _load_arrays(directory, mmap)
+        self._restore(arrays, meta)
+
+    def __len__(self):
+        return self.size
+
+
+class FrameStorage(ArrayStorage):
+    """
+    Replay storage for stacked pixel observations like the 4x84x84 stacks of wrapper.make_env.
+
+    Every frame is written once as uint8 into a per-worker frame ring, together with a
+    flag marking the first frame of a stack sequence (start of the run or an env reset).
+    Transitions only keep the frame positions of their state and next_state and the
+    stacks are rebuilt from the rings when a batch is gathered; frames before a sequence
+    start are zero, exactly like BufferWrapper pads a fresh episode.
+
+    Each frame ring starts with (1 + headroom) times the worker's share of the capacity,
+    which is enough as long as a reset (which re-writes a full stack) happens less often
+    than every history/headroom steps. A ring that would overwrite a frame the oldest
+    stored transition of its worker still needs doubles instead, so frequent resets cost
+    memory but never corrupt a stack.
+    """
+    def __init__(self, capacity, parallel_env=1, frame_scale=255., headroom=0.25):
+        super(FrameStorage, self).__init__(capacity)
+        self.parallel_env = parallel_env
+        self.frame_scale = frame_scale
+        self.frame_capacity = int(np.ceil(capacity / parallel_env * (1 + headroom))) + 64
+        self.frames = None
+        self.starts = None
+        self.count = np.zeros(parallel_env, dtype=np.int64)
+        self.last_obs = [None for _ in range(parallel_env)]
+
+    def _allocate_frames(self, state):
+        state = np.asarray(state)
+        assert state.ndim == 3, "FrameStorage needs stacked pixel observations (stack, height, width), got shape {}".format(state.shape)
+        self.history = state.shape[0]
+        self.offsets = np.arange(1 - self.history, 1)
+        if np.issubdtype(state.dtype, np.integer):
+            self.frame_scale = None
+        self.frames = np.zeros((self.parallel_env, self.frame_capacity) + state.shape[1:], dtype=np.uint8)
+        self.starts = np.zeros((self.parallel_env, self.frame_capacity), dtype=np.bool_)
+
+    def _allocate(self, state):
+        self.fields = {"states": self._alloc("states", (), np.int64),
+                       "actions": self._alloc("actions", (), np.int32),
+                       "rewards": self._alloc("rewards", (), np.float32),
+                       "next_states": self._alloc("next_states", (), np.int64),
+                       "dones": self._alloc("dones", (), np.bool_)}
+
+    def _oldest_live(self):
+        """Position of the oldest frame every worker's stored transitions still reference."""
+        oldest = np.zeros(self.parallel_env, dtype=np.int64)
+        if self.size == 0:
+            return oldest
+        # every add writes one transition per worker, so the oldest transition of each worker is among the oldest parallel_env slots
+        slots = (self.pos - self.size + np.arange(min(self.size, self.parallel_env))) % self.capacity
+        keys = self.fields["states"][slots]
+        oldest[keys % self.parallel_env] = keys // self.parallel_env - self.history + 1
+        return oldest
+
+    def _grow(self):
+        """Doubles the frame rings, the frames keep their positions."""
+        frame_capacity = 2 * self.frame_capacity
+        frames = np.zeros((self.parallel_env, frame_capacity) + self.frames.shape[2:], dtype=np.uint8)
+        starts = np.zeros((self.parallel_env, frame_capacity), dtype=np.bool_)
+        for worker, count in enumerate(self.count):
+            positions = np.arange(max(count - self.frame_capacity, 0), count)
+            frames[worker, positions % frame_capacity] = self.frames[worker, positions % self.frame_capacity]
+            starts[worker, positions % frame_capacity] = self.starts[worker, positions % self.frame_capacity]
+        self.frames, self.starts, self.frame_capacity = frames, starts, frame_capacity
+
+    def _push(self, worker, frame, start):
+        pos = self.count[worker]
+        while pos - self.frame_capacity >= self.oldest[worker]:
+            self._grow()
+        slot = pos % self.frame_capacity
+        if self.frame_scale is not None:
+            frame = np.rint(frame * self.frame_scale)
+        self.frames[worker, slot] = frame
+        self.starts[worker, slot] = start
+        self.count[worker] += 1
+        return pos
+
+    def _push_stack(self, worker, stack):
+        for i, frame in enumerate(stack):
+            pos = self._push(worker, frame, start=(i == 0))
+        return pos
+
+    def encode(self, states, next_states):
+        """
+        Writes the new frame of every worker and returns integer keys (position * parallel_env + worker)
+        for states and next_states. A state that does not continue the last next_state of the
+        worker, or a next_state that is not state shifted by one frame (env reset), starts a
+        new sequence and gets its whole stack written.
+        """
+        if self.frames is None:
+            self._allocate_frames(states[0])
+        self.oldest = self._oldest_live()
+        keys = np.array([self._encode_worker(worker, state, next_state) for worker, (state, next_state) in enumerate(zip(states, next_states))])
+        return keys[:, 0], keys[:, 1]
+
+    def _encode_worker(self, worker, state, next_state):
+        last = self.last_obs[worker]
+        if last is None or not np.array_equal(state, last):
+            state_pos = self._push_stack(worker, state)
+        else:
+            state_pos = self.count[worker] - 1
+        if np.array_equal(next_state[:-1], state[1:]):
+            next_pos = self._push(worker, next_state[-1], start=False)
+        else:
+            next_pos = self._push_stack(worker, next_state)
+        self.last_obs[worker] = np.array(next_state)
+        return state_pos * self.parallel_env + worker, next_pos * self.parallel_env + worker
+
+    def stack(self, keys):
+        """Rebuilds the float32 observation stacks for an array of frame keys."""
+        workers = (keys % self.parallel_env)[:, None]
+        positions = (keys // self.parallel_env)[:, None] + self.offsets
+        slots = positions % self.frame_capacity
+        starts = self.starts[workers, slots]
+        # frame j belongs to the stack unless a sequence starts at one of the later frames
+        later_starts = np.cumsum(starts[:, :0:-1], axis=1)[:, ::-1]
+        keep = np.ones(starts.shape, dtype=np.float32)
+        keep[:, :-1] = later_starts == 0
+        stacks = self.frames[workers, slots].astype(np.float32)
+        stacks *= keep.reshape(keep.shape + (1,) * (stacks.ndim - 2))
+        if self.frame_scale is not None:
+            stacks /= self.frame_scale
+        return stacks
+
+    def _snapshot(self):
+        arrays, meta = super(FrameStorage, self)._snapshot()
+        meta.update(parallel_env=self.parallel_env, frame_capacity=self.frame_capacity, frame_scale=self.frame_scale)
+        if self.frames is not None:
+            arrays.update(frames=self.frames, starts=self.starts, count=self.count,
+                          last_obs=np.stack([np.zeros_like(self.frames[0, 0], dtype=np.float32) if obs is None else obs[-self.history:] for obs in self.last_obs]),
+                          last_valid=np.array([obs is not None for obs in self.last_obs]))
+            meta.update(history=self.history)
+        return arrays, meta
+
+    def _restore(self, arrays, meta):
+        super(FrameStorage, self)._restore(arrays, meta)
+        assert meta["parallel_env"] == self.parallel_env, "snapshot frame layout does not match"
+        self.frame_capacity = meta["frame_capacity"]
+        self.frame_scale = meta["frame_scale"]
+        if "frames" in arrays:
+            self.history = meta["history"]
+            self.offsets = np.arange(1 - self.history, 1)
+            self.frames = arrays["frames"]
+            self.starts = arrays["starts"]
+            self.count = np.array(arrays["count"])
+            self.last_obs = [np.array(obs) if valid else None for obs, valid in zip(arrays["last_obs"], arrays["last_valid"])]
+
+    def gather(self, indices):
+        f = self.fields
+        return (self.stack(f["states"][indices]),
+                f["actions"][indices].astype(np.int64),
+                f["rewards"][indices],
+                self.stack(f["next_states"][indices]),
+                f["dones"][indices].astype(np.float32))
+
+
+class MemmapStorage(ArrayStorage):
+    """
+    ArrayStorage whose arrays are np.memmap files in `directory`, so the capacity is
+    bounded by disk instead of resident memory and the OS pages data in on demand.
+
+    Layouts:
+        "columnar": one file per field, cheapest for writes and for small observations
+        "record": one file of structured records where all fields of a transition are
+                  adjacent, so a sampled transition is one contiguous read. Records are
+                  padded to a multiple of `align` bytes (e.g. 4096 to start every large
+                  pixel record on a page boundary).
+
+    With block_size > 1 uniform sampling draws batch_size/block_size runs of consecutive
+    slots instead of independent slots, which keeps disk reads sequential at the price of
+    correlated transitions inside a batch.
+    """
+    def __init__(self, capacity, directory, layout="columnar", align=0, block_size=1):
+        super(MemmapStorage, self).__init__(capacity)
+        assert layout in ("columnar", "record"), "unknown memmap layout: {}".format(layout)
+        self.directory = directory
+        self.layout = layout
+        self.align = align
+        self.block_size = block_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _alloc(self, name, shape, dtype):
+        return np.memmap(os.path.join(self.directory, name + ".dat"), mode="w+", dtype=dtype, shape=(self.capacity,) + tuple(shape))
+
+    def _allocate(self, state):
+        if self.layout == "columnar":
+            return super(MemmapStorage, self)._allocate(state)
+        state = np.asarray(state)
+        obs_dtype = np.float32 if np.issubdtype(state.dtype, np.floating) else state.dtype
+        record = np.dtype([("states", obs_dtype, state.shape),
+                           ("next_states", obs_dtype, state.shape),
+                           ("rewards", np.float32),
+                           ("actions", np.int32),
+                           ("dones", np.bool_)])
+        itemsize = record.itemsize
+        if self.align > 0:
+            itemsize = -(-itemsize // self.align) * self.align
+        record = np.dtype({"names": record.names,
+                           "formats": [record.fields[n][0] for n in record.names],
+                           "offsets": [record.fields[n][1] for n in record.names],
+                           "itemsize": itemsize})
+        self.records = np.memmap(os.path.join(self.directory, "records.dat"), mode="w+", dtype=record, shape=(self.capacity,))
+        self.fields = {name: self.records[name] for name in record.names}
+
+    def _snapshot(self):
+        if self.layout == "columnar" or self.fields is None:
+            return super(MemmapStorage, self)._snapshot()
+        arrays, meta = super(MemmapStorage, self)._snapshot()
+        return {"records": self.records}, meta
+
+    def _restore(self, arrays, meta):
+        # the snapshot is copied into this storage's own files, with copy-on-write maps of the
+        # snapshot files every later write would end up in anonymous memory
+        if "records" in arrays:
+            records = arrays.pop("records")
+            self.records = np.memmap(os.path.join(self.directory, "records.dat"), mode="w+", dtype=records.dtype, shape=records.shape)
+            _copy_rows(self.records, records)
+            arrays.update({name: self.records[name] for name in self.records.dtype.names})
+        elif "states" in arrays:
+            for name in ("states", "actions", "rewards", "next_states", "dones"):
+                field = self._alloc(name, arrays[name].shape[1:], arrays[name].dtype)
+                _copy_rows(field, arrays[name])
+                arrays[name] = field
+        super(MemmapStorage, self)._restore(arrays, meta)
+
+    def sample_indices(self, batch_size, rng=None):
+        if self.block_size <= 1:
+            return super(MemmapStorage, self).sample_indices(batch_size, rng)
+        n_blocks = -(-batch_size // self.block_size)
+        starts = _randint(rng, self.size, n_blocks)
+        indices = (starts[:, None] + np.arange(self.block_size)) % self.size
+        return indices.reshape(-1)[:batch_size]
+
+
+class SharedMemoryStorage(ArrayStorage):
+    """
+    ArrayStorage living in multiprocessing.shared_memory so several actor processes can
+    write transitions directly and a learner process samples from the same memory.
+
+    The capacity is split into one slot range per writer. A writer only touches its own
+    range and publishes new transitions by bumping its counter in a shared counter array
+    after the data is written, so writers never take a lock. Readers sample from the
+    published slots of all writers and leave out the `guard` slots each writer overwrites
+    next, so a batch does not pick up half-written transitions.
+
+    The creating process owns the memory and unlinks it on close(). Its child processes
+    get their handle through for_writer(k), which attaches by name, e.g.
+        storage = SharedMemoryStorage(capacity, obs_shape, writers=4)
+        Process(target=actor, args=(storage.for_writer(k), ...))
+    and in the actor ReplayBuffer(..., storage=storage).add_batch(...) as usual. The learner
+    uses ReplayBuffer/PrioritizedReplay with the creating instance, PrioritizedReplay picks
+    up new slots with max priority through external_writes() and gives the guard slots zero
+    priority, so it only samples published slots as well. The buffers cannot save() or load()
+    a shared storage.
+    """
+    def __init__(self, capacity, obs_shape, obs_dtype=np.float32, writers=1, writer=0, guard=16, names=None):
+        self.capacity = capacity
+        self.obs_shape = tuple(obs_shape)
+        self.obs_dtype = np.dtype(obs_dtype)
+        self.writers = writers
+        self.writer = writer
+        self.writer_capacity = capacity // writers
+        self.guard = min(guard, self.writer_capacity - 1)
+        self.owner = names is None
+        self.blocks = {}
+        layout = {"states": (self.obs_shape, self.obs_dtype),
+                  "actions": ((), np.int32),
+                  "rewards": ((), np.float32),
+                  "next_states": (self.obs_shape, self.obs_dtype),
+                  "dones": ((), np.bool_)}
+        self.fields = {name: self._shared(name, (self.capacity,) + shape, dtype, names) for name, (shape, dtype) in layout.items()}
+        self.counts = self._shared("counts", (writers,), np.int64, names)
+        self.seen = np.array(self.counts)
+
+    def _shared(self, name, shape, dtype, names):
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        if names is None:
+            block = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            block = shared_memory.SharedMemory(name=names[name])
+        self.blocks[name] = block
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        if names is None:
+            array[...] = 0
+        return array
+
+    def spec(self):
+        """Everything another process needs to attach to this memory."""
+        return {"capacity": self.capacity, "obs_shape": self.obs_shape, "obs_dtype": self.obs_dtype.str,
+                "writers": self.writers, "guard": self.guard, "names": {name: block.name for name, block in self.blocks.items()}}
+
+    def for_writer(self, writer):
+        """Handle for actor `writer`, safe to pass to another process."""
+        return _attach_shared_memory(self.spec(), writer)
+
+    @property
+    def pos(self):
+        return int(self.counts[self.writer] % self.writer_capacity)
+
+    def add(self, states, actions, rewards, next_states, dones):
+        """Writes a batch into this writer's slot range and publishes it afterwards."""
+        n = len(actions)
+        start = int(self.counts[self.writer])
+        indices = self.writer * self.writer_capacity + (start + np.arange(n)) % self.writer_capacity
+        self.fields["states"][indices] = states
+        self.fields["actions"][indices] = actions
+        self.fields["rewards"][indices] = rewards
+        self.fields["next_states"][indices] = next_states
+        self.fields["dones"][indices] = dones
+        self.counts[self.writer] = start + n
+        return indices
+
+    def _valid(self):
+        """First valid offset and number of valid slots in every writer range."""
+        counts = np.array(self.counts)
+        full = counts > self.writer_capacity - self.guard
+        starts = np.where(full, (counts + self.guard) % self.writer_capacity, 0)
+        sizes = np.where(full, self.writer_capacity - self.guard, counts)
+        return starts, sizes
+
+    def sample_indices(self, batch_size, rng=None):
+        starts, sizes = self._valid()
+        offsets = _randint(rng, sizes.sum(), batch_size)
+        bounds = np.cumsum(sizes)
+        writers = np.searchsorted(bounds, offsets, side="right")
+        offsets -= bounds[writers] - sizes[writers]
+        return writers * self.writer_capacity + (starts[writers] + offsets) % self.writer_capacity
+
+    def external_writes(self):
+        counts = np.array(self.counts)
+        new = []
+        for writer, (seen, count) in enumerate(zip(self.seen, counts)):
+            positions = np.arange(max(seen, count - self.writer_capacity), count)
+            new.append(writer * self.writer_capacity + positions % self.writer_capacity)
+        self.seen = counts
+        return np.concatenate(new).astype(np.int64)
+
+    def guard_slots(self):
+        """The guard slots every writer overwrites next, left out by sample_indices()."""
+        counts = np.array(self.counts)
+        positions = (counts[:, None] + np.arange(self.guard)) % self.writer_capacity
+        return (np.arange(self.writers)[:, None] * self.writer_capacity + positions).reshape(-1)
+
+    def __reduce__(self):
+        return (_attach_shared_memory, (self.spec(), self.writer))
+
+    def __len__(self):
+        return int(self._valid()[1].sum())
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+
+
+def _attach_shared_memory(spec, writer):
+    return SharedMemoryStorage(spec["capacity"], spec["obs_shape"], np.dtype(spec["obs_dtype"]), spec["writers"], writer, spec["guard"], spec["names"])
+
+
+class CompressedStorage(ArrayStorage):
+    """
+    ArrayStorage that keeps states and next_states zlib compressed, one blob per observation,
+    and only decompresses the sampled batch, spread over a small thread pool (zlib releases
+    the GIL). Rewards, actions and dones stay plain arrays.
+
+    With obs_scale set, float observations are stored as round(obs * obs_scale) in uint8
+    before compression, which is lossless for the /255 frames of wrapper.make_env.
+    stats() reports the compression ratio against float32 observations and the mean
+    decode time per sampled batch.
+    """
+    def __init__(self, capacity, level=1, threads=4, obs_scale=None):
+        super(CompressedStorage, self).__init__(capacity)
+        self.level = level
+        self.obs_scale = obs_scale
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.decode_time = 0.
+        self.decodes = 0
+
+    def _allocate(self, state):
+        state = np.asarray(state)
+        self.obs_shape = state.shape
+        if self.obs_scale is not None:
+            self.obs_dtype = np.dtype(np.uint8)
+        else:
+            self.obs_dtype = np.dtype(np.float32) if np.issubdtype(state.dtype, np.floating) else state.dtype
+        self.fields = {"states": np.full(self.capacity, b"", dtype=object),
+                       "actions": self._alloc("actions", (), np.int32),
+                       "rewards": self._alloc("rewards", (), np.float32),
+                       "next_states": np.full(self.capacity, b"", dtype=object),
+                       "dones": self._alloc("dones", (), np.bool_)}
+
+    def _map(self, fn, items):
+        if self.pool is None or len(items) < 2:
+            return [fn(item) for item in items]
+        return list(self.pool.map(fn, items))
+
+    def _encode(self, obs):
+        if self.obs_scale is not None:
+            obs = np.rint(obs * self.obs_scale)
+        raw = np.ascontiguousarray(obs, dtype=self.obs_dtype).tobytes()
+        return zlib.compress(raw, self.level)
+
+    def _decode(self, blob):
+        return np.frombuffer(zlib.decompress(blob), dtype=self.obs_dtype).reshape(self.obs_shape)
+
+    def add(self, states, actions, rewards, next_states, dones):
+        if self.fields is None:
+            self._allocate(states[0])
+        n = len(actions)
+        indices = (self.pos + np.arange(n)) % self.capacity
+        blobs = self._map(self._encode, list(states) + list(next_states))
+        self.fields["states"][indices] = blobs[:n]
+        self.fields["next_states"][indices] = blobs[n:]
+        self.fields["actions"][indices] = actions
+        self.fields["rewards"][indices] = rewards
+        self.fields["dones"][indices] = dones
+        self.raw_bytes += 2 * n * int(np.prod(self.obs_shape)) * np.dtype(np.float32).itemsize
+        self.compressed_bytes += sum(len(blob) for blob in blobs)
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        return indices
+
+    def _decode_batch(self, blobs):
+        obs = np.stack(self._map(self._decode, list(blobs))).astype(np.float32)
+        if self.obs_scale is not None:
+            obs /= self.obs_scale
+        return obs
+
+    def gather(self, indices):
+        f = self.fields
+        t0 = time.perf_counter()
+        states = self._decode_batch(f["states"][indices])
+        next_states = self._decode_batch(f["next_states"][indices])
+        self.decode_time += time.perf_counter() - t0
+        self.decodes += 1
+        return (states,
+                f["actions"][indices].astype(np.int64),
+                f["rewards"][indices],
+                next_states,
+                f["dones"][indices].astype(np.float32))
+
+    def stats(self):
+        if self.compressed_bytes == 0:
+            return {}
+        return {"compression_ratio": self.raw_bytes / self.compressed_bytes,
+                "decode_ms": 1000 * self.decode_time / max(self.decodes, 1)}
+
+    def _snapshot(self):
+        arrays, meta = super(CompressedStorage, self)._snapshot()
+        if self.fields is not None:
+            for name in ("states", "next_states"):
+                blobs = arrays.pop(name)
+                arrays[name + "_offsets"] = np.cumsum([0] + [len(blob) for blob in blobs])
+                arrays[name + "_data"] = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+            meta.update(obs_shape=list(self.obs_shape), obs_dtype=self.obs_dtype.str, obs_scale=self.obs_scale,
+                        raw_bytes=self.raw_bytes, compressed_bytes=self.compressed_bytes)
+        return arrays, meta
+
+    def _restore(self, arrays, meta):
+        if "states_data" in arrays:
+            self.obs_shape = tuple(meta["obs_shape"])
+            self.obs_dtype = np.dtype(meta["obs_dtype"])
+            self.obs_scale = meta["obs_scale"]
+            self.raw_bytes = meta["raw_bytes"]
+            self.compressed_bytes = meta["compressed_bytes"]
+            for name in ("states", "next_states"):
+                offsets, data = arrays.pop(name + "_offsets"), arrays.pop(name + "_data")
+                blobs = np.empty(self.capacity, dtype=object)
+                blobs[:] = [data[start:end].tobytes() for start, end in zip(offsets[:-1], offsets[1:])]
+                arrays[name] = blobs
+            arrays["actions"], arrays["rewards"], arrays["dones"] = [np.array(arrays[k]) for k in ("actions", "rewards", "dones")]
+        super(CompressedStorage, self)._restore(arrays, meta)
+
+
+def _randint(rng, high, size):
+    """Integers in [0, high) from the np.random.Generator rng, or from the global NumPy RNG if rng is None."""
+    if rng is None:
+        return np.random.randint(0, high, size=size)
+    return rng.integers(0, high, size=size)
+
+
+def _copy_rows(dst, src, rows=65536):
+    """Copies src into dst in chunks of rows, so a mapped source is never read into memory as a whole."""
+    for start in range(0, len(src), rows):
+        dst[start:start + rows] = src[start:start + rows]
+
+
+def _save_arrays(directory, arrays, meta, written=()):
+    """Writes arrays and meta to directory, the names in written were already saved there by _copy_arrays."""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + ".npy"), array)
+    meta = dict(meta, arrays=sorted(list(arrays) + list(written)))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def _load_arrays(directory, mmap=True):
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="c" if mmap else None) for name in meta["arrays"]}
+    return arrays, meta
+
+
+def _steps_to_arrays(prefix, steps):
+    """Stacks a list of (state, action, reward, next_state, done) entries field by field."""
+    if len(steps) == 0:
+        return {}
+    return {"{}_{}".format(prefix, i): np.stack([np.asarray(step[i]) for step in steps]) for i in range(5)}
+
+
+def _arrays_to_steps(prefix, arrays, length):
+    return [tuple(np.array(arrays["{}_{}".format(prefix, i)][j]) for i in range(5)) for j in range(length)]
+
+
+def _check_snapshots(buffer):
+    if isinstance(buffer.memory, SharedMemoryStorage):
+        raise ValueError("save_replay is not supported for shared memory storage, the memory is owned by the actor processes")
+
+
+def _copy_arrays(directory, arrays):
+    """
+    Copies arrays that keep changing after a snapshot was taken. In-memory arrays are copied in memory,
+    memory-mapped ones (possibly larger than RAM) are copied into their .npy file in directory right away.
+    Returns the copies and the names already written.
+    """
+    copies, written = {}, []
+    for name, array in arrays.items():
+        if isinstance(array, np.memmap):
+            os.makedirs(directory, exist_ok=True)
+            copy = np.lib.format.open_memmap(os.path.join(directory, name + ".npy"), mode="w+", dtype=array.dtype, shape=array.shape)
+            _copy_rows(copy, array)
+            copy.flush()
+            written.append(name)
+        else:
+            copies[name] = np.array(array, copy=True)
+    return copies, written
+
+
+def _snapshot_buffer(buffer, directory, arrays, meta, copy=True):
+    """
+    Takes a snapshot of storage, n-step window, pending single adds and the given buffer state and
+    returns a function that writes it to a temporary folder next to `directory` and swaps it in once
+    it is complete, so a job killed while saving leaves the previous snapshot intact. With copy the
+    arrays are copied first, the buffer can keep changing while the function runs on another thread.
+    """
+    _check_snapshots(buffer)
+    directory = directory.rstrip("/")
+    tmp = directory + ".tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    storage_arrays, storage_meta = buffer.memory._snapshot()
+    arrays = dict(arrays)
+    arrays.update(_steps_to_arrays("window", buffer.n_step_buffer))
+    arrays.update(_steps_to_arrays("pending", buffer.pending))
+    meta = dict(meta, window=len(buffer.n_step_buffer), pending=len(buffer.pending))
+    storage_written, written = (), ()
+    if copy:
+        storage_arrays, storage_written = _copy_arrays(os.path.join(tmp, "storage"), storage_arrays)
+        arrays, written = _copy_arrays(tmp, arrays)
+        storage_meta = dict(storage_meta)
+
+    def write():
+        _save_arrays(os.path.join(tmp, "storage"), storage_arrays, storage_meta, storage_written)
+        _save_arrays(tmp, arrays, meta, written)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp, directory)
+    return write
+
+
+def _save_buffer(buffer, directory, arrays, meta):
+    """Writes a snapshot of the buffer (see _snapshot_buffer) to directory."""
+    _snapshot_buffer(buffer, directory, arrays, meta, copy=False)()
+
+
+def _load_buffer(buffer, directory, mmap=True):
+    """Counterpart of _save_buffer, returns the remaining arrays and state for the buffer to restore."""
+    _check_snapshots(buffer)
+    buffer.memory.load(os.path.join(directory, "storage"), mmap)
+    arrays, meta = _load_arrays(directory, mmap)
+    buffer.n_step_buffer.clear()
+    buffer.n_step_buffer.extend(_arrays_to_steps("window", arrays, meta["window"]))
+    buffer.pending = _arrays_to_steps("pending", arrays, meta["pending"])
+    return arrays, meta
+
+
+def make_storage(kind, capacity, parallel_env=1, directory=None, layout="columnar", align=0, block_size=1,
+                 compress_level=1, compress_threads=4, obs_scale=None):
+    """
+    Creates the transition storage used by ReplayBuffer and PrioritizedReplay.
+    Params
+    ======
+        kind (str): "array" for plain columnar arrays, "frames" for deduplicated uint8 frame stacks,
+                    "memmap" for arrays memory-mapped from files in directory, "compressed" for zlib compressed observations
+        capacity (int): number of transitions
+        parallel_env (int): number of environments feeding the buffer
+        directory (str): folder for the memmap files
+        layout (str): memmap file layout, "columnar" or "record"
+        align (int): memmap record alignment in bytes, 0 = packed
+        block_size (int): length of the runs of consecutive slots drawn by memmap uniform sampling
+        compress_level (int): zlib level of the compressed storage
+        compress_threads (int): threads decompressing a sampled batch
+        obs_scale (float): compressed storage keeps observations as uint8 round(obs * obs_scale) if set
+    """
+    if kind == "array":
+        return ArrayStorage(capacity)
+    elif kind == "frames":
+        return FrameStorage(capacity, parallel_env)
+    elif kind == "memmap":
+        return MemmapStorage(capacity, directory, layout=layout, align=align, block_size=block_size)
+    elif kind == "compressed":
+        return CompressedStorage(capacity, level=compress_level, threads=compress_threads, obs_scale=obs_scale)
+    else:
+        raise ValueError("Unknown replay storage: {}".format(kind))
+
+
+def _to_device(array, device, pin_memory=False):
+    tensor = torch.from_numpy(array)
+    if pin_memory:
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
 class ReplayBuffer:
     """Fixed-size buffer to store experience tuples."""
 
-    def __init__(self, buffer_size, batch_size, device, seed, gamma, n_step=1, parallel_env=4):
+    def __init__(self, buffer_size, batch_size, device, seed, gamma, n_step=1, parallel_env=4, storage=None, rng=None):
         """Initialize a ReplayBuffer object.
         Params
         ======
             buffer_size (int): maximum size of buffer
             batch_size (int): size of each training batch
             seed (int): random seed
+            storage (ArrayStorage): transition storage, defaults to an ArrayStorage of buffer_size
+            rng (np.random.Generator): generator the batches are sampled with, default = the global NumPy RNG
         """
         self.device = device
-        self.memory = deque(maxlen=buffer_size)  
+        self.memory = storage if storage is not None else ArrayStorage(buffer_size)
+        self.rng = rng
         self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
         self.seed = random.seed(seed)
         self.gamma = gamma
         self.n_step = n_step
         self.parallel_env = parallel_env
-        self.n_step_buffer = [deque(maxlen=self.n_step) for i in range(parallel_env)]
-        self.iter_ = 0
+        self.n_step_buffer = deque(maxlen=self.n_step) # one entry per env step, every field stacked over the parallel envs
+        self.discounts = (self.gamma ** np.arange(self.n_step)).astype(np.float32)
+        self.pending = []
     
     def add(self, state, action, reward, next_state, done):
-        """Add a new experience to memory."""
-        if self.iter_ == self.parallel_env:
-            self.iter_ = 0
-        self.n_step_buffer[self.iter_].append((state, action, reward, next_state, done))
-        if len(self.n_step_buffer[self.iter_]) == self.n_step:
-            state, action, reward, next_state, done = self.calc_multistep_return(self.n_step_buffer[self.iter_])
-            e = self.experience(state, action, reward, next_state, done)
-            self.memory.append(e)
-        self.iter_ += 1
-
+        """Add a new experience of a single env to memory, stored once every parallel env delivered one."""
+        self.pending.append((state, action, reward, next_state, done))
+        if len(self.pending) == self.parallel_env:
+            self.add_batch(*[np.stack(field) for field in zip(*self.pending)])
+            self.pending = []
 
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add one step of all parallel envs to memory, every argument is stacked along the worker dimension."""
+        states, next_states = self.memory.encode(states, next_states)
+        self.n_step_buffer.append((states, np.asarray(actions), np.asarray(rewards, dtype=np.float32), next_states, np.asarray(dones)))
+        if len(self.n_step_buffer) == self.n_step:
+            self.memory.add(*self.calc_multistep_return(self.n_step_buffer))
 
     def calc_multistep_return(self, n_step_buffer):
-        Return = 0
-        for idx in range(self.n_step):
-            Return += self.gamma**idx * n_step_buffer[idx][2]
+        # discounted rewards of all envs at once: (n_step,) @ (n_step, worker)
+        Return = self.discounts @ np.stack([step[2] for step in n_step_buffer])
         
         return n_step_buffer[0][0], n_step_buffer[0][1], Return, n_step_buffer[-1][3], n_step_buffer[-1][4]
         
@@ -50,45 +794,124 @@ class ReplayBuffer:
     
     def sample(self):
         """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
+        return self.to_tensors(self.sample_arrays())
+
+    def sample_arrays(self):
+        """Randomly sample a batch of experiences from memory as NumPy arrays."""
+        indices = self.memory.sample_indices(self.batch_size, self.rng)
+        return self.memory.gather(indices)
 
-        states = torch.from_numpy(np.stack([e.state for e in experiences if e is not None])).float().to(self.device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(self.device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(self.device)
-        next_states = torch.from_numpy(np.stack([e.next_state for e in experiences if e is not None])).float().to(self.device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(self.device)
+    def to_tensors(self, experiences, pin_memory=False):
+        """Moves a batch of NumPy experiences to the device, optionally through pinned host memory."""
+        states, actions, rewards, next_states, dones = [_to_device(e, self.device, pin_memory) for e in experiences]
   
-        return (states, actions, rewards, next_states, dones)
+        return (states, actions.unsqueeze(1), rewards.unsqueeze(1), next_states, dones.unsqueeze(1))
+
+    def stats(self):
+        return self.memory.stats()
+
+    def save(self, directory):
+        """Snapshot the whole buffer into directory, see ArrayStorage.save."""
+        _save_buffer(self, directory, {}, {})
+
+    def snapshot(self, directory):
+        """
+        Copies the buffer and returns a function that writes the copy to directory like save(), e.g. on a
+        background thread while the buffer keeps filling. Memory-mapped storages are copied to disk right away.
+        """
+        return _snapshot_buffer(self, directory, {}, {})
+
+    def load(self, directory, mmap=True):
+        """Restore a snapshot written by save()."""
+        _load_buffer(self, directory, mmap)
 
     def __len__(self):
         """Return the current size of internal memory."""
         return len(self.memory)
 
+class SumTree(object):
+    """
+    Binary segment tree over the replay slots where every inner node holds the sum
+    of its two children. Leaf updates and prefix-sum lookups are O(log N) and both
+    work on whole batches of indices at once.
+    """
+    def __init__(self, capacity):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.depth = int(np.log2(self.capacity))
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+    def update(self, indices, values):
+        """Sets the leaves at `indices` to `values` and recomputes their ancestors level by level."""
+        nodes = np.atleast_1d(np.asarray(indices, dtype=np.int64)) + self.capacity
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns for every prefix sum in `values` the index of the leaf it falls into."""
+        values = np.array(values, dtype=np.float64)
+        idx = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * idx
+            left_sum = self.tree[left]
+            go_right = values > left_sum
+            values = np.where(go_right, values - left_sum, values)
+            idx = np.where(go_right, left + 1, left)
+        return idx - self.capacity
+
+    def last_nonzero(self):
+        """Index of the last leaf with a nonzero value."""
+        idx = 1
+        for _ in range(self.depth):
+            idx = 2 * idx + 1 if self.tree[2 * idx + 1] > 0 else 2 * idx
+        return idx - self.capacity
+
+
 class PrioritizedReplay(object):
     """
     Proportional Prioritization
+
+    Priorities p^alpha are kept in a SumTree so adding, sampling and updating are
+    O(log N) instead of a pass over the whole capacity. Transitions live in an
+    ArrayStorage and batches are returned as ready-to-use arrays.
     """
-    def __init__(self, capacity, batch_size, seed, gamma=0.99, n_step=1, alpha=0.6, beta_start = 0.4, beta_frames=100000, parallel_env=4):
+    def __init__(self, capacity, batch_size, seed, gamma=0.99, n_step=1, alpha=0.6, beta_start = 0.4, beta_frames=100000, parallel_env=4, storage=None, rng=None):
         self.alpha = alpha
         self.beta_start = beta_start
         self.beta_frames = beta_frames
         self.frame = 1 #for beta calculation
         self.batch_size = batch_size
         self.capacity   = capacity
-        self.buffer     = []
-        self.pos        = 0
-        self.priorities = np.zeros((capacity,), dtype=np.float32)
+        self.memory     = storage if storage is not None else ArrayStorage(capacity)
+        self.tree       = SumTree(capacity)
+        self.max_prio   = 1.0 # running max priority, new transitions get it so they are replayed at least once
+        self.stamps     = np.zeros((capacity,), dtype=np.int64) # write counter per slot, tells if a slot was overwritten
+        self.writes     = 0
         self.seed = np.random.seed(seed)
+        self.rng = rng if rng is not None else np.random # generator of the sampled prefix sums
         self.n_step = n_step
         self.parallel_env = parallel_env
-        self.n_step_buffer = [deque(maxlen=self.n_step) for i in range(parallel_env)]
-        self.iter_ = 0
         self.gamma = gamma
+        self.n_step_buffer = deque(maxlen=self.n_step) # one entry per env step, every field stacked over the parallel envs
+        self.discounts = (self.gamma ** np.arange(self.n_step)).astype(np.float32)
+        self.pending = []
+
+    @property
+    def pos(self):
+        return self.memory.pos
 
     def calc_multistep_return(self,n_step_buffer):
-        Return = 0
-        for idx in range(self.n_step):
-            Return += self.gamma**idx * n_step_buffer[idx][2]
+        # discounted rewards of all envs at once: (n_step,) @ (n_step, worker)
+        Return = self.discounts @ np.stack([step[2] for step in n_step_buffer])
         
         return n_step_buffer[0][0], n_step_buffer[0][1], Return, n_step_buffer[-1][3], n_step_buffer[-1][4]
     
@@ -104,61 +927,207 @@ class PrioritizedReplay(object):
         return min(1.0, self.beta_start + frame_idx * (1.0 - self.beta_start) / self.beta_frames)
     
     def add(self, state, action, reward, next_state, done):
-        if self.iter_ == self.parallel_env:
-            self.iter_ = 0
-        assert state.ndim == next_state.ndim
-        state      = np.expand_dims(state, 0)
-        next_state = np.expand_dims(next_state, 0)
-        
-        # n_step calc
-        self.n_step_buffer[self.iter_].append((state, action, reward, next_state, done))
-        if len(self.n_step_buffer[self.iter_]) == self.n_step:
-            state, action, reward, next_state, done = self.calc_multistep_return(self.n_step_buffer[self.iter_])
-
-        max_prio = self.priorities.max() if self.buffer else 1.0 # gives max priority if buffer is not empty else 1
+        """Add a new experience of a single env to memory, stored once every parallel env delivered one."""
+        self.pending.append((state, action, reward, next_state, done))
+        if len(self.pending) == self.parallel_env:
+            self.add_batch(*[np.stack(field) for field in zip(*self.pending)])
+            self.pending = []
 
-        if len(self.buffer) < self.capacity:
-            self.buffer.append((state, action, reward, next_state, done))
-        else:
-            # puts the new data on the position of the oldes since it circles via pos variable
-            # since if len(buffer) == capacity -> pos == 0 -> oldest memory (at least for the first round?) 
-            self.buffer[self.pos] = (state, action, reward, next_state, done) 
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add one step of all parallel envs to memory, every argument is stacked along the worker dimension."""
+        assert states.ndim == next_states.ndim
+        states, next_states = self.memory.encode(states, next_states)
         
-        self.priorities[self.pos] = max_prio
-        self.pos = (self.pos + 1) % self.capacity # lets the pos circle in the ranges of capacity if pos+1 > cap --> new posi = 0
-        self.iter_ += 1
+        # n_step calc
+        self.n_step_buffer.append((states, np.asarray(actions), np.asarray(rewards, dtype=np.float32), next_states, np.asarray(dones)))
+        if len(self.n_step_buffer) == self.n_step:
+            indices = self.memory.add(*self.calc_multistep_return(self.n_step_buffer))
+            self.tree.update(indices, self.max_prio ** self.alpha)
+            self.writes += 1
+            self.stamps[indices] = self.writes
 
         
     def sample(self):
-        N = len(self.buffer)
-        if N == self.capacity:
-            prios = self.priorities
-        else:
-            prios = self.priorities[:self.pos]
-            
-        # calc P = p^a/sum(p^a)
-        probs  = prios ** self.alpha
-        P = probs/probs.sum()
-        
-        #gets the indices depending on the probability p
-        indices = np.random.choice(N, self.batch_size, p=P) 
-        samples = [self.buffer[idx] for idx in indices]
+        fresh = self.memory.external_writes()
+        if len(fresh):
+            self.tree.update(fresh, self.max_prio ** self.alpha)
+            self.writes += 1
+            self.stamps[fresh] = self.writes
+        # slots a writer is about to overwrite are not sampled, they get their priority back once rewritten
+        guard = self.memory.guard_slots()
+        if len(guard):
+            self.tree.update(guard, 0.)
+        N = len(self.memory)
+        total = self.tree.total()
+
+        # stratified sampling: one prefix sum drawn uniformly from each of batch_size equal segments of P = p^a/sum(p^a)
+        segment = total / self.batch_size
+        values = (np.arange(self.batch_size) + self.rng.uniform(size=self.batch_size)) * segment
+        indices = self.tree.find(values)
+        # rounding in the prefix sums can end a search on an empty leaf
+        empty = self.tree[indices] <= 0
+        if empty.any():
+            indices[empty] = self.tree.last_nonzero()
+        P = self.tree[indices] / total
         
         beta = self.beta_by_frame(self.frame)
         self.frame+=1
                 
         #Compute importance-sampling weight
-        weights  = (N * P[indices]) ** (-beta)
+        weights  = (N * P) ** (-beta)
         # normalize weights
         weights /= weights.max() 
         weights  = np.array(weights, dtype=np.float32) 
         
-        states, actions, rewards, next_states, dones = zip(*samples) 
-        return np.concatenate(states), actions, rewards, np.concatenate(next_states), dones, indices, weights
+        states, actions, rewards, next_states, dones = self.memory.gather(indices)
+        return states, actions, rewards, next_states, dones, indices, weights
     
+    def update_priorities(self, batch_indices, batch_priorities, stamps=None):
+        """
+        Sets new priorities for sampled slots. If the write stamps the slots had when they
+        were sampled are given, slots that got overwritten since are skipped.
+        """
+        prios = np.maximum(np.asarray(batch_priorities, dtype=np.float64).reshape(-1), 1e-6) # a zero priority would never be sampled again
+        if stamps is not None:
+            fresh = self.stamps[batch_indices] == stamps
+            batch_indices, prios = np.asarray(batch_indices)[fresh], prios[fresh]
+            if len(prios) == 0:
+                return
+        self.tree.update(batch_indices, prios ** self.alpha)
+        self.max_prio = max(self.max_prio, prios.max())
+
+    def stats(self):
+        return self.memory.stats()
+
+    def _state(self):
+        return ({"tree": self.tree.tree, "stamps": self.stamps},
+                {"frame": self.frame, "max_prio": float(self.max_prio), "writes": self.writes})
+
+    def save(self, directory):
+        """Snapshot the whole buffer including priorities and the beta annealing frame into directory."""
+        _save_buffer(self, directory, *self._state())
+
+    def snapshot(self, directory):
+        """Copy of the buffer and a function writing it to directory, see ReplayBuffer.snapshot."""
+        return _snapshot_buffer(self, directory, *self._state())
+
+    def load(self, directory, mmap=True):
+        """Restore a snapshot written by save()."""
+        arrays, meta = _load_buffer(self, directory, mmap)
+        self.tree.tree = np.array(arrays["tree"])
+        self.stamps = np.array(arrays["stamps"])
+        self.frame = meta["frame"]
+        self.max_prio = meta["max_prio"]
+        self.writes = meta["writes"]
+
+    def __len__(self):
+        return len(self.memory)
+
+
+
+class BatchPrefetcher(object):
+    """
+    Wraps a ReplayBuffer or PrioritizedReplay and assembles batches on a background thread,
+    keeping up to `size` ready batches in a queue so sampling and the host to device copy
+    overlap with the learner's forward/backward pass. Batches go through pinned memory
+    when the device is a GPU.
+
+    Offers the add/add_batch/sample/update_priorities/__len__ interface of the wrapped
+    buffer; a lock serializes writes and sampling. For PER the write stamps of the slots
+    of the last handed-out batch are remembered, so update_priorities skips slots that were
+    overwritten while the batch was queued. This assumes every batch is learned on and its
+    priorities updated before the next sample() call, which is what IQN_Agent does.
+    """
+    def __init__(self, memory, device, size=2, per=False):
+        self.memory = memory
+        self.device = device
+        self.per = per
+        self.pin_memory = torch.cuda.is_available() and torch.device(device).type == "cuda"
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=size)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.error = None
+        self.in_flight = None
+
+    def add(self, state, action, reward, next_state, done):
+        with self.lock:
+            self.memory.add(state, action, reward, next_state, done)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        with self.lock:
+            self.memory.add_batch(states, actions, rewards, next_states, dones)
+
+    def _assemble(self):
+        if not self.per:
+            with self.lock:
+                experiences = self.memory.sample_arrays()
+            return self.memory.to_tensors(experiences, self.pin_memory), None
+        with self.lock:
+            states, actions, rewards, next_states, dones, idx, weights = self.memory.sample()
+            stamps = self.memory.stamps[idx]
+        states, actions, rewards, next_states, dones, weights = [_to_device(e, self.device, self.pin_memory)
+                                                                 for e in (states, actions, rewards, next_states, dones, weights)]
+        return (states, actions, rewards, next_states, dones, idx, weights), stamps
+
+    def _work(self):
+        try:
+            while not self.stop_event.is_set():
+                batch = self._assemble()
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.error = e
+
+    def sample(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._work, daemon=True)
+            self.thread.start()
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                batch, stamps = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        if self.per:
+            self.in_flight = (batch[5], stamps)
+        return batch
+
     def update_priorities(self, batch_indices, batch_priorities):
-        for idx, prio in zip(batch_indices, batch_priorities):
-            self.priorities[idx] = prio 
+        stamps = None
+        if self.in_flight is not None and self.in_flight[0] is batch_indices:
+            stamps = self.in_flight[1]
+        with self.lock:
+            self.memory.update_priorities(batch_indices, batch_priorities, stamps)
+
+    def stats(self):
+        return self.memory.stats()
+
+    def save(self, directory):
+        with self.lock:
+            self.memory.save(directory)
+
+    def snapshot(self, directory):
+        with self.lock:
+            return self.memory.snapshot(directory)
+
+    def load(self, directory, mmap=True):
+        with self.lock:
+            self.memory.load(directory, mmap)
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
     def __len__(self):
-        return len(self.buffer)
\ No newline at end of file
+        return len(self.memory)
@@ -5,8 +5,15 @@ from torch.nn.utils import clip_grad_norm_
 import torch.nn.functional as F
 import random
 import math
-from ReplayBuffers import ReplayBuffer, PrioritizedReplay
+import time
+import copy
+import contextlib
+import threading
+from collections import deque
+from ReplayBuffers import ReplayBuffer, PrioritizedReplay, BatchPrefetcher
 from model import IQN
+from checkpoint import rng_state, set_rng_state
+from metrics import PhaseTimer
 
 class IQN_Agent():
     """Interacts with and learns from the environment."""
@@ -26,7 +33,20 @@ class IQN_Agent():
                  N,
                  worker,
                  device,
-                 seed):
+                 seed,
+                 storage=None,
+                 prefetch=0,
+                 compile_learn=False,
+                 target_update="soft",
+                 target_update_every=1,
+                 log_every=1,
+                 precision="fp32",
+                 async_learner=False,
+                 actor_sync_every=100,
+                 replay_ratio=1.,
+                 K=0,
+                 timer=None,
+                 noise_reset="forward"):
         """Initialize an Agent object.
         
         Params
@@ -42,6 +62,25 @@ class IQN_Agent():
             UPDATE_EVERY (int): update frequency
             device (str): device that is used for the compute
             seed (int): random seed
+            storage (ArrayStorage): transition storage for the replay buffer, see ReplayBuffers.make_storage
+            prefetch (int): number of batches assembled ahead on a background thread, 0 = sample synchronously
+            compile_learn (bool): run the loss computations through torch.compile, falls back to eager if that fails
+            target_update (str): "soft", "periodic" or "hard" target network updates, see TargetUpdater
+            target_update_every (int): learn steps between periodic or hard target updates
+            log_every (int): learn steps between read backs of the mean loss to the writer
+            precision (str): "fp32", "bf16" runs the network forward passes under bfloat16 autocast with float32
+                             weights and loss, "bf16+target" additionally stores the target network in bfloat16
+            async_learner (bool): learn on a background thread while the caller keeps stepping the environments,
+                                  acting uses a copy of the network
+            actor_sync_every (int): learn steps between refreshes of the acting network in async_learner mode
+            replay_ratio (float): learn steps per environment step in async_learner mode, the learner waits when it
+                                  gets ahead and step() waits when the learner falls more than replay_slack steps behind
+            K (int): number of fixed, evenly spaced quantiles of the low-latency act path with cached tau embeddings,
+                     0 = act on N freshly sampled taus
+            timer (PhaseTimer): times the memory, learn and logging phases, default = disabled
+            noise_reset (str): when noisy networks resample their noise, "forward" in every forward pass, "step" once
+                               per learn step, "episode" once per learn step for learning and on reset_noise() (at
+                               episode ends) for acting
         """
         self.state_size = state_size
         self.action_size = action_size
@@ -52,7 +91,7 @@ class IQN_Agent():
         self.device = device
         self.TAU = TAU
         self.N = N
-        self.K = 32
+        self.K = K
         self.entropy_tau = 0.03
         self.lo = -1
         self.alpha = 0.9
@@ -60,6 +99,8 @@ class IQN_Agent():
         
         self.BATCH_SIZE = BATCH_SIZE * worker
         self.Q_updates = 0
+        self.log_every = log_every
+        self.loss_sum = 0.
         self.n_step = n_step
         self.worker = worker
         self.UPDATE_EVERY = worker
@@ -76,41 +117,191 @@ class IQN_Agent():
             duel = False
 
         
+        # fnoisy_* agents use factorized gaussian noise
+        noise = "factorized" if self.network.startswith("fnoisy") else "independent"
+        assert noise_reset in ("forward", "step", "episode"), "unknown noise reset schedule: {}".format(noise_reset)
+        self.noise_reset = noise_reset if noisy else "forward"
+
         # IQN-Network
-        self.qnetwork_local = IQN(state_size, action_size,layer_size, n_step, seed, N, dueling=duel, noisy=noisy, device=device).to(device)
-        self.qnetwork_target = IQN(state_size, action_size,layer_size, n_step, seed,N, dueling=duel, noisy=noisy, device=device).to(device)
+        self.qnetwork_local = IQN(state_size, action_size,layer_size, n_step, seed, N, dueling=duel, noisy=noisy, device=device, noise=noise).to(device)
+        self.qnetwork_target = IQN(state_size, action_size,layer_size, n_step, seed,N, dueling=duel, noisy=noisy, device=device, noise=noise).to(device)
+        if self.noise_reset != "forward":
+            self.qnetwork_local.resample_noise(False)
+            self.qnetwork_target.resample_noise(False)
 
         self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=LR)
+        assert precision in ("fp32", "bf16", "bf16+target"), "unknown precision: {}".format(precision)
+        self.precision = precision
+        self.target_updater = TargetUpdater(self.qnetwork_local, self.qnetwork_target, TAU, target_update, target_update_every,
+                                            dtype=torch.bfloat16 if precision == "bf16+target" else None)
         print(self.qnetwork_local)
+
+        # Loss computations, traced once per variant in compiled mode
+        self.loss_fn = self.quantile_loss
+        self.munchausen_loss_fn = self.munchausen_loss
+        self.munchausen_per_loss_fn = self.munchausen_per_loss
+        if compile_learn:
+            self.loss_fn = CompiledFunction(self.quantile_loss)
+            self.munchausen_loss_fn = CompiledFunction(self.munchausen_loss)
+            self.munchausen_per_loss_fn = CompiledFunction(self.munchausen_per_loss)
         
         # Replay memory
         if "per" in self.network:
             self.per = 1
-            self.memory = PrioritizedReplay(BUFFER_SIZE, self.BATCH_SIZE, seed=seed, gamma=self.GAMMA, n_step=n_step, parallel_env=worker)
+            self.memory = PrioritizedReplay(BUFFER_SIZE, self.BATCH_SIZE, seed=seed, gamma=self.GAMMA, n_step=n_step, parallel_env=worker, storage=storage)
         else:
             self.per = 0
-            self.memory = ReplayBuffer(BUFFER_SIZE, self.BATCH_SIZE, self.device, seed, self.GAMMA, n_step, worker)
+            self.memory = ReplayBuffer(BUFFER_SIZE, self.BATCH_SIZE, self.device, seed, self.GAMMA, n_step, worker, storage=storage)
+        if prefetch > 0 or async_learner:
+            # the prefetcher also serializes the replay access of the actor and the learner thread
+            self.memory = BatchPrefetcher(self.memory, self.device, max(prefetch, 1), per=self.per)
+
+        # Asynchronous learning
+        self.async_learner = async_learner
+        if async_learner:
+            self.qnetwork_actor = copy.deepcopy(self.qnetwork_local)
+        elif self.noise_reset == "episode":
+            # acting keeps its own noise between episode ends but shares the weights
+            self.qnetwork_actor = shared_weights_copy(self.qnetwork_local)
+        else:
+            self.qnetwork_actor = self.qnetwork_local
+        self.actor_sync_every = actor_sync_every
+        self.actor_weights = None
+        self.replay_ratio = replay_ratio
+        self.replay_slack = 100
+        self.learn_steps = 0
+        self.learner_cond = threading.Condition()
+        # held by the learner thread for every update, see learner_paused()
+        self.learner_lock = threading.Lock()
+        self.learner_stop = threading.Event()
+        self.learner_thread = None
+        self.learner_error = None
+
+        self.timer = timer if timer is not None else PhaseTimer(enabled=False)
+
+        # Acting
+        self.act_buffers = {}
+        self.act_latency = deque(maxlen=1000)
         
         # Initialize time step (for updating every UPDATE_EVERY steps)
         self.t_step = 0
+
+    def state_dict(self):
+        """
+        Training state of the agent: both networks, the optimizer, the update counters and the random number
+        generator states. The replay memory is saved separately (memory.save).
+        """
+        return {"qnetwork_local": self.qnetwork_local.state_dict(),
+                "qnetwork_target": self.qnetwork_target.state_dict(),
+                "optimizer": self.optimizer.state_dict(),
+                "target_updater": self.target_updater.state_dict(),
+                "Q_updates": self.Q_updates,
+                "t_step": self.t_step,
+                "learn_steps": self.learn_steps,
+                "rng": rng_state()}
+
+    def learner_paused(self):
+        """
+        Context in which the async learner makes no update, so that e.g. state_dict() and the copy of it a
+        checkpoint takes see the networks, optimizer and target of a single update.
+        """
+        return self.learner_lock
+
+    def load_state_dict(self, state):
+        self.qnetwork_local.load_state_dict(state["qnetwork_local"])
+        self.qnetwork_target.load_state_dict(state["qnetwork_target"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.target_updater.load_state_dict(state["target_updater"])
+        self.Q_updates = state["Q_updates"]
+        self.t_step = state["t_step"]
+        self.learn_steps = state["learn_steps"]
+        if self.async_learner:
+            self.qnetwork_actor.load_state_dict(state["qnetwork_local"])
+        set_rng_state(state["rng"])
+
+    def autocast(self):
+        """Context for the network forward passes, bfloat16 autocast unless training in fp32."""
+        if self.precision == "fp32":
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16)
     
     def step(self, state, action, reward, next_state, done, writer):
-        # Save experience in replay memory
-        self.memory.add(state, action, reward, next_state, done)
+        # Save the experiences of all parallel envs in replay memory, arguments are stacked along the worker dimension
+        with self.timer.phase("memory_add"):
+            self.memory.add_batch(state, action, reward, next_state, done)
         
+        if self.async_learner:
+            self._step_async(writer)
+            return
+
         # Learn every UPDATE_EVERY time steps.
-        self.t_step = (self.t_step + 1) % self.UPDATE_EVERY
+        self.t_step = (self.t_step + len(done)) % self.UPDATE_EVERY
         if self.t_step == 0:
             # If enough samples are available in memory, get random subset and learn
             if len(self.memory) > self.BATCH_SIZE:
-                experiences = self.memory.sample()
-                if not self.per:
-                    loss = self.learn(experiences)
-                else:
-                    loss = self.learn_per(experiences)
-                self.Q_updates += 1
-                writer.add_scalar("IQN/Q_loss", loss, self.Q_updates)
-                writer.flush()
+                self.update(writer)
+
+    def update(self, writer):
+        """Samples a batch and makes one learn step."""
+        if self.noise_reset != "forward":
+            self.qnetwork_local.reset_noise()
+            self.qnetwork_target.reset_noise()
+        with self.timer.phase("memory_sample"):
+            experiences = self.memory.sample()
+        if not self.per:
+            loss = self.learn(experiences)
+        else:
+            loss = self.learn_per(experiences)
+        self.Q_updates += 1
+        # the loss stays on the device and is only read back every log_every updates
+        self.loss_sum = self.loss_sum + loss
+        if self.Q_updates % self.log_every == 0:
+            with self.timer.phase("loss_readback"):
+                writer.add_scalar("IQN/Q_loss", (self.loss_sum / self.log_every).item(), self.Q_updates)
+            self.loss_sum = 0.
+
+    def _step_async(self, writer):
+        if self.learner_error is not None:
+            raise self.learner_error
+        if self.learner_thread is None:
+            self.learner_thread = threading.Thread(target=self._learn_async, args=(writer,), daemon=True)
+            self.learner_thread.start()
+        with self.learner_cond:
+            if len(self.memory) > self.BATCH_SIZE:
+                self.learn_steps += 1
+                self.learner_cond.notify_all()
+            # throttle the environments if the learner falls behind the replay ratio
+            while self.Q_updates < self.replay_ratio * self.learn_steps - self.replay_slack and self.learner_error is None:
+                self.learner_cond.wait(0.1)
+
+    def _learn_async(self, writer):
+        try:
+            while True:
+                with self.learner_cond:
+                    while self.Q_updates >= self.replay_ratio * self.learn_steps and not self.learner_stop.is_set():
+                        self.learner_cond.wait(0.1)
+                if self.learner_stop.is_set():
+                    break
+                with self.learner_lock:
+                    self.update(writer)
+                    if self.Q_updates % self.actor_sync_every == 0:
+                        # picked up by the actor on its next act() call
+                        self.actor_weights = [p.detach().clone() for p in self.qnetwork_local.parameters()]
+                with self.learner_cond:
+                    self.learner_cond.notify_all()
+        except Exception as e:
+            self.learner_error = e
+            with self.learner_cond:
+                self.learner_cond.notify_all()
+
+    def close(self):
+        """Stops the learner thread and the batch prefetcher."""
+        self.learner_stop.set()
+        if self.learner_thread is not None:
+            self.learner_thread.join()
+            self.learner_thread = None
+        if isinstance(self.memory, BatchPrefetcher):
+            self.memory.close()
 
     def act(self, state, eps=0., eval=False):
         """Returns actions for given state as per current policy. Acting only every 4 frames!
@@ -125,23 +316,58 @@ class IQN_Agent():
 
         # Epsilon-greedy action selection
         if random.random() > eps: # select greedy action if random number is higher than epsilon or noisy network is used!
-            state = np.array(state)
-            if len(self.state_size) > 1:
-                state = torch.from_numpy(state).float().to(self.device)#.expand(self.K, self.state_size[0], self.state_size[1],self.state_size[2])        
+            # only the network actions are timed, random picks would hide the inference latency early in training
+            t0 = time.perf_counter()
+            self._sync_actor()
+            if self.K > 0:
+                action = self._act_fixed(state)
             else:
-                state = torch.from_numpy(state).float().to(self.device)#.expand(self.K, self.state_size[0])
-            self.qnetwork_local.eval()
-            with torch.no_grad():
-                action_values = self.qnetwork_local.get_qvalues(state)#.mean(0)
-            self.qnetwork_local.train()
-            action = np.argmax(action_values.cpu().data.numpy(), axis=1)
-            return action
+                state = np.array(state)
+                state = torch.from_numpy(state).float().to(self.device)
+                self.qnetwork_actor.eval()
+                with torch.no_grad(), self.autocast():
+                    action_values = self.qnetwork_actor.get_qvalues(state)#.mean(0)
+                self.qnetwork_actor.train()
+                action = np.argmax(action_values.float().cpu().data.numpy(), axis=1)
+            self.act_latency.append(time.perf_counter() - t0)
         else:
             if eval:
                 action = random.choices(np.arange(self.action_size), k=1)
             else:
                 action = random.choices(np.arange(self.action_size), k=self.worker)
-            return action
+        return action
+
+    def reset_noise(self):
+        """Resamples the noise of the acting network, called at episode ends with noise_reset="episode"."""
+        self.qnetwork_actor.reset_noise()
+
+    def _sync_actor(self):
+        # new weights published by the async learner
+        if self.actor_weights is not None:
+            weights, self.actor_weights = self.actor_weights, None
+            with torch.no_grad():
+                for param, weight in zip(self.qnetwork_actor.parameters(), weights):
+                    param.copy_(weight)
+            if self.noise_reset == "step":
+                self.qnetwork_actor.reset_noise()
+
+    def _act_fixed(self, state):
+        """Greedy actions on the K fixed quantiles, the states are copied into a preallocated input tensor."""
+        state = np.asarray(state)
+        buffer = self.act_buffers.get(state.shape)
+        if buffer is None:
+            buffer = self.act_buffers[state.shape] = torch.empty(state.shape, dtype=torch.float32, device=self.device)
+        with torch.inference_mode(), self.autocast():
+            buffer.copy_(torch.from_numpy(state))
+            action_values = self.qnetwork_actor.get_qvalues_fixed(buffer, self.K)
+            return action_values.argmax(dim=1).cpu().numpy()
+
+    def act_stats(self):
+        """Percentiles of the act() latency over the last 1000 greedy (network) actions in milliseconds."""
+        if len(self.act_latency) == 0:
+            return {}
+        p50, p90, p99 = np.percentile(np.array(self.act_latency) * 1000, [50, 90, 99])
+        return {"latency_p50_ms": p50, "latency_p90_ms": p90, "latency_p99_ms": p99}
 
 
 
@@ -153,81 +379,24 @@ class IQN_Agent():
             gamma (float): discount factor
         """
         self.optimizer.zero_grad()
-        if not self.munchausen:
-            states, actions, rewards, next_states, dones = experiences
-            # Get max predicted Q values (for next states) from target model
-            Q_targets_next, _ = self.qnetwork_target(next_states, self.N) 
-            Q_targets_next = Q_targets_next.detach().cpu()
-            action_indx = torch.argmax(Q_targets_next.mean(dim=1), dim=1, keepdim=True)
-            Q_targets_next = Q_targets_next.gather(2, action_indx.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1)).transpose(1,2)
-            # Compute Q targets for current states 
-            Q_targets = rewards.unsqueeze(-1) + (self.GAMMA**self.n_step * Q_targets_next.to(self.device) * (1. - dones.unsqueeze(-1)))
-            # Get expected Q values from local model
-            Q_expected, taus = self.qnetwork_local(states, self.N)
-            Q_expected = Q_expected.gather(2, actions.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1))
-
-            # Quantile Huber loss
-            td_error = Q_targets - Q_expected
-            assert td_error.shape == (self.BATCH_SIZE, self.N, self.N), "wrong td error shape"
-            huber_l = calculate_huber_loss(td_error, 1.0)
-            quantil_l = abs(taus -(td_error.detach() < 0).float()) * huber_l / 1.0
-            
-            loss = quantil_l.sum(dim=1).mean(dim=1) # , keepdim=True if per weights get multipl
-            loss = loss.mean()
-        else:
-            states, actions, rewards, next_states, dones = experiences
-            Q_targets_next, _ = self.qnetwork_target(next_states, self.N)
-            Q_targets_next = Q_targets_next.detach() #(batch, num_tau, actions)
-            q_t_n = Q_targets_next.mean(dim=1)
-
-            # calculate log-pi 
-            logsum = torch.logsumexp(\
-                (q_t_n - q_t_n.max(1)[0].unsqueeze(-1))/self.entropy_tau, 1).unsqueeze(-1) #logsum trick
-            assert logsum.shape == (self.BATCH_SIZE, 1), "log pi next has wrong shape: {}".format(logsum.shape)
-            tau_log_pi_next = (q_t_n - q_t_n.max(1)[0].unsqueeze(-1) - self.entropy_tau*logsum).unsqueeze(1)
-            
-            pi_target = F.softmax(q_t_n/self.entropy_tau, dim=1).unsqueeze(1)
-
-            Q_target = (self.GAMMA**self.n_step * (pi_target * (Q_targets_next-tau_log_pi_next)*(1 - dones.unsqueeze(-1))).sum(2)).unsqueeze(1)
-            assert Q_target.shape == (self.BATCH_SIZE, 1, self.N)
-
-            q_k_target = self.qnetwork_target.get_qvalues(states).detach()
-            v_k_target = q_k_target.max(1)[0].unsqueeze(-1) 
-            tau_log_pik = q_k_target - v_k_target - self.entropy_tau*torch.logsumexp(\
-                                                                    (q_k_target - v_k_target)/self.entropy_tau, 1).unsqueeze(-1)
-
-            assert tau_log_pik.shape == (self.BATCH_SIZE, self.action_size), "shape instead is {}".format(tau_log_pik.shape)
-            munchausen_addon = tau_log_pik.gather(1, actions)
-            
-            # calc munchausen reward:
-            munchausen_reward = (rewards + self.alpha*torch.clamp(munchausen_addon, min=self.lo, max=0)).unsqueeze(-1)
-            assert munchausen_reward.shape == (self.BATCH_SIZE, 1, 1)
-            # Compute Q targets for current states 
-            Q_targets = munchausen_reward + Q_target
-            # Get expected Q values from local model
-            q_k, taus = self.qnetwork_local(states, self.N)
-            Q_expected = q_k.gather(2, actions.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1))
-            assert Q_expected.shape == (self.BATCH_SIZE, self.N, 1)
-
-            # Quantile Huber loss
-            td_error = Q_targets - Q_expected
-            assert td_error.shape == (self.BATCH_SIZE, self.N, self.N), "wrong td error shape"
-            huber_l = calculate_huber_loss(td_error, 1.0)
-            quantil_l = abs(taus -(td_error.detach() < 0).float()) * huber_l / 1.0
-            
-            loss = quantil_l.sum(dim=1).mean(dim=1) # , keepdim=True if per weights get multipl
-            loss = loss.mean()
-
+        states, actions, rewards, next_states, dones = experiences
+        with self.timer.phase("learn_forward"):
+            if not self.munchausen:
+                loss, _ = self.loss_fn(states, actions, rewards, next_states, dones)
+            else:
+                loss, _ = self.munchausen_loss_fn(states, actions, rewards, next_states, dones)
 
         # Minimize the loss
-        loss.backward()
-        clip_grad_norm_(self.qnetwork_local.parameters(),1)
+        with self.timer.phase("learn_backward"):
+            loss.backward()
+            clip_grad_norm_(self.qnetwork_local.parameters(),1)
 
-        self.optimizer.step()
+            self.optimizer.step()
 
         # ------------------- update target network ------------------- #
-        self.soft_update(self.qnetwork_local, self.qnetwork_target)
-        return loss.detach().cpu().numpy()
+        with self.timer.phase("target_update"):
+            self.target_updater.step()
+        return loss.detach()
 
     def learn_per(self, experiences):
             """Update value parameters using given batch of experience tuples.
@@ -237,109 +406,277 @@ class IQN_Agent():
                 gamma (float): discount factor
             """
             self.optimizer.zero_grad()
-            if not self.munchausen:
-                states, actions, rewards, next_states, dones, idx, weights = experiences
-                
-                states = torch.FloatTensor(states).to(self.device)
-                next_states = torch.FloatTensor(np.float32(next_states)).to(self.device)
-                actions = torch.LongTensor(actions).to(self.device).unsqueeze(1)
-                rewards = torch.FloatTensor(rewards).to(self.device).unsqueeze(1) 
-                dones = torch.FloatTensor(dones).to(self.device).unsqueeze(1)
-                weights = torch.FloatTensor(weights).unsqueeze(1).to(self.device)
-
-                # Get max predicted Q values (for next states) from target model
-                Q_targets_next, _ = self.qnetwork_target(next_states, self.N) 
-                Q_targets_next = Q_targets_next.detach().cpu()
-                action_indx = torch.argmax(Q_targets_next.mean(dim=1), dim=1, keepdim=True)
-                Q_targets_next = Q_targets_next.gather(2, action_indx.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1)).transpose(1,2)
-                # Compute Q targets for current states 
-                Q_targets = rewards.unsqueeze(-1) + (self.GAMMA**self.n_step * Q_targets_next.to(self.device) * (1. - dones.unsqueeze(-1)))
-                # Get expected Q values from local model
-                Q_expected, taus = self.qnetwork_local(states, self.N)
-                Q_expected = Q_expected.gather(2, actions.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1))
-
-                # Quantile Huber loss
-                td_error = Q_targets - Q_expected
-                assert td_error.shape == (self.BATCH_SIZE, self.N, self.N), "wrong td error shape"
-                huber_l = calculate_huber_loss(td_error, 1.0)
-                quantil_l = abs(taus -(td_error.detach() < 0).float()) * huber_l / 1.0
-                
-                loss = quantil_l.sum(dim=1).mean(dim=1, keepdim=True)* weights # , keepdim=True if per weights get multipl
-                loss = loss.mean()
-            else:
-                states, actions, rewards, next_states, dones, idx, weights = experiences
-                states = torch.FloatTensor(states).to(self.device)
-                next_states = torch.FloatTensor(np.float32(next_states)).to(self.device)
-                actions = torch.LongTensor(actions).to(self.device).unsqueeze(1)
-                rewards = torch.FloatTensor(rewards).to(self.device).unsqueeze(1) 
-                dones = torch.FloatTensor(dones).to(self.device).unsqueeze(1)
-                weights = torch.FloatTensor(weights).unsqueeze(1).to(self.device)
-
-                Q_targets_next, _ = self.qnetwork_target(next_states, self.N)
-                Q_targets_next = Q_targets_next.detach() #(batch, num_tau, actions)
-                q_t_n = Q_targets_next.mean(dim=1)
-                # calculate log-pi 
-                logsum = torch.logsumexp(\
-                    (Q_targets_next - Q_targets_next.max(2)[0].unsqueeze(-1))/self.entropy_tau, 2).unsqueeze(-1) #logsum trick
-                assert logsum.shape == (self.BATCH_SIZE, self.N, 1), "log pi next has wrong shape"
-                tau_log_pi_next = Q_targets_next - Q_targets_next.max(2)[0].unsqueeze(-1) - self.entropy_tau*logsum
-                
-                pi_target = F.softmax(q_t_n/self.entropy_tau, dim=1).unsqueeze(1)
-
-                Q_target = (self.GAMMA**self.n_step * (pi_target * (Q_targets_next-tau_log_pi_next)*(1 - dones.unsqueeze(-1))).sum(2)).unsqueeze(1)
-                assert Q_target.shape == (self.BATCH_SIZE, 1, self.N)
-
-                q_k_target = self.qnetwork_target.get_qvalues(states).detach()
-                v_k_target = q_k_target.max(1)[0].unsqueeze(-1) # (8,8,1)
-                tau_log_pik = q_k_target - v_k_target - self.entropy_tau*torch.logsumexp(\
-                                                                        (q_k_target - v_k_target)/self.entropy_tau, 1).unsqueeze(-1)
-
-                assert tau_log_pik.shape == (self.BATCH_SIZE, self.action_size), "shape instead is {}".format(tau_log_pik.shape)
-                munchausen_addon = tau_log_pik.gather(1, actions) #.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1)
-                
-                # calc munchausen reward:
-                munchausen_reward = (rewards + self.alpha*torch.clamp(munchausen_addon, min=self.lo, max=0)).unsqueeze(-1)
-                assert munchausen_reward.shape == (self.BATCH_SIZE, 1, 1)
-                # Compute Q targets for current states 
-                Q_targets = munchausen_reward + Q_target
-                # Get expected Q values from local model
-                q_k, taus = self.qnetwork_local(states, self.N)
-                Q_expected = q_k.gather(2, actions.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1))
-                assert Q_expected.shape == (self.BATCH_SIZE, self.N, 1)
-
-                # Quantile Huber loss
-                td_error = Q_targets - Q_expected
-                assert td_error.shape == (self.BATCH_SIZE, self.N, self.N), "wrong td error shape"
-                huber_l = calculate_huber_loss(td_error, 1.0)
-                quantil_l = abs(taus -(td_error.detach() < 0).float()) * huber_l / 1.0
-                
-                loss = quantil_l.sum(dim=1).mean(dim=1, keepdim=True)* weights # , keepdim=True if per weights get multipl
-                loss = loss.mean()
-
+            states, actions, rewards, next_states, dones, idx, weights = experiences
+            states = torch.as_tensor(states, device=self.device)
+            next_states = torch.as_tensor(next_states, device=self.device)
+            actions = torch.as_tensor(actions, device=self.device).unsqueeze(1)
+            rewards = torch.as_tensor(rewards, device=self.device).unsqueeze(1) 
+            dones = torch.as_tensor(dones, device=self.device).unsqueeze(1)
+            weights = torch.as_tensor(weights, device=self.device).unsqueeze(1)
+            with self.timer.phase("learn_forward"):
+                if not self.munchausen:
+                    loss, td_error = self.loss_fn(states, actions, rewards, next_states, dones, weights)
+                else:
+                    loss, td_error = self.munchausen_per_loss_fn(states, actions, rewards, next_states, dones, weights)
 
             # Minimize the loss
-            loss.backward()
-            clip_grad_norm_(self.qnetwork_local.parameters(),1)
-            self.optimizer.step()
+            with self.timer.phase("learn_backward"):
+                loss.backward()
+                clip_grad_norm_(self.qnetwork_local.parameters(),1)
+                self.optimizer.step()
 
             # ------------------- update target network ------------------- #
-            self.soft_update(self.qnetwork_local, self.qnetwork_target)
-            # update priorities
-            td_error = td_error.sum(dim=1).mean(dim=1,keepdim=True) # not sure about this -> test 
-            self.memory.update_priorities(idx, abs(td_error.data.cpu().numpy()))
-            return loss.detach().cpu().numpy()            
-
-    def soft_update(self, local_model, target_model):
-        """Soft update model parameters.
-        θ_target = τ*θ_local + (1 - τ)*θ_target
-        Params
-        ======
-            local_model (PyTorch model): weights will be copied from
-            target_model (PyTorch model): weights will be copied to
-            tau (float): interpolation parameter 
+            with self.timer.phase("target_update"):
+                self.target_updater.step()
+            # update priorities, the only read back per update since the sum tree lives on the host
+            with self.timer.phase("priority_update"):
+                td_error = td_error.sum(dim=1).mean(dim=1,keepdim=True) # not sure about this -> test 
+                self.memory.update_priorities(idx, abs(td_error.data.cpu().numpy()))
+            return loss.detach()            
+
+    def quantile_loss(self, states, actions, rewards, next_states, dones, weights=None):
+        """
+        Double IQN loss of a batch, weighted by the PER importance-sampling weights if given.
+        Returns the loss and the td errors (batch, N, N).
+        """
+        # Get max predicted Q values (for next states) from target model
+        with self.autocast():
+            Q_targets_next, _ = self.qnetwork_target(next_states, self.N) 
+        Q_targets_next = Q_targets_next.detach().float()
+        action_indx = torch.argmax(Q_targets_next.mean(dim=1), dim=1, keepdim=True)
+        Q_targets_next = Q_targets_next.gather(2, action_indx.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1)).transpose(1,2)
+        # Compute Q targets for current states 
+        Q_targets = rewards.unsqueeze(-1) + (self.GAMMA**self.n_step * Q_targets_next * (1. - dones.unsqueeze(-1)))
+        # Get expected Q values from local model, the loss is computed in float32
+        with self.autocast():
+            Q_expected, taus = self.qnetwork_local(states, self.N)
+        Q_expected = Q_expected.float().gather(2, actions.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1))
+
+        # Quantile Huber loss
+        td_error = Q_targets - Q_expected
+        assert td_error.shape == (self.BATCH_SIZE, self.N, self.N), "wrong td error shape"
+        huber_l = calculate_huber_loss(td_error, 1.0)
+        quantil_l = abs(taus -(td_error.detach() < 0).float()) * huber_l / 1.0
+        
+        loss = quantil_l.sum(dim=1).mean(dim=1, keepdim=True) # , keepdim=True if per weights get multipl
+        if weights is not None:
+            loss = loss * weights
+        return loss.mean(), td_error
+
+    def munchausen_loss(self, states, actions, rewards, next_states, dones):
+        """Munchausen IQN loss of a batch, returns the loss and the td errors (batch, N, N)."""
+        # one target forward over next states and states, the second half gives the Munchausen term
+        with self.autocast():
+            Q_targets_all, _ = self.qnetwork_target(torch.cat([next_states, states]), self.N)
+        Q_targets_all = Q_targets_all.detach().float()
+        Q_targets_next = Q_targets_all[:self.BATCH_SIZE] #(batch, num_tau, actions)
+        q_t_n = Q_targets_next.mean(dim=1)
+
+        # calculate log-pi 
+        logsum = torch.logsumexp(\
+            (q_t_n - q_t_n.max(1)[0].unsqueeze(-1))/self.entropy_tau, 1).unsqueeze(-1) #logsum trick
+        assert logsum.shape == (self.BATCH_SIZE, 1), "log pi next has wrong shape: {}".format(logsum.shape)
+        tau_log_pi_next = (q_t_n - q_t_n.max(1)[0].unsqueeze(-1) - self.entropy_tau*logsum).unsqueeze(1)
+        
+        pi_target = F.softmax(q_t_n/self.entropy_tau, dim=1).unsqueeze(1)
+
+        Q_target = (self.GAMMA**self.n_step * (pi_target * (Q_targets_next-tau_log_pi_next)*(1 - dones.unsqueeze(-1))).sum(2)).unsqueeze(1)
+        assert Q_target.shape == (self.BATCH_SIZE, 1, self.N)
+
+        q_k_target = Q_targets_all[self.BATCH_SIZE:].mean(dim=1)
+        v_k_target = q_k_target.max(1)[0].unsqueeze(-1) 
+        tau_log_pik = q_k_target - v_k_target - self.entropy_tau*torch.logsumexp(\
+                                                                (q_k_target - v_k_target)/self.entropy_tau, 1).unsqueeze(-1)
+
+        assert tau_log_pik.shape == (self.BATCH_SIZE, self.action_size), "shape instead is {}".format(tau_log_pik.shape)
+        munchausen_addon = tau_log_pik.gather(1, actions)
+        
+        # calc munchausen reward:
+        munchausen_reward = (rewards + self.alpha*torch.clamp(munchausen_addon, min=self.lo, max=0)).unsqueeze(-1)
+        assert munchausen_reward.shape == (self.BATCH_SIZE, 1, 1)
+        # Compute Q targets for current states 
+        Q_targets = munchausen_reward + Q_target
+        # Get expected Q values from local model
+        with self.autocast():
+            q_k, taus = self.qnetwork_local(states, self.N)
+        Q_expected = q_k.float().gather(2, actions.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1))
+        assert Q_expected.shape == (self.BATCH_SIZE, self.N, 1)
+
+        # Quantile Huber loss
+        td_error = Q_targets - Q_expected
+        assert td_error.shape == (self.BATCH_SIZE, self.N, self.N), "wrong td error shape"
+        huber_l = calculate_huber_loss(td_error, 1.0)
+        quantil_l = abs(taus -(td_error.detach() < 0).float()) * huber_l / 1.0
+        
+        loss = quantil_l.sum(dim=1).mean(dim=1) # , keepdim=True if per weights get multipl
+        return loss.mean(), td_error
+
+    def munchausen_per_loss(self, states, actions, rewards, next_states, dones, weights):
         """
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(self.TAU*local_param.data + (1.0-self.TAU)*target_param.data)
+        Munchausen IQN loss of a PER batch, log-pi of the next states is taken per quantile.
+        Returns the weighted loss and the td errors (batch, N, N).
+        """
+        # one target forward over next states and states, the second half gives the Munchausen term
+        with self.autocast():
+            Q_targets_all, _ = self.qnetwork_target(torch.cat([next_states, states]), self.N)
+        Q_targets_all = Q_targets_all.detach().float()
+        Q_targets_next = Q_targets_all[:self.BATCH_SIZE] #(batch, num_tau, actions)
+        q_t_n = Q_targets_next.mean(dim=1)
+        # calculate log-pi 
+        logsum = torch.logsumexp(\
+            (Q_targets_next - Q_targets_next.max(2)[0].unsqueeze(-1))/self.entropy_tau, 2).unsqueeze(-1) #logsum trick
+        assert logsum.shape == (self.BATCH_SIZE, self.N, 1), "log pi next has wrong shape"
+        tau_log_pi_next = Q_targets_next - Q_targets_next.max(2)[0].unsqueeze(-1) - self.entropy_tau*logsum
+        
+        pi_target = F.softmax(q_t_n/self.entropy_tau, dim=1).unsqueeze(1)
+
+        Q_target = (self.GAMMA**self.n_step * (pi_target * (Q_targets_next-tau_log_pi_next)*(1 - dones.unsqueeze(-1))).sum(2)).unsqueeze(1)
+        assert Q_target.shape == (self.BATCH_SIZE, 1, self.N)
+
+        q_k_target = Q_targets_all[self.BATCH_SIZE:].mean(dim=1)
+        v_k_target = q_k_target.max(1)[0].unsqueeze(-1) # (8,8,1)
+        tau_log_pik = q_k_target - v_k_target - self.entropy_tau*torch.logsumexp(\
+                                                                (q_k_target - v_k_target)/self.entropy_tau, 1).unsqueeze(-1)
+
+        assert tau_log_pik.shape == (self.BATCH_SIZE, self.action_size), "shape instead is {}".format(tau_log_pik.shape)
+        munchausen_addon = tau_log_pik.gather(1, actions) #.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1)
+        
+        # calc munchausen reward:
+        munchausen_reward = (rewards + self.alpha*torch.clamp(munchausen_addon, min=self.lo, max=0)).unsqueeze(-1)
+        assert munchausen_reward.shape == (self.BATCH_SIZE, 1, 1)
+        # Compute Q targets for current states 
+        Q_targets = munchausen_reward + Q_target
+        # Get expected Q values from local model
+        with self.autocast():
+            q_k, taus = self.qnetwork_local(states, self.N)
+        Q_expected = q_k.float().gather(2, actions.unsqueeze(-1).expand(self.BATCH_SIZE, self.N, 1))
+        assert Q_expected.shape == (self.BATCH_SIZE, self.N, 1)
+
+        # Quantile Huber loss
+        td_error = Q_targets - Q_expected
+        assert td_error.shape == (self.BATCH_SIZE, self.N, self.N), "wrong td error shape"
+        huber_l = calculate_huber_loss(td_error, 1.0)
+        quantil_l = abs(taus -(td_error.detach() < 0).float()) * huber_l / 1.0
+        
+        loss = quantil_l.sum(dim=1).mean(dim=1, keepdim=True)* weights # , keepdim=True if per weights get multipl
+        return loss.mean(), td_error
+
+
+def shared_weights_copy(network):
+    """Copy of the network that shares the parameters with it but has its own buffers (e.g. the noise)."""
+    shared = copy.deepcopy(network)
+    modules = dict(network.named_modules())
+    for name, module in shared.named_modules():
+        for param_name, _ in list(module.named_parameters(recurse=False)):
+            setattr(module, param_name, getattr(modules[name], param_name))
+    return shared
+
+
+class TargetUpdater(object):
+    """
+    Moves the target network towards the local network with fused multi-tensor (foreach) ops
+    over all parameters at once.
+
+    Modes:
+        "soft": θ_target = τ*θ_local + (1 - τ)*θ_target after every learn step
+        "periodic": the same Polyak update every `every` learn steps with τ_k = 1 - (1 - τ)^k,
+                    which moves the target as far as k soft updates towards a fixed local network
+        "hard": θ_target = θ_local every `every` learn steps
+
+    If dtype is given the target network is cast to it (e.g. bfloat16 to halve its memory traffic) and
+    θ_target is tracked in a float32 shadow copy, so that updates with a small τ are not rounded away.
+    """
+    def __init__(self, local_model, target_model, tau, mode="soft", every=1, dtype=None):
+        assert mode in ("soft", "periodic", "hard"), "unknown target update mode: {}".format(mode)
+        self.local_model = local_model
+        self.target_model = target_model
+        self.mode = mode
+        self.every = 1 if mode == "soft" else every
+        if mode == "hard":
+            self.tau = 1.0
+        else:
+            self.tau = 1 - (1 - tau) ** self.every
+        self.steps = 0
+        self.shadow = None
+        if dtype is not None:
+            self.shadow = [p.detach().clone().float() for p in target_model.parameters()]
+            target_model.to(dtype)
+
+    def state_dict(self):
+        return {"steps": self.steps, "shadow": self.shadow}
+
+    def load_state_dict(self, state):
+        self.steps = state["steps"]
+        if self.shadow is not None and state["shadow"] is not None:
+            for shadow, saved in zip(self.shadow, state["shadow"]):
+                shadow.copy_(saved)
+
+    def step(self):
+        """Called after every learn step, updates the target when it is due."""
+        self.steps += 1
+        if self.steps % self.every == 0:
+            self.update()
+
+    @torch.no_grad()
+    def update(self):
+        targets = [p.data for p in self.target_model.parameters()] if self.shadow is None else self.shadow
+        locals_ = [p.data for p in self.local_model.parameters()]
+        if self.mode == "hard":
+            if hasattr(torch, "_foreach_copy_"):
+                torch._foreach_copy_(targets, locals_)
+            else:
+                for target, local in zip(targets, locals_):
+                    target.copy_(local)
+        elif hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(targets, locals_, self.tau)
+        else:
+            for target, local in zip(targets, locals_):
+                target.lerp_(local, self.tau)
+        if self.shadow is not None:
+            for target, shadow in zip(self.target_model.parameters(), self.shadow):
+                target.data.copy_(shadow)
+
+
+def _compile_errors():
+    """Exceptions of torch.compile failing to compile, errors raised by the compiled code itself are not among them."""
+    errors = []
+    try:
+        from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+        errors += [BackendCompilerFailed, Unsupported]
+    except ImportError:
+        pass
+    try:
+        from torch._inductor.exc import InductorError
+        errors.append(InductorError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+class CompiledFunction(object):
+    """
+    Wraps fn with torch.compile and keeps calling the compiled version. If torch.compile is not
+    available or the first call fails to compile, it prints the reason once and runs the eager fn from
+    then on. Any other error, e.g. a shape mismatch or out of memory in the loss, is raised.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.compiled = torch.compile(fn) if hasattr(torch, "compile") else None
+        self.first_call = True
+
+    def __call__(self, *args):
+        if self.compiled is None:
+            return self.fn(*args)
+        if not self.first_call:
+            return self.compiled(*args)
+        try:
+            result = self.compiled(*args)
+        except _compile_errors() as e:
+            print("Compiling {} failed, falling back to eager mode: {}".format(self.fn.__name__, e))
+            self.compiled = None
+            return self.fn(*args)
+        self.first_call = False
+        return result
 
 
 def calculate_huber_loss(td_errors, k=1.0):
@@ -0,0 +1,409 @@
+"""
+Benchmark suite for the replay buffers, the IQN network and the learner, results are printed as JSON
+(and written to -out) so that runs can be compared with each other.
+
+The full suite on a CPU-only machine, saved for a later comparison:
+`python benchmark.py -suite buffers network learner -out bench.json`
+
+To compare eager and compiled learn steps on a CartPole sized network:
+`python benchmark.py -state_size 4 -action_size 2 -compile 0 1`
+
+To measure how much lockstep training of 5 seeds in one process (replicas.py) gains over 5 separate agents:
+`python benchmark.py -suite replicas -replicas 5 -layer_size 128`
+
+To compare float32 and bfloat16 learning, both in throughput and in CartPole learning curves:
+`python benchmark.py -compile 0 -precision fp32 bf16 bf16+target -parity_frames 20000`
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import time
+import numpy as np
+import torch
+
+import MultiPro
+import synthetic_envs
+from agent import IQN_Agent
+from model import IQN
+from replicas import ReplicatedIQN_Agent
+from ReplayBuffers import ReplayBuffer, PrioritizedReplay, make_storage
+
+AGENT_TYPES = ["iqn", "iqn+per", "noisy_iqn", "noisy_iqn+per", "dueling", "dueling+per", "noisy_dueling", "noisy_dueling+per",
+               "fnoisy_iqn", "fnoisy_iqn+per", "fnoisy_dueling", "fnoisy_dueling+per"]
+
+
+class NullWriter(object):
+    """SummaryWriter stand-in that drops everything."""
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_agent(agent_type, munchausen, state_size, action_size, layer_size=512, batch_size=32, buffer_size=10000,
+               N=8, n_step=1, worker=1, device="cpu", seed=1, **kwargs):
+    """Builds an IQN_Agent without printing its network."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return IQN_Agent(state_size=state_size,
+                         action_size=action_size,
+                         network=agent_type,
+                         munchausen=munchausen,
+                         layer_size=layer_size,
+                         n_step=n_step,
+                         BATCH_SIZE=batch_size,
+                         BUFFER_SIZE=buffer_size,
+                         LR=2.5e-4,
+                         TAU=1e-3,
+                         GAMMA=0.99,
+                         N=N,
+                         worker=worker,
+                         device=device,
+                         seed=seed,
+                         **kwargs)
+
+
+def fill_memory(memory, transitions, state_size, action_size, worker=1):
+    """Fills a replay memory with random transitions."""
+    for _ in range(transitions // worker):
+        memory.add_batch(np.random.rand(worker, *state_size).astype(np.float32),
+                               np.random.randint(action_size, size=worker),
+                               np.random.rand(worker).astype(np.float32),
+                               np.random.rand(worker, *state_size).astype(np.float32),
+                               np.random.rand(worker) < 0.01)
+
+
+def observation_stream(state_size, worker, rng):
+    """
+    Endless stream of (worker, *state_size) observations. Pixel observations are uint8 frame stacks that
+    shift by one new frame per step like the Atari wrapper's, feature vectors are float32.
+    """
+    if len(state_size) == 3:
+        stacks = rng.randint(0, 256, size=(worker,) + tuple(state_size), dtype=np.uint8)
+        while True:
+            stacks = np.concatenate([stacks[:, 1:], rng.randint(0, 256, size=(worker, 1) + tuple(state_size[1:]), dtype=np.uint8)], axis=1)
+            yield stacks
+    while True:
+        yield rng.rand(worker, *state_size).astype(np.float32)
+
+
+def bench_buffer(kind, capacity, state_size, storage="array", fill=None, samples=200, batch_size=32, worker=4, seed=1):
+    """
+    add_batch throughput (transitions/s) while filling min(capacity, fill) transitions (fill=None fills
+    the whole capacity), then sample throughput (batches/s) and for PER also update_priorities throughput.
+    """
+    fill = capacity if fill is None else min(capacity, fill)
+    result = {"buffer": kind, "storage": storage, "capacity": capacity, "fill": fill, "state_size": list(state_size)}
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    if kind == "per":
+        memory = PrioritizedReplay(capacity, batch_size, seed, parallel_env=worker, storage=make_storage(storage, capacity, worker))
+    else:
+        memory = ReplayBuffer(capacity, batch_size, "cpu", seed, 0.99, 1, worker, storage=make_storage(storage, capacity, worker))
+    stream = observation_stream(state_size, worker, rng)
+    state = next(stream)
+    steps = max(fill // worker, 1)
+    try:
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            next_state = next(stream)
+            memory.add_batch(state, rng.randint(4, size=worker), rng.rand(worker).astype(np.float32), next_state,
+                             rng.rand(worker) < 0.01)
+            state = next_state
+        add_seconds = time.perf_counter() - t0
+    except MemoryError as e:
+        result["error"] = "MemoryError: {}".format(e)
+        return result
+    result["transitions"] = len(memory)
+    result["add_transitions_per_sec"] = steps * worker / add_seconds
+    t0 = time.perf_counter()
+    for _ in range(samples):
+        batch = memory.sample()
+    result["sample_batches_per_sec"] = samples / (time.perf_counter() - t0)
+    if kind == "per":
+        t0 = time.perf_counter()
+        for _ in range(samples):
+            memory.update_priorities(batch[5], rng.rand(batch_size, 1))
+        result["update_priorities_per_sec"] = samples / (time.perf_counter() - t0)
+    return result
+
+
+def bench_network(state_size, batch_size, num_tau, dueling=False, noisy=False, layer_size=512, action_size=6, iters=100, warmup=10,
+                  noise="independent"):
+    """Latency of IQN.forward (no grad) in milliseconds."""
+    network = IQN(tuple(state_size), action_size, layer_size, 1, 1, num_tau, dueling=dueling, noisy=noisy, device="cpu", noise=noise)
+    inputs = torch.rand(batch_size, *state_size)
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + iters):
+            t0 = time.perf_counter()
+            network(inputs, num_tau)
+            if i >= warmup:
+                times.append(time.perf_counter() - t0)
+    times = np.array(times) * 1000
+    return {"state_size": list(state_size), "batch_size": batch_size, "num_tau": num_tau, "dueling": dueling, "noisy": noisy, "noise": noise if noisy else None,
+            "mean_ms": float(times.mean()), "p50_ms": float(np.percentile(times, 50)), "p99_ms": float(np.percentile(times, 99))}
+
+
+def bench_vecenv(env_name, workers, steps=1000, step_cost_ms=0., seed=1):
+    """Frames per second of a MultiPro.SubprocVecEnv of synthetic environments stepped with random actions."""
+    envs = MultiPro.SubprocVecEnv([lambda: synthetic_envs.make(env_name, step_cost_ms) for _ in range(workers)])
+    envs.seed(seed)
+    envs.reset()
+    rng = np.random.RandomState(seed)
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        envs.step(rng.randint(envs.action_space.n, size=workers))
+    elapsed = time.perf_counter() - t0
+    envs.close()
+    return {"env": env_name, "workers": workers, "step_cost_ms": step_cost_ms, "steps": steps,
+            "frames_per_sec": steps * workers / elapsed}
+
+
+def learn_once(agent):
+    experiences = agent.memory.sample()
+    if agent.per:
+        return agent.learn_per(experiences)
+    return agent.learn(experiences)
+
+
+def _reset(env):
+    state = env.reset()
+    return state[0] if isinstance(state, tuple) else state
+
+
+def _step(env, action):
+    result = env.step(action)
+    if len(result) == 5:
+        state, reward, terminated, truncated, _ = result
+        return state, reward, terminated or truncated
+    state, reward, done, _ = result
+    return state, reward, done
+
+
+def parity_curve(agent_type, precision, frames=20000, eval_every=2000, eval_runs=5, seed=1, env_name="CartPole-v0", **kwargs):
+    """
+    Trains one agent on CartPole and returns its greedy evaluation scores every eval_every frames,
+    so that learning curves of different precisions with the same seed can be compared.
+    """
+    import gym
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    env, eval_env = gym.make(env_name), gym.make(env_name)
+    env.action_space.seed(seed)
+    agent = make_agent(agent_type, 0, env.observation_space.shape, env.action_space.n, layer_size=128,
+                       buffer_size=frames, seed=seed, precision=precision, **kwargs)
+    writer = NullWriter()
+    curve = []
+    state = _reset(env)
+    for frame in range(1, frames + 1):
+        eps = max(1 - frame / (0.1 * frames), 0.01)
+        action = agent.act(np.expand_dims(state, 0), eps)
+        next_state, reward, done = _step(env, action[0].item())
+        agent.step(np.expand_dims(state, 0), np.array([action[0]]), np.array([reward]), np.expand_dims(next_state, 0),
+                   np.array([done]), writer)
+        state = _reset(env) if done else next_state
+        if frame % eval_every == 0:
+            scores = []
+            for _ in range(eval_runs):
+                eval_state, score, eval_done = _reset(eval_env), 0., False
+                while not eval_done:
+                    eval_action = agent.act(np.expand_dims(eval_state, 0), 0., eval=True)
+                    eval_state, reward, eval_done = _step(eval_env, eval_action[0].item())
+                    score += reward
+                scores.append(score)
+            curve.append(float(np.mean(scores)))
+    return {"agent": agent_type, "precision": precision, "frames": frames, "eval_every": eval_every, "eval_scores": curve}
+
+
+def bench_learner(agent_type, munchausen, state_size, action_size, updates=200, warmup=20, **kwargs):
+    """Full learn/learn_per updates per second of one agent configuration."""
+    agent = make_agent(agent_type, munchausen, state_size, action_size, **kwargs)
+    fill_memory(agent.memory, max(2000, 4 * agent.BATCH_SIZE), state_size, action_size)
+    for _ in range(warmup):
+        learn_once(agent)
+    t0 = time.perf_counter()
+    for _ in range(updates):
+        learn_once(agent)
+    elapsed = time.perf_counter() - t0
+    return {"agent": agent_type, "munchausen": munchausen, "state_size": list(state_size), "updates": updates, "seconds": elapsed,
+            "updates_per_sec": updates / elapsed}
+
+
+def bench_replicas(agent_type, munchausen, replicas, state_size, action_size, updates=200, warmup=20, layer_size=512,
+                   batch_size=32, buffer_size=10000, N=8, device="cpu", seed=1):
+    """
+    Learn steps per second of `replicas` separate agents updated one after another and of one
+    ReplicatedIQN_Agent that updates all replicas in a single batched step.
+    """
+    agents = [make_agent(agent_type, munchausen, state_size, action_size, layer_size=layer_size, batch_size=batch_size,
+                         buffer_size=buffer_size, N=N, device=device, seed=seed + r) for r in range(replicas)]
+    for agent in agents:
+        fill_memory(agent.memory, max(2000, 4 * agent.BATCH_SIZE), state_size, action_size)
+    for _ in range(warmup):
+        for agent in agents:
+            learn_once(agent)
+    t0 = time.perf_counter()
+    for _ in range(updates):
+        for agent in agents:
+            learn_once(agent)
+    separate = time.perf_counter() - t0
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        replicated = ReplicatedIQN_Agent(replicas, state_size, action_size, agent_type, munchausen, layer_size, 1, batch_size,
+                                         buffer_size, 2.5e-4, 1e-3, 0.99, N, 1, device, seed)
+    for memory in replicated.memories:
+        fill_memory(memory, max(2000, 4 * replicated.BATCH_SIZE), state_size, action_size)
+    writers = [NullWriter()] * replicas
+    for _ in range(warmup):
+        replicated.update(writers)
+    t0 = time.perf_counter()
+    for _ in range(updates):
+        replicated.update(writers)
+    lockstep = time.perf_counter() - t0
+    return {"agent": agent_type, "munchausen": munchausen, "replicas": replicas, "state_size": list(state_size),
+            "layer_size": layer_size, "updates": updates,
+            "separate_replica_updates_per_sec": replicas * updates / separate,
+            "lockstep_replica_updates_per_sec": replicas * updates / lockstep,
+            "speedup": separate / lockstep}
+
+
+def _shape(text):
+    return tuple(int(d) for d in text.split("x"))
+
+
+def write_report(report, path):
+    """Writes the results gathered so far, called after every suite so that a failing suite keeps the earlier ones."""
+    if path is None:
+        return
+    with open(path + ".tmp", "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-suite", type=str, nargs="+", default=["buffers", "network", "learner", "vecenv"], choices=["buffers", "network", "learner", "vecenv", "replicas"], help="Benchmarks to run, default = buffers network learner vecenv")
+    parser.add_argument("-out", type=str, default=None, help="Also write the JSON results to this file, updated after every suite")
+    parser.add_argument("-threads", type=int, default=0, help="torch intra-op threads, 0 = torch default, default = 0")
+    # buffers
+    parser.add_argument("-buffers", type=str, nargs="+", default=["replay", "per"], choices=["replay", "per"], help="Replay buffers to benchmark, default = replay per")
+    parser.add_argument("-storage", type=str, nargs="+", default=["array"], choices=["array", "frames", "compressed"], help="Replay storages to benchmark, default = array")
+    parser.add_argument("-capacities", type=int, nargs="+", default=[10000, 100000, 1000000], help="Replay capacities, default = 1e4 1e5 1e6")
+    parser.add_argument("-shapes", type=str, nargs="+", default=["12", "4x84x84"], help="Observation shapes of the buffer benchmark, default = 12 4x84x84")
+    parser.add_argument("-fill", type=int, default=None, help="Transitions added per buffer (at most the capacity), default = the capacity")
+    parser.add_argument("-samples", type=int, default=200, help="Timed sampled batches per buffer, default = 200")
+    parser.add_argument("-worker", type=int, default=4, help="Parallel environments feeding the buffers, default = 4")
+    # network
+    parser.add_argument("-net_shapes", type=str, nargs="+", default=["12", "4x84x84"], help="Observation shapes of the network benchmark, default = 12 4x84x84")
+    parser.add_argument("-net_batch", type=int, nargs="+", default=[1, 32, 256], help="Batch sizes of the network benchmark, default = 1 32 256")
+    parser.add_argument("-num_tau", type=int, nargs="+", default=[8, 32, 64], help="Numbers of taus of the network benchmark, default = 8 32 64")
+    parser.add_argument("-iters", type=int, default=50, help="Timed forwards per network configuration, default = 50")
+    # vecenv
+    parser.add_argument("-envs", type=str, nargs="+", default=list(synthetic_envs.ENVS), choices=list(synthetic_envs.ENVS), help="Synthetic environments of the vecenv benchmark, default = all")
+    parser.add_argument("-vec_workers", type=int, nargs="+", default=[1, 2, 4], help="SubprocVecEnv sizes, default = 1 2 4")
+    parser.add_argument("-env_steps", type=int, default=1000, help="Timed vector steps per configuration, default = 1000")
+    parser.add_argument("-step_cost_ms", type=float, nargs="+", default=[0.], help="Busy-wait milliseconds per environment step, default = 0")
+    # learner
+    parser.add_argument("-agent", type=str, nargs="+", default=AGENT_TYPES, choices=AGENT_TYPES, help="Agent types to benchmark, default = all of run.py's -agent choices")
+    parser.add_argument("-munchausen", type=int, nargs="+", default=[0, 1], help="Munchausen settings to benchmark, default = 0 1")
+    parser.add_argument("-compile", type=int, nargs="+", default=[0], help="Benchmark with eager (0) and/or compiled (1) learn step, default = 0")
+    parser.add_argument("-precision", type=str, nargs="+", default=["fp32"], choices=["fp32", "bf16", "bf16+target"], help="Training precisions to benchmark, default = fp32")
+    parser.add_argument("-parity_frames", type=int, default=0, help="If > 0, also train every -agent and -precision on CartPole for this many frames and report the evaluation curves, default = 0")
+    parser.add_argument("-state_size", type=int, nargs="+", default=[4], help="Observation shape of the learner benchmark, e.g. 4 or 4 84 84, default = 4")
+    parser.add_argument("-action_size", type=int, default=2, help="Number of actions, default = 2")
+    parser.add_argument("-layer_size", type=int, default=512, help="Size of the hidden layer, default = 512")
+    parser.add_argument("-bs", "--batch_size", type=int, default=32, help="Batch size, default = 32")
+    parser.add_argument("-N", type=int, default=8, help="Number of quantiles, default = 8")
+    parser.add_argument("-updates", type=int, default=200, help="Timed updates per configuration, default = 200")
+    parser.add_argument("-warmup", type=int, default=20, help="Untimed updates before timing (includes compilation), default = 20")
+    parser.add_argument("-seed", type=int, default=1, help="Random seed, default = 1")
+    # replicas
+    parser.add_argument("-replicas", type=int, nargs="+", default=[2, 5, 10], help="Numbers of replicas of the replicas benchmark, default = 2 5 10")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    report = {"meta": {"device": str(device), "torch": torch.__version__, "numpy": np.__version__,
+                       "python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(),
+                       "cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads(), "args": vars(args)}}
+
+    if "buffers" in args.suite:
+        report["buffers"] = []
+        for shape in args.shapes:
+            for capacity in args.capacities:
+                for kind in args.buffers:
+                    for storage in args.storage:
+                        report["buffers"].append(bench_buffer(kind, capacity, _shape(shape), storage=storage, fill=args.fill,
+                                                              samples=args.samples, batch_size=args.batch_size,
+                                                              worker=args.worker, seed=args.seed))
+        write_report(report, args.out)
+
+    if "network" in args.suite:
+        report["network"] = []
+        for shape in args.net_shapes:
+            for dueling in (False, True):
+                for noisy, noise in ((False, "independent"), (True, "independent"), (True, "factorized")):
+                    for batch_size in args.net_batch:
+                        for num_tau in args.num_tau:
+                            report["network"].append(bench_network(_shape(shape), batch_size, num_tau, dueling, noisy,
+                                                                   layer_size=args.layer_size, iters=args.iters, noise=noise))
+        write_report(report, args.out)
+
+    if "learner" in args.suite:
+        report["learner"] = []
+        for agent_type in args.agent:
+            for munchausen in args.munchausen:
+                for compile_learn in args.compile:
+                    for precision in args.precision:
+                        result = bench_learner(agent_type, munchausen, tuple(args.state_size), args.action_size,
+                                               updates=args.updates, warmup=args.warmup, layer_size=args.layer_size,
+                                               batch_size=args.batch_size, N=args.N, device=device, seed=args.seed,
+                                               compile_learn=bool(compile_learn), precision=precision)
+                        result["compile"] = compile_learn
+                        result["precision"] = precision
+                        report["learner"].append(result)
+        write_report(report, args.out)
+
+    if "replicas" in args.suite:
+        report["replicas"] = []
+        for agent_type in args.agent:
+            for munchausen in args.munchausen:
+                for replicas in args.replicas:
+                    report["replicas"].append(bench_replicas(agent_type, munchausen, replicas, tuple(args.state_size), args.action_size,
+                                                             updates=args.updates, warmup=args.warmup, layer_size=args.layer_size,
+                                                             batch_size=args.batch_size, N=args.N, device=device, seed=args.seed))
+        write_report(report, args.out)
+
+    if "vecenv" in args.suite:
+        report["vecenv"] = []
+        for env_name in args.envs:
+            for step_cost_ms in args.step_cost_ms:
+                for workers in args.vec_workers:
+                    report["vecenv"].append(bench_vecenv(env_name, workers, args.env_steps, step_cost_ms, args.seed))
+        write_report(report, args.out)
+
+    if args.parity_frames > 0:
+        report["parity"] = []
+        for agent_type in args.agent:
+            for precision in args.precision:
+                # a failing run (e.g. a gym that does not work with the installed numpy) is recorded, the others still run
+                try:
+                    result = parity_curve(agent_type, precision, frames=args.parity_frames,
+                                          eval_every=max(args.parity_frames // 10, 1), seed=args.seed, device=device)
+                except Exception as e:
+                    result = {"agent": agent_type, "precision": precision, "frames": args.parity_frames,
+                              "error": "{}: {}".format(type(e).__name__, e)}
+                report["parity"].append(result)
+                write_report(report, args.out)
+
+    write_report(report, args.out)
+    print(json.dumps(report, indent=2))
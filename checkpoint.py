@@ -0,0 +1,128 @@
+import copy
+import glob
+import os
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Copy of a (nested) state with every tensor copied to the cpu, safe to serialize while training goes on."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def checkpoint_paths(directory):
+    """Paths of the complete checkpoints in directory, oldest first."""
+    return sorted(glob.glob(os.path.join(directory, "checkpoint-*.pt")))
+
+
+def latest_checkpoint(directory):
+    checkpoints = checkpoint_paths(directory)
+    return checkpoints[-1] if len(checkpoints) > 0 else None
+
+
+class CheckpointManager(object):
+    """
+    Writes checkpoints of the training state on a background thread.
+
+    save() only snapshots the state to the cpu on the calling thread, serialization happens on the
+    writer thread into "<name>.tmp" which is renamed once complete, so a crash never leaves a partial
+    checkpoint behind. Only the last `keep` checkpoints (checkpoint-<step>.pt) in `directory` are kept.
+
+    A replay snapshot (the function returned by ReplayBuffer.snapshot(replay_path(step))) passed to save()
+    is written on the writer thread before the checkpoint of the same step, so every checkpoint has its
+    own complete replay-<step> directory, which is removed together with the checkpoint.
+    """
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def path(self, step):
+        return os.path.join(self.directory, "checkpoint-{:012d}.pt".format(step))
+
+    def replay_path(self, step):
+        return os.path.join(self.directory, "replay-{:012d}".format(step))
+
+    def save(self, state, step, replay=None):
+        """
+        Queues a checkpoint of state (e.g. IQN_Agent.state_dict() plus the training loop state), replay
+        is an optional function writing the replay snapshot of the same step to replay_path(step).
+        """
+        self.write(state, self.path(step), retain=True, replay=replay)
+
+    def write(self, obj, path, retain=False, replay=None):
+        """Queues an atomic torch.save of obj to path, after running replay() if given."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((snapshot(obj), path, retain, replay))
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            obj, path, retain, replay = item
+            try:
+                if replay is not None:
+                    replay()
+                torch.save(obj, path + ".tmp")
+                os.replace(path + ".tmp", path)
+                if retain:
+                    for old in checkpoint_paths(self.directory)[:-self.keep]:
+                        os.remove(old)
+                        replay_path = old.replace("checkpoint-", "replay-")[:-len(".pt")]
+                        if os.path.isdir(replay_path):
+                            shutil.rmtree(replay_path)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def load(self, path=None, map_location="cpu"):
+        """Loads the checkpoint at path, by default the latest one in the directory."""
+        path = path if path is not None else latest_checkpoint(self.directory)
+        if path is None:
+            raise FileNotFoundError("no checkpoint in {}".format(self.directory))
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def wait(self):
+        """Blocks until every queued checkpoint is written."""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def rng_state():
+    """States of the python, numpy and torch random number generators."""
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
@@ -0,0 +1,173 @@
+"""
+Exports a trained IQN (the model.pth/final.pth state dict written by run.py) as a standalone policy that
+maps a batch of observations to greedy actions, without needing this code base to load it.
+
+The policy evaluates K fixed, evenly spaced taus whose cosine embedding is stored in the artifact, noisy
+layers are replaced by their mean weights, so the exported policy is deterministic.
+
+TorchScript: `python export.py runs/<run>/final.pth -out policy.pt`, load with `torch.jit.load("policy.pt")`
+ONNX:        `python export.py runs/<run>/final.pth -format onnx -out policy.onnx`
+"""
+import argparse
+import copy
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model import IQN, NoisyLinear, FactorizedNoisyLinear
+
+
+def network_config(state_dict):
+    """Recovers the IQN constructor arguments from a saved state dict."""
+    if "head.0.weight" in state_dict:
+        state_size = (state_dict["head.0.weight"].shape[1], 84, 84)
+        layer_size = state_dict["ff_1.weight"].shape[0]
+    else:
+        state_size = (state_dict["head.weight"].shape[1],)
+        layer_size = state_dict["head.weight"].shape[0]
+    dueling = "value.weight" in state_dict
+    action_size = state_dict["advantage.weight" if dueling else "ff_2.weight"].shape[0]
+    noisy = "ff_1.sigma_weight" in state_dict
+    noise = "factorized" if "ff_1.epsilon_in" in state_dict else "independent"
+    return {"state_size": state_size, "action_size": action_size, "layer_size": layer_size, "dueling": dueling, "noisy": noisy,
+            "noise": noise}
+
+
+def load_network(path, state_size=None):
+    """Rebuilds the IQN of a saved state dict on the cpu, state_size overrides the inferred observation shape."""
+    state_dict = torch.load(path, map_location="cpu")
+    config = network_config(state_dict)
+    if state_size is not None:
+        config["state_size"] = tuple(state_size)
+    network = IQN(config["state_size"], config["action_size"], config["layer_size"], 1, 0, 8,
+                  dueling=config["dueling"], noisy=config["noisy"], device="cpu", noise=config["noise"])
+    network.load_state_dict(state_dict)
+    return network.eval(), config
+
+
+def strip_noise(network):
+    """Copy of the network with every (Factorized)NoisyLinear replaced by a Linear with its mean weights (sigma = 0)."""
+    network = copy.deepcopy(network)
+    for module in list(network.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, (NoisyLinear, FactorizedNoisyLinear)):
+                linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+                linear.weight.data.copy_(child.weight.data)
+                if child.bias is not None:
+                    linear.bias.data.copy_(child.bias.data)
+                setattr(module, name, linear)
+    return network
+
+
+class Policy(nn.Module):
+    """
+    Greedy policy of an IQN on K fixed taus. forward(obs) returns the actions (batch,) and, if
+    return_quantiles is set, also the quantiles (batch, K, action_size).
+    """
+    def __init__(self, network, K=32, return_quantiles=False):
+        super(Policy, self).__init__()
+        self.network = strip_noise(network)
+        self.return_quantiles = return_quantiles
+        with torch.no_grad():
+            self.register_buffer("cos_x", self.network.fixed_embedding(K).clone())
+        self.network.embedding_cache = None
+
+    def forward(self, obs):
+        x = torch.relu(self.network.head(obs.float())).flatten(1)
+        quantiles = self.network.quantiles(x, self.cos_x)
+        actions = quantiles.mean(dim=1).argmax(dim=1)
+        if self.return_quantiles:
+            return actions, quantiles
+        return actions
+
+
+def export_torchscript(policy, example, path, metadata):
+    """Traces the policy and saves it with the metadata as policy.json in the archive."""
+    with torch.no_grad():
+        scripted = torch.jit.trace(policy, example)
+    torch.jit.save(scripted, path, _extra_files={"policy.json": json.dumps(metadata)})
+
+
+def export_onnx(policy, example, path, metadata):
+    """Exports the policy as ONNX with a dynamic batch dimension, the metadata goes to path + '.json'."""
+    output_names = ["actions", "quantiles"] if policy.return_quantiles else ["actions"]
+    dynamic_axes = {name: {0: "batch"} for name in ["obs"] + output_names}
+    with torch.no_grad():
+        torch.onnx.export(policy, (example,), path, input_names=["obs"], output_names=output_names,
+                          dynamic_axes=dynamic_axes)
+    with open(path + ".json", "w") as f:
+        json.dump(metadata, f)
+
+
+def load_exported(path, fmt):
+    """Returns a function obs (numpy) -> tuple of numpy outputs for an exported policy."""
+    if fmt == "torchscript":
+        scripted = torch.jit.load(path)
+
+        def run(obs):
+            with torch.no_grad():
+                outputs = scripted(torch.from_numpy(obs))
+            outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+            return tuple(o.numpy() for o in outputs)
+        return run
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path)
+    return lambda obs: tuple(session.run(None, {"obs": obs}))
+
+
+def verify(policy, path, fmt, state_size, batch_sizes=(1, 7, 32), atol=1e-4, seed=0):
+    """
+    Compares the exported policy with the eager one on random observations of several batch sizes.
+    Raises an AssertionError on a mismatch, returns the largest quantile difference.
+    """
+    run = load_exported(path, fmt)
+    rng = np.random.RandomState(seed)
+    max_diff = 0.
+    for batch_size in batch_sizes:
+        obs = rng.rand(batch_size, *state_size).astype(np.float32)
+        with torch.no_grad():
+            expected = policy(torch.from_numpy(obs))
+        expected = expected if isinstance(expected, tuple) else (expected,)
+        outputs = run(obs)
+        if policy.return_quantiles:
+            diff = float(np.abs(outputs[1] - expected[1].numpy()).max())
+            assert diff <= atol, "exported quantiles differ by {} at batch size {}".format(diff, batch_size)
+            max_diff = max(max_diff, diff)
+            # argmax of (numerically) tied Q values may legitimately differ
+            q_values = expected[1].mean(dim=1).numpy()
+            chosen = q_values[np.arange(batch_size), outputs[0]]
+            assert np.all(chosen >= q_values.max(axis=1) - atol), "exported actions differ at batch size {}".format(batch_size)
+        else:
+            assert np.array_equal(outputs[0], expected[0].numpy()), "exported actions differ at batch size {}".format(batch_size)
+    return max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="Path of a saved qnetwork state dict, e.g. runs/<run>/final.pth")
+    parser.add_argument("-out", type=str, default="policy.pt", help="Path of the exported policy, default = policy.pt")
+    parser.add_argument("-format", type=str, default="torchscript", choices=["torchscript", "onnx"], help="Export format, default = torchscript")
+    parser.add_argument("-K", type=int, default=32, help="Number of fixed quantiles the policy evaluates, default = 32")
+    parser.add_argument("-quantiles", type=int, choices=[0,1], default=0, help="Also return the quantiles (batch, K, actions), default = 0")
+    parser.add_argument("-state_size", type=int, nargs="+", default=None, help="Observation shape if it differs from the inferred one (e.g. pixel inputs other than 4x84x84)")
+    parser.add_argument("-verify", type=int, choices=[0,1], default=1, help="Check that exported and eager outputs agree, default = 1")
+    args = parser.parse_args()
+
+    network, config = load_network(args.model, args.state_size)
+    policy = Policy(network, args.K, bool(args.quantiles)).eval()
+    metadata = {"state_size": list(config["state_size"]), "action_size": config["action_size"], "K": args.K,
+                "outputs": ["actions", "quantiles"] if args.quantiles else ["actions"], "source": args.model,
+                "torch": torch.__version__}
+    example = torch.zeros(1, *config["state_size"])
+    if args.format == "torchscript":
+        export_torchscript(policy, example, args.out, metadata)
+    else:
+        export_onnx(policy, example, args.out, metadata)
+    print("Exported {} policy to {}: {}".format(args.format, args.out, json.dumps(metadata)))
+    if args.verify:
+        try:
+            max_diff = verify(policy, args.out, args.format, config["state_size"])
+            print("Verified: exported and eager policy agree (max quantile difference {:.2e})".format(max_diff))
+        except ImportError as e:
+            print("Skipping verification, {}".format(e))
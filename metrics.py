@@ -0,0 +1,182 @@
+import contextlib
+import os
+import queue
+import threading
+import time
+import numpy as np
+import torch
+from collections import deque
+
+
+class MetricsWriter(object):
+    """
+    Stand-in for a SummaryWriter in the training loop that keeps disk I/O off the hot path.
+
+    Scalars are aggregated in memory per tag over a window of values (`window` by default,
+    `windows` overrides it per tag). When a window is complete its mean is written under the
+    original tag, so "IQN/Q_loss", "IQN/Avg 100 score" and "IQN/Eval Score" keep their
+    meaning, and for windows larger than one also "<tag>_min" and "<tag>_max", all at the step
+    of the last value. Finished windows go through a queue to a background thread which writes
+    them and flushes the wrapped writer at most every flush_secs seconds.
+
+    flush() only asks the background thread to flush at its next chance, close() writes the
+    unfinished windows, drains the queue and closes the wrapped writer. The queue holds at most
+    max_queue records, add_scalar() waits when the thread falls that far behind. If writing fails,
+    the error is raised from the next add_scalar() or close().
+    """
+    def __init__(self, writer, window=1, windows=None, flush_secs=10., max_queue=10000):
+        self.writer = writer
+        self.window = window
+        self.windows = windows if windows is not None else {}
+        self.flush_secs = flush_secs
+        self.values = {}
+        self.steps = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.flush_requested = threading.Event()
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag, value, step):
+        self._check_error()
+        with self.lock:
+            values = self.values.setdefault(tag, [])
+            values.append(float(value))
+            self.steps[tag] = step
+            if len(values) >= self.windows.get(tag, self.window):
+                self._emit(tag, values, step)
+                self.values[tag] = []
+
+    def _emit(self, tag, values, step):
+        self.queue.put((tag, float(np.mean(values)), step))
+        if len(values) > 1:
+            self.queue.put((tag + "_min", float(np.min(values)), step))
+            self.queue.put((tag + "_max", float(np.max(values)), step))
+
+    def _work(self):
+        last_flush = time.time()
+        while True:
+            try:
+                record = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                record = ()
+            if record is None:
+                break
+            if self.error is not None:
+                # keep draining so that add_scalar() never waits on a full queue
+                continue
+            try:
+                if record:
+                    self.writer.add_scalar(*record)
+                if self.flush_requested.is_set() or time.time() - last_flush > self.flush_secs:
+                    self.writer.flush()
+                    self.flush_requested.clear()
+                    last_flush = time.time()
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("writing the metrics failed: {}".format(self.error)) from self.error
+
+    def flush(self):
+        self.flush_requested.set()
+
+    def close(self):
+        with self.lock:
+            for tag, values in self.values.items():
+                if values:
+                    self._emit(tag, values, self.steps[tag])
+            self.values = {}
+        self.queue.put(None)
+        self.thread.join()
+        self._check_error()
+        self.writer.flush()
+        self.writer.close()
+
+
+class PhaseTimer(object):
+    """
+    Wall-clock timers of the phases of the training loop, `with timer.phase("env_step"): ...`.
+
+    Keeps the durations of the last `window` calls per phase and reports rolling means and percentiles.
+    A disabled timer hands out a no-op context. On a GPU the phases measure the host side only,
+    device work shows up in the phase that waits for it (e.g. the loss read back in "loss_readback").
+    """
+    def __init__(self, window=1000, enabled=True):
+        self.window = window
+        self.enabled = enabled
+        self.times = {}
+        self.null = contextlib.nullcontext()
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.null
+        return self._measure(name)
+
+    @contextlib.contextmanager
+    def _measure(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            times = self.times.get(name)
+            if times is None:
+                times = self.times.setdefault(name, deque(maxlen=self.window))
+            times.append(time.perf_counter() - t0)
+
+    def stats(self):
+        """{"<phase>_mean_ms": .., "<phase>_p50_ms": .., "<phase>_p99_ms": ..} over the rolling window."""
+        stats = {}
+        for name, times in list(self.times.items()):
+            if len(times) == 0:
+                continue
+            times = np.array(times) * 1000
+            stats[name + "_mean_ms"] = float(times.mean())
+            stats[name + "_p50_ms"], stats[name + "_p99_ms"] = [float(t) for t in np.percentile(times, [50, 99])]
+        return stats
+
+    def log(self, writer, step, prefix="Time/"):
+        for name, value in self.stats().items():
+            writer.add_scalar(prefix + name, value, step)
+
+
+class ProfilerWindow(object):
+    """
+    Records a torch.profiler trace of `updates` learn steps, starting at frame `start_frame`. The trace is
+    written as a chrome trace to directory/trace.json and the ops taking the most time are printed.
+    """
+    def __init__(self, directory, start_frame, updates=10):
+        self.directory = directory
+        self.start_frame = start_frame
+        self.updates = updates
+        self.profiler = None
+        self.start_updates = 0
+        self.done = False
+
+    def step(self, frame, updates):
+        """Called once per loop iteration with the current frame and number of learn steps."""
+        if self.done:
+            return
+        if self.profiler is None:
+            if frame >= self.start_frame:
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+                self.profiler.__enter__()
+                self.start_updates = updates
+        elif updates - self.start_updates >= self.updates:
+            self.close()
+
+    def close(self):
+        """Stops a running recording and exports what it recorded, e.g. when training ended inside the window."""
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.directory, exist_ok=True)
+        self.profiler.export_chrome_trace(os.path.join(self.directory, "trace.json"))
+        print("\n" + self.profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=20))
+        self.profiler = None
+        self.done = True
@@ -21,6 +21,8 @@ class NoisyLinear(nn.Linear):
     
         # reset parameter as initialization of the layer
         self.reset_parameter()
+        # resample the noise in every forward pass, otherwise only on reset_noise()
+        self.resample = True
     
     def reset_parameter(self):
         """
@@ -31,23 +33,62 @@ class NoisyLinear(nn.Linear):
         self.bias.data.uniform_(-std, std)
 
     
-    def forward(self, input):
+    def reset_noise(self):
         # sample random noise in sigma weight buffer and bias buffer
         self.epsilon_weight.normal_()
+        if self.bias is not None:
+            self.epsilon_bias.normal_()
+
+    def forward(self, input):
+        if self.resample:
+            self.reset_noise()
         bias = self.bias
         if bias is not None:
-            self.epsilon_bias.normal_()
             bias = bias + self.sigma_bias * self.epsilon_bias
         return F.linear(input, self.weight + self.sigma_weight * self.epsilon_weight, bias)
 
 
+class FactorizedNoisyLinear(nn.Linear):
+    # Noisy Linear Layer for factorized Gaussian Noise, in + out draws instead of in * out
+    def __init__(self, in_features, out_features, sigma_zero=0.5, bias=True):
+        super(FactorizedNoisyLinear, self).__init__(in_features, out_features, bias=bias)
+        sigma_init = sigma_zero / math.sqrt(in_features)
+        self.sigma_weight = nn.Parameter(torch.full((out_features, in_features), sigma_init))
+        self.register_buffer("epsilon_in", torch.zeros(in_features))
+        self.register_buffer("epsilon_out", torch.zeros(out_features))
+        if bias:
+            self.sigma_bias = nn.Parameter(torch.full((out_features,), sigma_init))
+        self.reset_parameter()
+        self.resample = True
+
+    def reset_parameter(self):
+        std = 1 / math.sqrt(self.in_features)
+        self.weight.data.uniform_(-std, std)
+        self.bias.data.uniform_(-std, std)
+
+    def reset_noise(self):
+        # f(x) = sgn(x) * sqrt(|x|) of in and out gaussians, the weight noise is their outer product
+        self.epsilon_in.normal_()
+        self.epsilon_out.normal_()
+        self.epsilon_in.copy_(self.epsilon_in.sign() * self.epsilon_in.abs().sqrt())
+        self.epsilon_out.copy_(self.epsilon_out.sign() * self.epsilon_out.abs().sqrt())
+
+    def forward(self, input):
+        if self.resample:
+            self.reset_noise()
+        bias = self.bias
+        if bias is not None:
+            bias = bias + self.sigma_bias * self.epsilon_out
+        return F.linear(input, self.weight + self.sigma_weight * torch.outer(self.epsilon_out, self.epsilon_in), bias)
+
+
 def weight_init(layers):
     for layer in layers:
         torch.nn.init.kaiming_normal_(layer.weight, nonlinearity='relu')
 
 
 class IQN(nn.Module):
-    def __init__(self, state_size, action_size, layer_size, n_step, seed, N, dueling=False, noisy=False, device="cuda:0"):
+    def __init__(self, state_size, action_size, layer_size, n_step, seed, N, dueling=False, noisy=False, device="cuda:0", noise="independent"):
         super(IQN, self).__init__()
         self.seed = torch.manual_seed(seed)
         self.input_shape = state_size
@@ -59,8 +100,9 @@ class IQN(nn.Module):
         self.pis = torch.FloatTensor([np.pi*i for i in range(1,self.n_cos+1)]).view(1,1,self.n_cos).to(device) # Starting from 0 as in the paper 
         self.dueling = dueling
         self.device = device
+        self.embedding_cache = None
         if noisy:
-            layer = NoisyLinear
+            layer = FactorizedNoisyLinear if noise == "factorized" else NoisyLinear
         else:
             layer = nn.Linear
 
@@ -121,7 +163,14 @@ class IQN(nn.Module):
         cos, taus = self.calc_cos(batch_size, num_tau) # cos shape (batch, num_tau, layer_size)
         cos = cos.view(batch_size*num_tau, self.n_cos)
         cos_x = torch.relu(self.cos_embedding(cos)).view(batch_size, num_tau, self.cos_layer_out) # (batch, n_tau, layer)
-        
+        return self.quantiles(x, cos_x), taus
+
+    def quantiles(self, x, cos_x):
+        """
+        Quantile values of the state features x (batch, layer) for the tau embeddings cos_x, which are
+        either per sample (batch, num_tau, layer) or shared by the whole batch (1, num_tau, layer)
+        """
+        batch_size, num_tau = x.shape[0], cos_x.shape[1]
         # x has shape (batch, layer_size) for multiplication –> reshape to (batch, 1, layer)
         x = (x.unsqueeze(1)*cos_x).view(batch_size*num_tau, self.cos_layer_out)
         
@@ -133,8 +182,45 @@ class IQN(nn.Module):
         else:
             out = self.ff_2(x)
         
-        return out.view(batch_size, num_tau, self.action_size), taus
+        return out.view(batch_size, num_tau, self.action_size)
+
+    def fixed_embedding(self, K):
+        """
+        Embedding (1, K, layer) of K evenly spaced taus (i + 0.5)/K. It is cached and recomputed only
+        when the cos_embedding weights have changed since, which their in-place version counters tell.
+        """
+        key = (K, self.cos_embedding.weight._version, self.cos_embedding.bias._version,
+               self.cos_embedding.weight.data_ptr())
+        if self.embedding_cache is None or self.embedding_cache[0] != key:
+            taus = (torch.arange(K, device=self.pis.device, dtype=torch.float32) + 0.5).view(1, K, 1) / K
+            # kept in the weights' precision, autocast casts it where needed
+            with torch.autocast(device_type=self.pis.device.type, enabled=False):
+                cos = torch.cos(taus*self.pis).view(K, self.n_cos).to(self.cos_embedding.weight.dtype)
+                cos_x = torch.relu(self.cos_embedding(cos))
+            self.embedding_cache = (key, cos_x.view(1, K, self.cos_layer_out))
+        return self.embedding_cache[1]
+
+    def get_qvalues_fixed(self, inputs, K=32):
+        """Q values as the mean over K fixed quantiles, the low-latency variant of get_qvalues for acting"""
+        x = torch.relu(self.head(inputs))
+        if self.state_dim == 3: x = x.view(inputs.size(0), -1)
+        return self.quantiles(x, self.fixed_embedding(K)).mean(dim=1)
     
+    def noisy_layers(self):
+        return [m for m in self.modules() if isinstance(m, (NoisyLinear, FactorizedNoisyLinear))]
+
+    def reset_noise(self):
+        """Resamples the noise of all noisy layers."""
+        for layer in self.noisy_layers():
+            layer.reset_noise()
+
+    def resample_noise(self, every_forward=True):
+        """Noise resampled in every forward pass (default) or only on reset_noise()."""
+        for layer in self.noisy_layers():
+            layer.resample = every_forward
+        if not every_forward:
+            self.reset_noise()
+
     def get_qvalues(self, inputs):
         quantiles, _ = self.forward(inputs, self.N)
         actions = quantiles.mean(dim=1)
@@ -0,0 +1,187 @@
+"""
+Local policy server with dynamic batching. Environment processes send observations through a shared
+multiprocessing queue, the server coalesces the pending requests into one batch (up to max_batch
+observations or until max_wait_ms after the first request), runs a single forward of the IQN and sends
+every client its actions back on the client's own queue.
+
+Benchmark against batch-1 forwards with many concurrent clients:
+`python policy_server.py -clients 32 -requests 300 -state_size 4 -action_size 2`
+"""
+import argparse
+import copy
+import json
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import deque
+import numpy as np
+import torch
+
+from model import IQN
+
+
+class PolicyClient(object):
+    """Handle of one environment process, picklable so it can be passed to the process it serves."""
+    def __init__(self, client_id, requests, responses):
+        self.client_id = client_id
+        self.requests = requests
+        self.responses = responses
+
+    def act(self, obs):
+        """Greedy actions for a batch of observations (n, *state_size), blocks until the server answered."""
+        self.requests.put((self.client_id, np.asarray(obs, dtype=np.float32), time.time()))
+        return self.responses.get()
+
+
+class PolicyServer(object):
+    """
+    Serves the greedy actions of an IQN to PolicyClients, one forward per coalesced batch.
+
+    Params
+    ======
+        network (IQN): the policy network, the server serves a copy in eval mode and leaves it unchanged
+        max_batch (int): maximum number of observations per forward
+        max_wait_ms (float): time the server waits for more requests after the first one of a batch
+        K (int): act on K fixed quantiles (IQN.get_qvalues_fixed), 0 = get_qvalues on N sampled taus
+    """
+    def __init__(self, network, device="cpu", max_batch=64, max_wait_ms=2., K=0):
+        self.network = copy.deepcopy(network).to(device).eval()
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.K = K
+        self.requests = mp.Queue()
+        self.responses = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.batch_sizes = {}
+        # only the most recent requests are kept for stats()
+        self.latency = deque(maxlen=10000)
+        self.depth = deque(maxlen=10000)
+
+    def client(self):
+        """Registers a new client, call before the client processes are started."""
+        self.responses.append(mp.Queue())
+        return PolicyClient(len(self.responses) - 1, self.requests, self.responses[-1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def load_state_dict(self, state_dict):
+        """Replaces the policy weights between two batches, e.g. with the learner's latest network."""
+        with self.lock:
+            self.network.load_state_dict(state_dict)
+
+    def _collect(self):
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        size = len(batch[0][1])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[1])
+        return batch
+
+    def _serve(self):
+        while not self.stop_event.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                self.depth.append(self.requests.qsize())
+            except NotImplementedError:
+                pass
+            obs = np.concatenate([request[1] for request in batch])
+            with self.lock, torch.inference_mode():
+                state = torch.from_numpy(obs).to(self.device)
+                if self.K > 0:
+                    action_values = self.network.get_qvalues_fixed(state, self.K)
+                else:
+                    action_values = self.network.get_qvalues(state)
+                actions = action_values.argmax(dim=1).cpu().numpy()
+            start = 0
+            now = time.time()
+            for client_id, client_obs, sent in batch:
+                self.responses[client_id].put(actions[start:start + len(client_obs)])
+                start += len(client_obs)
+                self.latency.append(now - sent)
+            self.batch_sizes[len(obs)] = self.batch_sizes.get(len(obs), 0) + 1
+
+    def stats(self):
+        """Queue depth, batch size histogram {observations: forwards} and request latency percentiles."""
+        latency = np.array(self.latency) * 1000
+        stats = {"forwards": sum(self.batch_sizes.values()),
+                 "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                 "mean_batch_size": sum(k * v for k, v in self.batch_sizes.items()) / max(sum(self.batch_sizes.values()), 1)}
+        if len(self.depth) > 0:
+            stats["queue_depth_mean"] = float(np.mean(self.depth))
+            stats["queue_depth_max"] = int(np.max(self.depth))
+        if len(latency) > 0:
+            stats["latency_p50_ms"] = float(np.percentile(latency, 50))
+            stats["latency_p99_ms"] = float(np.percentile(latency, 99))
+        return stats
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def _random_client(client, state_size, requests):
+    for _ in range(requests):
+        client.act(np.random.rand(1, *state_size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-clients", type=int, default=32, help="Number of concurrent client processes, default = 32")
+    parser.add_argument("-requests", type=int, default=300, help="Requests (single observations) per client, default = 300")
+    parser.add_argument("-state_size", type=int, nargs="+", default=[4], help="Observation shape, default = 4")
+    parser.add_argument("-action_size", type=int, default=2, help="Number of actions, default = 2")
+    parser.add_argument("-layer_size", type=int, default=512, help="Size of the hidden layer, default = 512")
+    parser.add_argument("-max_batch", type=int, default=64, help="Maximum observations per forward, default = 64")
+    parser.add_argument("-max_wait_ms", type=float, default=2., help="Batching deadline after the first request, default = 2")
+    parser.add_argument("-K", type=int, default=0, help="Act on K fixed quantiles, 0 = N sampled taus, default = 0")
+    parser.add_argument("-model", type=str, default=None, help="Optional state dict of a trained network")
+    args = parser.parse_args()
+
+    state_size = tuple(args.state_size)
+    network = IQN(state_size, args.action_size, args.layer_size, 1, 1, 8, device="cpu")
+    if args.model is not None:
+        network.load_state_dict(torch.load(args.model, map_location="cpu"))
+    total = args.clients * args.requests
+
+    # baseline: one batch-1 forward per observation
+    obs = torch.rand(1, *state_size)
+    t0 = time.perf_counter()
+    with torch.inference_mode():
+        for _ in range(min(total, 2000)):
+            network.get_qvalues(obs).argmax(dim=1)
+    baseline = min(total, 2000) / (time.perf_counter() - t0)
+
+    server = PolicyServer(network, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms, K=args.K)
+    processes = [mp.Process(target=_random_client, args=(server.client(), state_size, args.requests), daemon=True)
+                 for _ in range(args.clients)]
+    for p in processes:
+        p.start()
+    t0 = time.perf_counter()
+    server.start()
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter() - t0
+    server.close()
+    print(json.dumps({"batch1_obs_per_sec": baseline, "served_obs_per_sec": total / elapsed,
+                      "server": server.stats()}, indent=2))
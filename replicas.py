@@ -0,0 +1,266 @@
+"""
+Trains several independent IQN replicas (e.g. the seeds of one config) in lockstep in one process.
+
+Every replica has its own seed, random generator, replay memory and environments, but the networks of
+all replicas are stacked (torch.func.stack_module_state) and every learn step runs one vmapped forward and
+backward over all replicas. Small feature-vector networks use the CPU much better this way than one
+run.py process per seed. Adam works elementwise, so one optimizer over the stacked parameters keeps
+independent optimizer states, gradients are clipped per replica.
+
+`python run.py -env SyntheticFeatureVec-v0 -replicas 5 -info sweep` logs replica r to runs/sweep/replica_<r>.
+"""
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.func import stack_module_state, functional_call, vmap
+
+from agent import IQN_Agent, TargetUpdater
+from model import IQN
+from ReplayBuffers import ReplayBuffer, PrioritizedReplay
+
+
+class FunctionalNetwork(object):
+    """Calls module with the given parameters and buffers instead of its own (torch.func.functional_call)."""
+    def __init__(self, module, params, buffers):
+        self.module = module
+        self.params = params
+        self.buffers = buffers
+
+    def __call__(self, *args):
+        return functional_call(self.module, (self.params, self.buffers), args)
+
+
+class ReplicaLearner(IQN_Agent):
+    """
+    The loss computations of IQN_Agent without networks, optimizer and replay memory of its own,
+    qnetwork_local and qnetwork_target are set to the functional networks of one replica.
+    """
+    def __init__(self, action_size, n_step, BATCH_SIZE, GAMMA, N, device, precision):
+        self.action_size = action_size
+        self.n_step = n_step
+        self.BATCH_SIZE = BATCH_SIZE
+        self.GAMMA = GAMMA
+        self.N = N
+        self.device = device
+        self.precision = precision
+        # Munchausen constants of IQN_Agent
+        self.entropy_tau = 0.03
+        self.lo = -1
+        self.alpha = 0.9
+        self.qnetwork_local = None
+        self.qnetwork_target = None
+
+
+class ReplicaPolicy(object):
+    """Epsilon-greedy policy of one replica, e.g. to evaluate or save it, qnetwork_local holds the replica's weights."""
+    def __init__(self, qnetwork_local, action_size, rng, device, autocast):
+        self.qnetwork_local = qnetwork_local
+        self.action_size = action_size
+        self.rng = rng
+        self.device = device
+        self.autocast = autocast
+
+    def act(self, state, eps=0., eval=False):
+        """Actions for the stacked states like IQN_Agent.act, random actions come from the replica's generator."""
+        state = np.asarray(state)
+        if self.rng.random() <= eps:
+            return self.rng.integers(self.action_size, size=len(state))
+        state = torch.from_numpy(state).float().to(self.device)
+        self.qnetwork_local.eval()
+        with torch.no_grad(), self.autocast():
+            action_values = self.qnetwork_local.get_qvalues(state)
+        self.qnetwork_local.train()
+        return np.argmax(action_values.float().cpu().numpy(), axis=1)
+
+
+class ReplicatedIQN_Agent(object):
+    """
+    Lockstep training of `replicas` IQN agents with the seeds seed, seed + 1, ...
+
+    The observations of act() and step() are stacked along the environment dimension, replica r owns the
+    environments [r * worker, (r + 1) * worker). step() takes one writer per replica. Replica r samples its
+    batches and random actions from its own generator np.random.default_rng(seed + r).
+
+    Params
+    ======
+        replicas (int): number of replicas
+        storages (list): replay storage of every replica, see ReplayBuffers.make_storage, default = ArrayStorage
+        the other parameters are the ones of IQN_Agent, shared by all replicas
+    """
+    def __init__(self,
+                 replicas,
+                 state_size,
+                 action_size,
+                 network,
+                 munchausen,
+                 layer_size,
+                 n_step,
+                 BATCH_SIZE,
+                 BUFFER_SIZE,
+                 LR,
+                 TAU,
+                 GAMMA,
+                 N,
+                 worker,
+                 device,
+                 seed,
+                 storages=None,
+                 target_update="soft",
+                 target_update_every=1,
+                 log_every=1,
+                 precision="fp32"):
+        self.replicas = replicas
+        self.action_size = action_size
+        self.device = device
+        self.worker = worker
+        self.UPDATE_EVERY = worker
+        self.log_every = log_every
+        self.BATCH_SIZE = BATCH_SIZE * worker
+        self.per = int("per" in network)
+        assert precision in ("fp32", "bf16", "bf16+target"), "unknown precision: {}".format(precision)
+
+        # the networks of replica r are initialized with seed + r like the IQN_Agent of that seed, fnoisy_* use factorized noise
+        noise = "factorized" if network.startswith("fnoisy") else "independent"
+        def make_network(seed):
+            return IQN(state_size, action_size, layer_size, n_step, seed, N, dueling="duel" in network,
+                       noisy="noisy" in network, device=device, noise=noise).to(device)
+        local_networks = [make_network(seed + r) for r in range(replicas)]
+        target_networks = [make_network(seed + r) for r in range(replicas)]
+        print(local_networks[0])
+
+        self.rngs = [np.random.default_rng(seed + r) for r in range(replicas)]
+        self.memories = []
+        for r in range(replicas):
+            storage = storages[r] if storages is not None else None
+            if self.per:
+                memory = PrioritizedReplay(BUFFER_SIZE, self.BATCH_SIZE, seed=seed + r, gamma=GAMMA, n_step=n_step, parallel_env=worker,
+                                           storage=storage, rng=self.rngs[r])
+            else:
+                memory = ReplayBuffer(BUFFER_SIZE, self.BATCH_SIZE, device, seed + r, GAMMA, n_step, worker, storage=storage, rng=self.rngs[r])
+            self.memories.append(memory)
+
+        # stacked parameters (replicas, *shape) of the local and target networks
+        params, self.buffers = stack_module_state(local_networks)
+        target_params, self.target_buffers = stack_module_state(target_networks)
+        self.names = list(params.keys())
+        self.params = nn.ParameterList([nn.Parameter(p) for p in params.values()])
+        self.target_params = nn.ParameterList([nn.Parameter(p, requires_grad=False) for p in target_params.values()])
+        self.base = local_networks[0]
+        self.policy_network = copy.deepcopy(self.base)
+        self.optimizer = optim.Adam(self.params.parameters(), lr=LR)
+        # the target networks are cast to bfloat16 by the shared TargetUpdater, not per replica
+        self.target_updater = TargetUpdater(self.params, self.target_params, TAU, target_update, target_update_every,
+                                            dtype=torch.bfloat16 if precision == "bf16+target" else None)
+
+        # loss computations of IQN_Agent, evaluated on the functional networks of one replica under vmap
+        self.learner = ReplicaLearner(action_size, n_step, self.BATCH_SIZE, GAMMA, N, device,
+                                      "bf16" if precision == "bf16+target" else precision)
+        loss_fn = {(0, 0): self.learner.quantile_loss, (0, 1): self.learner.quantile_loss,
+                   (1, 0): self.learner.munchausen_loss, (1, 1): self.learner.munchausen_per_loss}[(int(bool(munchausen)), self.per)]
+        self.replica_loss = vmap(self._replica_loss(loss_fn), randomness="different")
+        self.replica_qvalues = vmap(self._replica_qvalues, randomness="different")
+
+        self.Q_updates = 0
+        self.loss_sum = 0.
+        self.t_step = 0
+
+    def _named(self, params):
+        return dict(zip(self.names, params))
+
+    def _replica_loss(self, loss_fn):
+        def replica_loss(params, buffers, target_params, target_buffers, *batch):
+            self.learner.qnetwork_local = FunctionalNetwork(self.base, params, buffers)
+            self.learner.qnetwork_target = FunctionalNetwork(self.base, target_params, target_buffers)
+            return loss_fn(*batch)
+        return replica_loss
+
+    def _replica_qvalues(self, params, buffers, states):
+        quantiles, _ = functional_call(self.base, (params, buffers), (states, self.learner.N))
+        return quantiles.mean(dim=1)
+
+    def replica(self, r):
+        """ReplicaPolicy of replica r with its current stacked weights, valid until the next call of replica()."""
+        with torch.no_grad():
+            state = dict(zip(self.names, (p[r] for p in self.params)))
+            state.update((name, b[r]) for name, b in self.buffers.items())
+            self.policy_network.load_state_dict(state)
+        return ReplicaPolicy(self.policy_network, self.action_size, self.rngs[r], self.device, self.learner.autocast)
+
+    def step(self, state, action, reward, next_state, done, writers):
+        # replica r stores the transitions of its own worker environments
+        for r, memory in enumerate(self.memories):
+            envs = slice(r * self.worker, (r + 1) * self.worker)
+            memory.add_batch(state[envs], np.asarray(action)[envs], reward[envs], next_state[envs], done[envs])
+
+        self.t_step = (self.t_step + len(done) // self.replicas) % self.UPDATE_EVERY
+        if self.t_step == 0:
+            if min(len(memory) for memory in self.memories) > self.BATCH_SIZE:
+                self.update(writers)
+
+    def update(self, writers):
+        """Samples a batch from every replica's memory and makes one learn step of all replicas."""
+        experiences = [memory.sample() for memory in self.memories]
+        loss = self.learn(experiences)
+        self.Q_updates += 1
+        self.loss_sum = self.loss_sum + loss
+        if self.Q_updates % self.log_every == 0:
+            losses = (self.loss_sum / self.log_every).tolist()
+            for writer, replica_loss in zip(writers, losses):
+                writer.add_scalar("IQN/Q_loss", replica_loss, self.Q_updates)
+            self.loss_sum = 0.
+
+    def _batch(self, experiences):
+        if not self.per:
+            return [torch.stack(tensors) for tensors in zip(*experiences)]
+        batch = []
+        for states, actions, rewards, next_states, dones, _, weights in experiences:
+            batch.append((torch.as_tensor(states, device=self.device),
+                          torch.as_tensor(actions, device=self.device).unsqueeze(1),
+                          torch.as_tensor(rewards, device=self.device).unsqueeze(1),
+                          torch.as_tensor(next_states, device=self.device),
+                          torch.as_tensor(dones, device=self.device).unsqueeze(1),
+                          torch.as_tensor(weights, device=self.device).unsqueeze(1)))
+        return [torch.stack(tensors) for tensors in zip(*batch)]
+
+    def learn(self, experiences):
+        """One learn step of every replica on its own batch, returns the losses (replicas,)."""
+        self.optimizer.zero_grad()
+        loss, td_error = self.replica_loss(self._named(self.params), self.buffers,
+                                           self._named(self.target_params), self.target_buffers, *self._batch(experiences))
+        # the replicas are independent, the gradient of the sum is the gradient of every replica's own loss
+        loss.sum().backward()
+        self.clip_grad_norm(1)
+        self.optimizer.step()
+        self.target_updater.step()
+
+        if self.per:
+            td_error = td_error.sum(dim=2).mean(dim=2, keepdim=True).data.cpu().numpy()
+            for memory, experience, errors in zip(self.memories, experiences, td_error):
+                memory.update_priorities(experience[5], abs(errors))
+        return loss.detach()
+
+    @torch.no_grad()
+    def clip_grad_norm(self, max_norm):
+        """clip_grad_norm_ of every replica's gradient on its own."""
+        grads = [p.grad for p in self.params if p.grad is not None]
+        norms = torch.stack([g.flatten(1).pow(2).sum(dim=1) for g in grads]).sum(dim=0).sqrt()
+        coef = (max_norm / (norms + 1e-6)).clamp(max=1.)
+        for g in grads:
+            g.mul_(coef.view(-1, *([1] * (g.dim() - 1))))
+
+    def act(self, state, eps=0.):
+        """Epsilon-greedy actions of all replicas, one batched forward for the replicas' environments."""
+        state = torch.from_numpy(np.asarray(state)).float().to(self.device)
+        state = state.view(self.replicas, -1, *state.shape[1:])
+        with torch.no_grad(), self.learner.autocast():
+            action_values = self.replica_qvalues(self._named(self.params), self.buffers, state)
+        actions = action_values.float().argmax(dim=2).cpu().numpy()
+        for r, rng in enumerate(self.rngs):
+            if rng.random() <= eps:
+                actions[r] = rng.integers(self.action_size, size=actions.shape[1])
+        return actions.reshape(-1)
+
+    def close(self):
+        """Nothing to stop, the replicas learn synchronously without prefetcher threads."""
@@ -2,40 +2,45 @@ import torch
 import numpy as np
 import random
 import time
-import gym
+import os
 import argparse
-import wrapper
 import MultiPro
-import toybox
+import ReplayBuffers
+import synthetic_envs
 from datetime import datetime
 from collections import deque
 from torch.utils.tensorboard import SummaryWriter
 
 from agent import IQN_Agent
+from replicas import ReplicatedIQN_Agent
+from metrics import MetricsWriter, PhaseTimer, ProfilerWindow
+from checkpoint import CheckpointManager, latest_checkpoint
 
-def evaluate(eps, frame, eval_runs=5):
+def evaluate(eps, frame, eval_runs=5, policy=None, log=None):
     """
-    Makes an evaluation run with the current epsilon
+    Makes an evaluation run with the current epsilon, by default of the agent logged to the writer
     """
+    policy = agent if policy is None else policy
+    log = writer if log is None else log
 
     reward_batch = []
     for i in range(eval_runs):
         state = eval_env.reset()
         rewards = 0
         while True:
-            action = agent.act(np.expand_dims(state, axis=0), 0.001, eval=True)
+            action = policy.act(np.expand_dims(state, axis=0), 0.001, eval=True)
             state, reward, done, _ = eval_env.step(action[0].item())
             rewards += reward
             if done:
                 break
         reward_batch.append(rewards)
         
-    writer.add_scalar("IQN/Eval Score", np.mean(reward_batch), frame)
-    writer.flush()
+    log.add_scalar("IQN/Eval Score", np.mean(reward_batch), frame)
 
 
 
-def run(frames=1000, eps_fixed=False, eps_frames=1e6, min_eps=0.01, eval_every=1000, eval_runs=5, worker=1, save_model=True, save_path='model.pth'):
+def run(frames=1000, eps_fixed=False, eps_frames=1e6, min_eps=0.01, eval_every=1000, eval_runs=5, worker=1, save_model=True, save_path='model.pth', replay_path=None,
+        checkpoints=None, resume_state=None, timer=None, log_timing=0, profiler=None):
     """Deep Q-Learning.
     
     Params
@@ -45,6 +50,12 @@ def run(frames=1000, eps_fixed=False, eps_frames=1e6, min_eps=0.01, eval_every=1
         eps_start (float): starting value of epsilon, for epsilon-greedy action selection
         eps_end (float): minimum value of epsilon
         eps_decay (float): multiplicative factor (per episode) for decreasing epsilon
+        replay_path (str): directory of the replay snapshot written at every evaluation, None = no snapshots. With
+                           checkpoints the snapshot is instead written in the background next to every checkpoint
+        checkpoints (CheckpointManager): writes the agent and loop state in the background at every evaluation
+        resume_state (dict): loop state of a checkpoint to continue from
+        timer (PhaseTimer): times the loop phases, logged with frames/s and updates/s every log_timing frames
+        profiler (ProfilerWindow): records a torch.profiler trace of a few learn steps
     """
     scores = []                        # list containing scores from each episode
     scores_window = deque(maxlen=100)  # last 100 scores
@@ -56,13 +67,21 @@ def run(frames=1000, eps_fixed=False, eps_frames=1e6, min_eps=0.01, eval_every=1
     eps_start = 1
     d_eps = eps_start - min_eps
     i_episode = 1
+    start_frame = 0
+    if resume_state is not None:
+        start_frame, eps, i_episode = resume_state["frame"], resume_state["eps"], resume_state["i_episode"]
+        scores_window.extend(resume_state["scores_window"])
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
     state = envs.reset()
     score = 0                  
-    for frame in range(1, frames+1):
-        action = agent.act(state, eps)
-        next_state, reward, done, _ = envs.step(action) #returns np.stack(obs), np.stack(action) ...
-        for s, a, r, ns, d in zip(state, action, reward, next_state, done):
-            agent.step(s, a, r, ns, d, writer)
+    last_time, last_frame, last_updates = time.time(), start_frame, agent.Q_updates
+    for frame in range(start_frame+1, frames+1):
+        with timer.phase("act"):
+            action = agent.act(state, eps)
+        with timer.phase("env_step"):
+            next_state, reward, done, _ = envs.step(action) #returns np.stack(obs), np.stack(action) ...
+        agent.step(state, action, reward, next_state, done, writer)
         state = next_state
         score += np.mean(reward)
         # linear annealing to the min epsilon value (until eps_frames and from there slowly decease epsilon to 0 until the end of training
@@ -74,24 +93,123 @@ def run(frames=1000, eps_fixed=False, eps_frames=1e6, min_eps=0.01, eval_every=1
 
         # evaluation runs
         if frame % eval_every == 0 or frame == 1:
-            evaluate(eps, frame*worker, eval_runs)
-            if save_model and len(save_path) > 0:
-                torch.save(agent.qnetwork_local.state_dict(), save_path)
+            with timer.phase("evaluate"):
+                evaluate(eps, frame*worker, eval_runs)
+            # the async learner is paused so that the saved networks, optimizer and replay belong to one update,
+            # with checkpoints the replay is only copied here and written on the checkpoint thread
+            with timer.phase("save"), agent.learner_paused():
+                if save_model and len(save_path) > 0:
+                    if checkpoints is not None:
+                        checkpoints.write(agent.qnetwork_local.state_dict(), save_path)
+                    else:
+                        torch.save(agent.qnetwork_local.state_dict(), save_path)
+                if checkpoints is not None:
+                    replay, checkpoint_replay_path = None, None
+                    if replay_path is not None:
+                        checkpoint_replay_path = checkpoints.replay_path(frame*worker)
+                        replay = agent.memory.snapshot(checkpoint_replay_path)
+                    checkpoints.save({"agent": agent.state_dict(),
+                                      "loop": {"frame": frame, "eps": eps, "i_episode": i_episode, "scores_window": list(scores_window)},
+                                      "replay_path": checkpoint_replay_path}, frame*worker, replay=replay)
+                elif replay_path is not None:
+                    agent.memory.save(replay_path)
+            with timer.phase("log"):
+                for name, value in agent.memory.stats().items():
+                    writer.add_scalar("Replay/" + name, value, frame*worker)
+                for name, value in agent.act_stats().items():
+                    writer.add_scalar("Act/" + name, value, frame*worker)
         
+        if profiler is not None:
+            profiler.step(frame*worker, agent.Q_updates)
+        if log_timing > 0 and frame % log_timing == 0:
+            now = time.time()
+            with timer.phase("log"):
+                writer.add_scalar("Perf/frames_per_sec", (frame - last_frame)*worker / (now - last_time), frame*worker)
+                writer.add_scalar("Perf/updates_per_sec", (agent.Q_updates - last_updates) / (now - last_time), frame*worker)
+                timer.log(writer, frame*worker)
+            last_time, last_frame, last_updates = now, frame, agent.Q_updates
+
         if done.any():
             scores_window.append(score)       # save most recent score
             scores.append(score)              # save most recent score
-            writer.add_scalar("IQN/Avg 100 score", np.mean(scores_window), frame*worker)
-            writer.add_scalar("IQN/Episode Cnt", i_episode*worker, frame*worker)
-            writer.flush()
+            with timer.phase("log"):
+                writer.add_scalar("IQN/Avg 100 score", np.mean(scores_window), frame*worker)
+                writer.add_scalar("IQN/Episode Cnt", i_episode*worker, frame*worker)
             print('\rEpisode {}\tFrame {} \tAverage 100 Score: {:.2f}'.format(i_episode*worker, frame*worker, np.mean(scores_window)), end="")
             if i_episode % 100 == 0:
                 print('\rEpisode {}\tFrame {}\tAverage 100 Score: {:.2f}'.format(i_episode*worker, frame*worker, np.mean(scores_window)))
             i_episode +=1 
+            if agent.noise_reset == "episode":
+                agent.reset_noise()
             state = envs.reset()
             score = 0              
 
 
+def run_replicas(frames=1000, eps_fixed=False, eps_frames=1e6, min_eps=0.01, eval_every=1000, eval_runs=5, worker=1, save_model=True, save_paths=None,
+                 timer=None, log_timing=0, profiler=None):
+    """
+    Training loop of a ReplicatedIQN_Agent, envs holds the worker environments of every replica and replica r
+    logs its scores and evaluations to writers[r] and saves its network to save_paths[r]. The timings and the
+    profiler cover the lockstep loop of all replicas, the Perf/ and Time/ scalars go to the run's writer.
+    """
+    replicas = len(writers)
+    scores_windows = [deque(maxlen=100) for _ in range(replicas)]
+    if eps_fixed:
+        eps = 0
+    else:
+        eps = 1
+    eps_start = 1
+    d_eps = eps_start - min_eps
+    i_episode = 1
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    state = envs.reset()
+    score = np.zeros(replicas)
+    last_time, last_frame, last_updates = time.time(), 0, agent.Q_updates
+    for frame in range(1, frames+1):
+        with timer.phase("act"):
+            action = agent.act(state, eps)
+        with timer.phase("env_step"):
+            next_state, reward, done, _ = envs.step(action)
+        agent.step(state, action, reward, next_state, done, writers)
+        state = next_state
+        score += reward.reshape(replicas, worker).mean(axis=1)
+        if eps_fixed == False:
+            eps = max(eps_start - ((frame*d_eps)/eps_frames), min_eps)
+
+        # evaluation runs of every replica
+        if frame % eval_every == 0 or frame == 1:
+            for r in range(replicas):
+                replica = agent.replica(r)
+                with timer.phase("evaluate"):
+                    evaluate(eps, frame*worker, eval_runs, replica, writers[r])
+                if save_model:
+                    with timer.phase("save"):
+                        torch.save(replica.qnetwork_local.state_dict(), save_paths[r])
+
+        if profiler is not None:
+            profiler.step(frame*worker, agent.Q_updates)
+        if log_timing > 0 and frame % log_timing == 0:
+            now = time.time()
+            with timer.phase("log"):
+                writer.add_scalar("Perf/frames_per_sec", (frame - last_frame)*worker*replicas / (now - last_time), frame*worker)
+                writer.add_scalar("Perf/updates_per_sec", (agent.Q_updates - last_updates) / (now - last_time), frame*worker)
+                timer.log(writer, frame*worker)
+            last_time, last_frame, last_updates = now, frame, agent.Q_updates
+
+        if done.any():
+            for r in range(replicas):
+                scores_windows[r].append(score[r])
+                with timer.phase("log"):
+                    writers[r].add_scalar("IQN/Avg 100 score", np.mean(scores_windows[r]), frame*worker)
+                    writers[r].add_scalar("IQN/Episode Cnt", i_episode*worker, frame*worker)
+            print('\rEpisode {}\tFrame {} \tAverage 100 Score of the replicas: {}'.format(
+                i_episode*worker, frame*worker, " ".join("{:.2f}".format(np.mean(w)) for w in scores_windows)), end="")
+            i_episode +=1 
+            state = envs.reset()
+            score = np.zeros(replicas)
+
+
 
 
 if __name__ == "__main__":
@@ -104,34 +222,69 @@ if __name__ == "__main__":
                                                      "dueling",
                                                      "dueling+per", 
                                                      "noisy_dueling",
-                                                     "noisy_dueling+per"
+                                                     "noisy_dueling+per",
+                                                     "fnoisy_iqn",
+                                                     "fnoisy_iqn+per",
+                                                     "fnoisy_dueling",
+                                                     "fnoisy_dueling+per"
                                                      ], default="iqn", help="Specify which type of IQN agent you want to train, default is IQN - baseline!")
     
-    parser.add_argument("-env", type=str, default="SpaceInvadersToyboxNoFrameskip-v4", help="Name of the Environment, default = SpaceInvadersToyboxNoFrameskip-v4")
+    parser.add_argument("-env", type=str, default="SpaceInvadersToyboxNoFrameskip-v4", help="Name of the Environment, SyntheticFeatureVec-v0 and SyntheticPixel-v0 need neither gym nor toybox, default = SpaceInvadersToyboxNoFrameskip-v4")
+    parser.add_argument("-env_step_cost", type=float, default=0., help="Busy-wait milliseconds per step of the synthetic environments (SyntheticFeatureVec-v0, SyntheticPixel-v0), default = 0")
     parser.add_argument("-frames", type=int, default=10000000, help="Number of frames to train, default = 10 mio")
     parser.add_argument("-eval_every", type=int, default=250000, help="Evaluate every x frames, default = 250000")
     parser.add_argument("-eval_runs", type=int, default=2, help="Number of evaluation runs, default = 2")
     parser.add_argument("-seed", type=int, default=1, help="Random seed to replicate training runs, default = 1")
     parser.add_argument("-N", type=int, default=8, help="Number of Quantiles, default = 8")
+    parser.add_argument("-K", type=int, default=0, help="Act on K fixed quantiles with cached tau embeddings (low-latency act path), 0 = sample N taus per action, default = 0")
     parser.add_argument("-munchausen", type=int, default=0, choices=[0,1], help="Use Munchausen RL loss for training if set to 1 (True), default = 0")
     parser.add_argument("-bs", "--batch_size", type=int, default=32, help="Batch size for updating the DQN, default = 32")
     parser.add_argument("-layer_size", type=int, default=512, help="Size of the hidden layer, default=512")
     parser.add_argument("-n_step", type=int, default=1, help="Multistep IQN, default = 1")
     parser.add_argument("-m", "--memory_size", type=int, default=int(1e5), help="Replay memory size, default = 1e5")
+    parser.add_argument("-replay", type=str, default="array", choices=["array", "frames", "memmap", "compressed"], help="Replay storage backend, 'frames' (pixel environments only) stores each pixel frame once as uint8 and restacks on sampling, 'memmap' keeps the buffer in files in the run directory, 'compressed' zlib compresses the observations, default = array")
+    parser.add_argument("-memmap_layout", type=str, default="columnar", choices=["columnar", "record"], help="File layout of the memmap replay, one file per field or one file of adjacent per-transition records, default = columnar")
+    parser.add_argument("-memmap_align", type=int, default=0, help="Pad memmap records to a multiple of this many bytes, e.g. 4096 for page aligned records, default = 0 (packed)")
+    parser.add_argument("-memmap_block", type=int, default=1, help="Sample the memmap replay in runs of this many consecutive transitions to keep disk reads sequential, default = 1")
+    parser.add_argument("-compress_level", type=int, default=1, help="zlib level of the compressed replay, default = 1")
+    parser.add_argument("-compress_threads", type=int, default=4, help="Threads decompressing a sampled batch of the compressed replay, default = 4")
+    parser.add_argument("-save_replay", type=int, choices=[0,1], default=0, help="Snapshot the replay memory at every evaluation, next to every checkpoint (written in the background) or into the run directory with -keep_checkpoints 0, default = 0")
+    parser.add_argument("-load_replay", type=str, default=None, help="Path of a replay snapshot to restore before training")
+    parser.add_argument("-prefetch", type=int, default=0, help="Number of replay batches assembled ahead on a background thread, 0 = sample synchronously, default = 0")
+    parser.add_argument("-compile", type=int, choices=[0,1], default=0, help="Run the learn step loss through torch.compile, falls back to eager if compiling fails, default = 0")
+    parser.add_argument("-precision", type=str, default="fp32", choices=["fp32", "bf16", "bf16+target"], help="Training precision, bf16 runs the forward passes under bfloat16 autocast with float32 weights and loss, bf16+target also keeps the target network in bfloat16, default = fp32")
+    parser.add_argument("-noise_reset", type=str, default="forward", choices=["forward", "step", "episode"], help="When noisy agents resample their noise: in every forward pass, once per learn step, or once per learn step for learning and once per episode for acting, default = forward")
+    parser.add_argument("-async_learner", type=int, choices=[0,1], default=0, help="Learn on a background thread while the environments keep stepping, default = 0")
+    parser.add_argument("-actor_sync", type=int, default=100, help="Learn steps between refreshes of the acting network with -async_learner 1, default = 100")
+    parser.add_argument("-replay_ratio", type=float, default=1., help="Learn steps per environment step with -async_learner 1, default = 1")
+    parser.add_argument("-log_every", type=int, default=10, help="Learn steps between logging the mean Q loss, the loss is only read back from the device that often, default = 10")
+    parser.add_argument("-metrics_window", type=int, default=10, help="Number of logged Q losses aggregated into one mean/min/max point, default = 10")
+    parser.add_argument("-flush_secs", type=float, default=10., help="Seconds between flushes of the tensorboard log by the background metrics writer, default = 10")
+    parser.add_argument("-log_timing", type=int, default=10000, help="Frames between logging frames/s, updates/s and the time spent per phase (Perf/, Time/), 0 = no phase timers, default = 10000")
+    parser.add_argument("-profile_frame", type=int, default=-1, help="Frame at which a torch.profiler trace of -profile_updates learn steps is recorded into the run directory, -1 = off, default = -1")
+    parser.add_argument("-profile_updates", type=int, default=10, help="Number of learn steps in the profiler trace, default = 10")
     parser.add_argument("-lr", type=float, default=0.00025, help="Learning rate, default = 2.5e-4")
     parser.add_argument("-g", "--gamma", type=float, default=0.99, help="Discount factor gamma, default = 0.99")
     parser.add_argument("-t", "--tau", type=float, default=1e-3, help="Soft update parameter tau, default = 1e-3")
+    parser.add_argument("-target_update", type=str, default="soft", choices=["soft", "periodic", "hard"], help="Target network update: Polyak every update (soft), Polyak every -target_every updates with equivalent tau (periodic) or a hard copy every -target_every updates (hard), default = soft")
+    parser.add_argument("-target_every", type=int, default=1, help="Learn steps between periodic or hard target updates, default = 1")
     parser.add_argument("-eps_frames", type=int, default=1000000, help="Linear annealed frames for Epsilon, default = 1mio")
     parser.add_argument("-min_eps", type=float, default=0.01, help="Final epsilon greedy value, default = 0.01")
+    parser.add_argument("-keep_checkpoints", type=int, default=3, help="Number of full training checkpoints kept in the run directory, written in the background at every evaluation, 0 = no checkpoints, default = 3")
+    parser.add_argument("-resume", type=str, default=None, help="Continue training from a checkpoint file or the latest checkpoint of a run directory, restores the replay snapshot of the checkpoint's step too if the run saved one")
     parser.add_argument("-save_model", type=int, choices=[0,1], default=1, help="Specify if the trained network shall be saved or not, default is 1 - save model!")
+    parser.add_argument("-replicas", type=int, default=1, help="Number of independent replicas with the seeds seed, seed+1, ... trained in lockstep in one process with batched networks, each with -worker environments and its own replay memory, logged to <run>/replica_<r>, default = 1")
     parser.add_argument("-w", "--worker", type=int, default=1, help="Number of parallel Environments. Batch size increases proportional to number of worker. not recommended to have more than 4 worker, default = 1")
     parser.add_argument("-path_base", type=str, default="/users/mli115/scratch/iqn-runs/", help="Base name of log path")
     # Non-default parameters
     parser.add_argument("-info", type=str, help="Name of the training run")
 
     args = parser.parse_args()
+    if args.replicas > 1 and (args.async_learner or args.prefetch > 0 or args.compile or args.K > 0 or args.noise_reset != "forward"
+                              or args.resume is not None or args.load_replay is not None or args.save_replay):
+        parser.error("-replicas does not support -async_learner, -prefetch, -compile, -K, -noise_reset, -resume, -load_replay and -save_replay")
     args.info += datetime.now().strftime("-%Y%m%d-%H%M%S")
-    writer = SummaryWriter(args.path_base + args.info)       
+    writer = MetricsWriter(SummaryWriter(args.path_base + args.info), windows={"IQN/Q_loss": args.metrics_window}, flush_secs=args.flush_secs)
     seed = args.seed
     BUFFER_SIZE = args.memory_size
     BATCH_SIZE = args.batch_size
@@ -146,16 +299,26 @@ if __name__ == "__main__":
     np.random.seed(seed)
     random.seed(seed)
     torch.manual_seed(seed)
-    if "-ram" in args.env or args.env == "CartPole-v0" or args.env == "LunarLander-v2": 
-        envs = MultiPro.SubprocVecEnv([lambda: gym.make(args.env) for i in range(args.worker)])
+    # gym, toybox and the Atari wrappers are only imported for the environments that need them
+    if args.env in synthetic_envs.ENVS:
+        envs = MultiPro.SubprocVecEnv([lambda: synthetic_envs.make(args.env, args.env_step_cost) for i in range(args.worker*args.replicas)])
+        eval_env = synthetic_envs.make(args.env, args.env_step_cost)
+    elif "-ram" in args.env or args.env == "CartPole-v0" or args.env == "LunarLander-v2": 
+        import gym
+        envs = MultiPro.SubprocVecEnv([lambda: gym.make(args.env) for i in range(args.worker*args.replicas)])
         eval_env = gym.make(args.env)
     elif args.env == "SpaceInvadersToyboxNoFrameskip-v4":
+        import gym
+        import toybox
         from space_invader_wrappers.space_invaders_feature_vec_wrapper import SpaceInvadersFeatureVecWrapper
-        envs = MultiPro.SubprocVecEnv([lambda: SpaceInvadersFeatureVecWrapper(gym.make(args.env)) for _ in range(args.worker)])
+        envs = MultiPro.SubprocVecEnv([lambda: SpaceInvadersFeatureVecWrapper(gym.make(args.env)) for _ in range(args.worker*args.replicas)])
         eval_env = gym.make(args.env)
         eval_env = SpaceInvadersFeatureVecWrapper(eval_env)
     else:
-        envs = MultiPro.SubprocVecEnv([lambda: wrapper.make_env(args.env) for i in range(args.worker)])
+        import wrapper
+        if "Toybox" in args.env:
+            import toybox
+        envs = MultiPro.SubprocVecEnv([lambda: wrapper.make_env(args.env) for i in range(args.worker*args.replicas)])
         eval_env = wrapper.make_env(args.env)
     envs.seed(seed)
     eval_env.seed(seed+1)
@@ -163,35 +326,137 @@ if __name__ == "__main__":
 
     action_size = eval_env.action_space.n
     state_size = eval_env.observation_space.shape
+    if args.replay == "frames" and len(state_size) != 3:
+        parser.error("-replay frames needs stacked pixel observations, {} has observations of shape {}".format(args.env, state_size))
 
-    agent = IQN_Agent(state_size=state_size,    
-                        action_size=action_size,
-                        network=args.agent,
-                        munchausen=args.munchausen,
-                        layer_size=args.layer_size,
-                        n_step=n_step,
-                        BATCH_SIZE=BATCH_SIZE, 
-                        BUFFER_SIZE=BUFFER_SIZE, 
-                        LR=LR, 
-                        TAU=TAU, 
-                        GAMMA=GAMMA,  
-                        N=args.N,
-                        worker=args.worker,
-                        device=device, 
-                        seed=seed)
+    def replay_storage(run_dir):
+        storage = ReplayBuffers.make_storage(args.replay, BUFFER_SIZE, args.worker,
+                                             directory=run_dir + "/replay",
+                                             layout=args.memmap_layout,
+                                             align=args.memmap_align,
+                                             block_size=args.memmap_block,
+                                             compress_level=args.compress_level,
+                                             compress_threads=args.compress_threads,
+                                             obs_scale=255. if len(state_size) == 3 else None)
+        if (args.save_replay or args.load_replay is not None) and isinstance(storage, ReplayBuffers.SharedMemoryStorage):
+            parser.error("-save_replay and -load_replay are not supported for shared memory replay storage")
+        return storage
+
+    timer = PhaseTimer(enabled=args.log_timing > 0)
+    if args.replicas > 1:
+        replica_dirs = [args.path_base + args.info + "/replica_{}".format(r) for r in range(args.replicas)]
+        writers = [MetricsWriter(SummaryWriter(replica_dir), windows={"IQN/Q_loss": args.metrics_window}, flush_secs=args.flush_secs)
+                   for replica_dir in replica_dirs]
+        agent = ReplicatedIQN_Agent(replicas=args.replicas,
+                                    state_size=state_size,
+                                    action_size=action_size,
+                                    network=args.agent,
+                                    munchausen=args.munchausen,
+                                    layer_size=args.layer_size,
+                                    n_step=n_step,
+                                    BATCH_SIZE=BATCH_SIZE,
+                                    BUFFER_SIZE=BUFFER_SIZE,
+                                    LR=LR,
+                                    TAU=TAU,
+                                    GAMMA=GAMMA,
+                                    N=args.N,
+                                    worker=args.worker,
+                                    device=device,
+                                    seed=seed,
+                                    storages=[replay_storage(replica_dir) for replica_dir in replica_dirs],
+                                    target_update=args.target_update,
+                                    target_update_every=args.target_every,
+                                    log_every=args.log_every,
+                                    precision=args.precision)
+    else:
+        agent = IQN_Agent(state_size=state_size,    
+                          action_size=action_size,
+                          network=args.agent,
+                          munchausen=args.munchausen,
+                          layer_size=args.layer_size,
+                          n_step=n_step,
+                          BATCH_SIZE=BATCH_SIZE, 
+                          BUFFER_SIZE=BUFFER_SIZE, 
+                          LR=LR, 
+                          TAU=TAU, 
+                          GAMMA=GAMMA,  
+                          N=args.N,
+                          worker=args.worker,
+                          device=device, 
+                          seed=seed,
+                          storage=replay_storage(args.path_base + args.info),
+                          prefetch=args.prefetch,
+                          compile_learn=bool(args.compile),
+                          target_update=args.target_update,
+                          target_update_every=args.target_every,
+                          log_every=args.log_every,
+                          precision=args.precision,
+                          async_learner=bool(args.async_learner),
+                          actor_sync_every=args.actor_sync,
+                          replay_ratio=args.replay_ratio,
+                          K=args.K,
+                          timer=timer,
+                          noise_reset=args.noise_reset)
 
 
 
+    checkpoints = None
+    if args.keep_checkpoints > 0 and args.replicas == 1:
+        checkpoints = CheckpointManager(args.path_base + args.info + "/checkpoints", keep=args.keep_checkpoints)
+    resume_state = None
+    if args.resume is not None:
+        resume_path = args.resume
+        if os.path.isdir(resume_path):
+            directory = os.path.join(resume_path, "checkpoints")
+            resume_path = latest_checkpoint(directory)
+            if resume_path is None:
+                raise FileNotFoundError("no checkpoint found in {}".format(directory))
+        checkpoint = torch.load(resume_path, map_location="cpu", weights_only=False)
+        agent.load_state_dict(checkpoint["agent"])
+        resume_state = checkpoint["loop"]
+        if args.load_replay is None and checkpoint["replay_path"] is not None:
+            # the snapshot of the checkpoint's own step, written before the checkpoint itself
+            if not os.path.isdir(checkpoint["replay_path"]):
+                raise FileNotFoundError("replay snapshot {} of checkpoint {} is missing".format(checkpoint["replay_path"], resume_path))
+            args.load_replay = checkpoint["replay_path"]
+        print("Resuming from {} at frame {}".format(resume_path, resume_state["frame"]*args.worker))
+
+    if args.load_replay is not None:
+        agent.memory.load(args.load_replay)
+        print("Restored {} transitions from {}".format(len(agent.memory), args.load_replay))
+
     # set epsilon frames to 0 so no epsilon exploration
     if "noisy" in args.agent:
         eps_fixed = True
     else:
         eps_fixed = False
 
+    profiler = ProfilerWindow(args.path_base + args.info + "/profile", args.profile_frame, args.profile_updates) if args.profile_frame >= 0 else None
     t0 = time.time()
-    run(frames = args.frames//args.worker, eps_fixed=eps_fixed, eps_frames=args.eps_frames//args.worker, min_eps=args.min_eps, eval_every=args.eval_every//args.worker, eval_runs=args.eval_runs, worker=args.worker, save_model=args.save_model, save_path=args.path_base + args.info + "/model.pth")
+    if args.replicas > 1:
+        run_replicas(frames = args.frames//args.worker, eps_fixed=eps_fixed, eps_frames=args.eps_frames//args.worker, min_eps=args.min_eps, eval_every=args.eval_every//args.worker, eval_runs=args.eval_runs, worker=args.worker, save_model=args.save_model,
+                     save_paths=[replica_dir + "/model.pth" for replica_dir in replica_dirs], timer=timer, log_timing=args.log_timing//args.worker,
+                     profiler=profiler)
+    else:
+        run(frames = args.frames//args.worker, eps_fixed=eps_fixed, eps_frames=args.eps_frames//args.worker, min_eps=args.min_eps, eval_every=args.eval_every//args.worker, eval_runs=args.eval_runs, worker=args.worker, save_model=args.save_model, save_path=args.path_base + args.info + "/model.pth",
+            replay_path=args.path_base + args.info + "/replay_snapshot" if args.save_replay else None,
+            checkpoints=checkpoints, resume_state=resume_state, timer=timer, log_timing=args.log_timing//args.worker,
+            profiler=profiler)
+    agent.close()
+    if profiler is not None:
+        profiler.close()
+    if checkpoints is not None:
+        checkpoints.close()
     t1 = time.time()
+    writer.close()
+    if args.replicas > 1:
+        for replica_writer in writers:
+            replica_writer.close()
     
     print("Training time: {}min".format(round((t1-t0)/60,2)))
     if args.save_model:
-        torch.save(agent.qnetwork_local.state_dict(), args.path_base + args.info + "/final.pth")
+        if args.replicas > 1:
+            for r, replica_dir in enumerate(replica_dirs):
+                torch.save(agent.replica(r).qnetwork_local.state_dict(), replica_dir + "/final.pth")
+        else:
+            torch.save(agent.qnetwork_local.state_dict(), args.path_base + args.info + "/final.pth")
@@ -0,0 +1,125 @@
+"""
+Synthetic environments without gym, ROM or toybox dependencies for end-to-end throughput tests of run.py
+and MultiPro.SubprocVecEnv. They implement the reset/step/seed/observation_space/action_space interface
+MultiPro.worker uses and mimic the observations of the real environments:
+
+    SyntheticFeatureVec-v0: 12-dim float32 feature vectors like SpaceInvadersFeatureVecWrapper, 6 actions
+    SyntheticPixel-v0:      4x84x84 float32 frame stacks in [0, 1] like wrapper.make_env, 6 actions
+
+The reward is 1 when the action matches the argmax of a fixed random projection of the observation, so
+agents have something to learn. step_cost_ms busy-waits in every step to emulate the CPU cost of an emulator.
+"""
+import time
+import numpy as np
+
+
+class Box(object):
+    """Minimal stand-in for gym.spaces.Box."""
+    def __init__(self, low, high, shape, dtype=np.float32):
+        self.low = np.full(shape, low, dtype=dtype)
+        self.high = np.full(shape, high, dtype=dtype)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.RandomState()
+
+    def seed(self, seed=None):
+        self.rng.seed(seed)
+
+    def sample(self):
+        return self.rng.uniform(self.low, self.high).astype(self.dtype)
+
+
+class Discrete(object):
+    """Minimal stand-in for gym.spaces.Discrete."""
+    def __init__(self, n):
+        self.n = n
+        self.shape = ()
+        self.dtype = np.dtype(np.int64)
+        self.rng = np.random.RandomState()
+
+    def seed(self, seed=None):
+        self.rng.seed(seed)
+
+    def sample(self):
+        return int(self.rng.randint(self.n))
+
+
+class SyntheticEnv(object):
+    """Base class, subclasses set observation_space and implement _observe(step)."""
+    def __init__(self, action_size=6, episode_length=1000, step_cost_ms=0.):
+        self.action_space = Discrete(action_size)
+        self.episode_length = episode_length
+        self.step_cost = step_cost_ms / 1000.
+        self.rng = np.random.RandomState()
+        self.t = 0
+        self.obs = None
+
+    def seed(self, seed=None):
+        self.rng.seed(seed)
+        self.action_space.seed(seed)
+        return [seed]
+
+    def _burn(self):
+        # busy wait, the time is spent on the core like an emulator step would
+        end = time.perf_counter() + self.step_cost
+        while time.perf_counter() < end:
+            pass
+
+    def _target(self, obs):
+        features = obs.reshape(-1)[:self.projection.shape[0]]
+        return int(np.argmax(features @ self.projection))
+
+    def reset(self):
+        self.t = 0
+        self.obs = self._observe(reset=True)
+        return self.obs
+
+    def step(self, action):
+        if self.step_cost > 0:
+            self._burn()
+        reward = 1. if int(action) == self._target(self.obs) else 0.
+        self.t += 1
+        self.obs = self._observe(reset=False)
+        return self.obs, reward, self.t >= self.episode_length, {}
+
+    def close(self):
+        pass
+
+
+class FeatureVecEnv(SyntheticEnv):
+    def __init__(self, action_size=6, episode_length=1000, step_cost_ms=0., size=12):
+        super(FeatureVecEnv, self).__init__(action_size, episode_length, step_cost_ms)
+        self.observation_space = Box(low=-float("inf"), high=float("inf"), shape=(size,))
+        self.projection = np.random.RandomState(0).randn(size, action_size).astype(np.float32)
+
+    def _observe(self, reset):
+        return self.rng.randn(*self.observation_space.shape).astype(np.float32)
+
+
+class PixelEnv(SyntheticEnv):
+    def __init__(self, action_size=6, episode_length=1000, step_cost_ms=0., stack=4, size=84):
+        super(PixelEnv, self).__init__(action_size, episode_length, step_cost_ms)
+        self.observation_space = Box(low=0.0, high=1.0, shape=(stack, size, size))
+        # the target only looks at the first 64 pixels of the newest frame
+        self.projection = np.random.RandomState(0).randn(64, action_size).astype(np.float32)
+
+    def _target(self, obs):
+        return int(np.argmax(obs[-1].reshape(-1)[:64] @ self.projection))
+
+    def _observe(self, reset):
+        frame = self.rng.randint(0, 256, size=(1,) + self.observation_space.shape[1:]).astype(np.float32) / 255.0
+        if reset:
+            # like wrapper.BufferWrapper the stack starts with zeros
+            return np.concatenate([np.zeros((self.observation_space.shape[0] - 1,) + frame.shape[1:], dtype=np.float32), frame])
+        return np.concatenate([self.obs[1:], frame])
+
+
+ENVS = {"SyntheticFeatureVec-v0": FeatureVecEnv,
+        "SyntheticPixel-v0": PixelEnv}
+
+
+def make(env_name, step_cost_ms=0., episode_length=1000):
+    """Creates the synthetic environment env_name (one of ENVS)."""
+    if env_name not in ENVS:
+        raise ValueError("Unknown synthetic environment: {}".format(env_name))
+    return ENVS[env_name](episode_length=episode_length, step_cost_ms=step_cost_ms)
@@ -0,0 +1,30 @@
+import unittest
+
+import numpy as np
+
+from ReplayBuffers import ReplayBuffer
+from test_replay_buffers import feature_stream, gather_all
+
+
+class TestNStep(unittest.TestCase):
+    def test_add_batch_matches_scalar_reference(self):
+        rng = np.random.RandomState(0)
+        gamma, n_step, workers = 0.9, 3, 2
+        buffer = ReplayBuffer(100, 8, "cpu", 0, gamma, n_step, workers)
+        steps = list(feature_stream(rng, workers, 20))
+        for step in steps:
+            buffer.add_batch(*step)
+        states, actions, rewards, next_states, dones = gather_all(buffer)
+        for t in range(len(steps) - n_step + 1):
+            for w in range(workers):
+                i = t * workers + w
+                expected = sum(gamma ** k * steps[t + k][2][w] for k in range(n_step))
+                self.assertAlmostEqual(rewards[i], expected, places=5)
+                np.testing.assert_array_equal(states[i], steps[t][0][w])
+                self.assertEqual(actions[i], steps[t][1][w])
+                np.testing.assert_array_equal(next_states[i], steps[t + n_step - 1][3][w])
+                self.assertEqual(dones[i], steps[t + n_step - 1][4][w])
+
+
+if __name__ == "__main__":
+    unittest.main()
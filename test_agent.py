@@ -0,0 +1,203 @@
+import contextlib
+import copy
+import io
+import unittest
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from agent import CompiledFunction, IQN_Agent, TargetUpdater
+
+
+def double(x):
+    return x * 2
+
+
+class TestCompiledFunction(unittest.TestCase):
+    def test_falls_back_to_eager_when_compiling_fails(self):
+        def broken_backend(graph, example_inputs):
+            raise RuntimeError("no compiler")
+
+        fn = CompiledFunction(double)
+        fn.compiled = torch.compile(double, backend=broken_backend)
+        self.assertTrue(torch.equal(fn(torch.ones(3)), torch.full((3,), 2.)))
+        self.assertIsNone(fn.compiled)
+
+    def test_errors_of_the_function_are_raised(self):
+        def out_of_memory(x):
+            raise RuntimeError("CUDA out of memory")
+
+        fn = CompiledFunction(double)
+        fn.compiled = out_of_memory
+        with self.assertRaises(RuntimeError):
+            fn(torch.ones(3))
+        self.assertIsNotNone(fn.compiled)
+
+    def test_compiled_result(self):
+        fn = CompiledFunction(double)
+        fn.compiled = torch.compile(double, backend="eager")
+        self.assertTrue(torch.equal(fn(torch.ones(3)), torch.full((3,), 2.)))
+        self.assertFalse(fn.first_call)
+
+
+
+def networks(seed=0):
+    torch.manual_seed(seed)
+    return nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Linear(8, 2)), nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Linear(8, 2))
+
+
+class TestTargetUpdater(unittest.TestCase):
+    def test_soft_update_is_a_lerp(self):
+        local, target = networks()
+        expected = [t.detach() + 0.1 * (l.detach() - t.detach()) for l, t in zip(local.parameters(), target.parameters())]
+        TargetUpdater(local, target, 0.1).step()
+        for p, e in zip(target.parameters(), expected):
+            torch.testing.assert_close(p, e)
+
+    def test_periodic_update_equals_soft_updates(self):
+        local, target = networks()
+        soft_target = copy.deepcopy(target)
+        periodic = TargetUpdater(local, target, 0.01, mode="periodic", every=5)
+        soft = TargetUpdater(local, soft_target, 0.01)
+        for step in range(1, 11):
+            periodic.step()
+            soft.step()
+            if step % 5 == 0:
+                for p, s in zip(target.parameters(), soft_target.parameters()):
+                    torch.testing.assert_close(p, s)
+            else:
+                self.assertFalse(torch.equal(next(target.parameters()), next(soft_target.parameters())))
+
+    def test_hard_update_copies(self):
+        local, target = networks()
+        updater = TargetUpdater(local, target, 0.01, mode="hard", every=3)
+        updater.step()
+        updater.step()
+        self.assertFalse(torch.equal(next(target.parameters()), next(local.parameters())))
+        updater.step()
+        for p, l in zip(target.parameters(), local.parameters()):
+            self.assertTrue(torch.equal(p, l))
+
+
+    def test_bfloat16_target_tracks_float32_shadow(self):
+        local, target = networks()
+        reference = copy.deepcopy(target)
+        start = [p.detach().to(torch.bfloat16) for p in target.parameters()]
+        updater = TargetUpdater(local, target, 1e-3, dtype=torch.bfloat16)
+        for _ in range(200):
+            updater.step()
+            with torch.no_grad():
+                for r, l in zip(reference.parameters(), local.parameters()):
+                    r.lerp_(l, 1e-3)
+        for p, shadow, r, s in zip(target.parameters(), updater.shadow, reference.parameters(), start):
+            self.assertEqual(p.dtype, torch.bfloat16)
+            torch.testing.assert_close(shadow, r.detach())
+            self.assertTrue(torch.equal(p, shadow.to(torch.bfloat16)))
+        # single 1e-3 steps would mostly be rounded away in bfloat16, 200 of them accumulated in the shadow are not
+        self.assertFalse(all(torch.equal(p, s) for p, s in zip(target.parameters(), start)))
+
+
+
+def make_agent(network="iqn", munchausen=0, state_size=(6,), batch_size=16, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return IQN_Agent(state_size, 3, network, munchausen, 32, 1, batch_size, 100, 1e-3, 1e-3, 0.99, 8, 1, "cpu", 0, **kwargs)
+
+
+def random_batch(batch_size=16, state_size=6, per=False):
+    batch = [torch.rand(batch_size, state_size), torch.randint(3, (batch_size, 1)), torch.rand(batch_size, 1),
+             torch.rand(batch_size, state_size), (torch.rand(batch_size, 1) < 0.1).float()]
+    return batch + [torch.rand(batch_size, 1)] if per else batch
+
+
+class SeparateForwards(object):
+    """Runs the network on the two halves of a batch one after another, the target forwards before the fusion."""
+    def __init__(self, network, batch_size):
+        self.network = network
+        self.batch_size = batch_size
+        self.calls = []
+
+    def __call__(self, inputs, N):
+        self.calls.append(len(inputs))
+        first, first_taus = self.network(inputs[:self.batch_size], N)
+        second, second_taus = self.network(inputs[self.batch_size:], N)
+        return torch.cat([first, second]), torch.cat([first_taus, second_taus])
+
+
+class TestMunchausenTargetForward(unittest.TestCase):
+    def test_fused_forward_matches_separate_forwards(self):
+        for per in (False, True):
+            with self.subTest(per=per):
+                agent = make_agent("iqn+per" if per else "iqn", munchausen=1)
+                loss_fn = agent.munchausen_per_loss if per else agent.munchausen_loss
+                batch = random_batch(per=per)
+                torch.manual_seed(1)
+                fused_loss, fused_td = loss_fn(*batch)
+                target = agent.qnetwork_target
+                agent.qnetwork_target = SeparateForwards(target, agent.BATCH_SIZE)
+                torch.manual_seed(1)
+                loss, td = loss_fn(*batch)
+                torch.testing.assert_close(fused_loss, loss)
+                torch.testing.assert_close(fused_td, td)
+                # the fused loss makes a single target forward over next states and states
+                self.assertEqual(agent.qnetwork_target.calls, [2 * agent.BATCH_SIZE])
+
+
+
+class TestActLatency(unittest.TestCase):
+    def test_only_network_actions_are_timed(self):
+        agent = make_agent()
+        states = torch.rand(1, 6).numpy()
+        for _ in range(5):
+            agent.act(states, eps=1.1)
+        self.assertEqual(agent.act_stats(), {})
+        agent.act(states, eps=0.)
+        self.assertEqual(len(agent.act_latency), 1)
+
+
+class NullWriter(object):
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+def noise(network):
+    return torch.cat([torch.cat([layer.epsilon_in, layer.epsilon_out]) for layer in network.noisy_layers()]).clone()
+
+
+class TestNoiseReset(unittest.TestCase):
+    def make_agent(self, noise_reset):
+        agent = make_agent("fnoisy_iqn", noise_reset=noise_reset)
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            agent.memory.add_batch(rng.rand(1, 6).astype(np.float32), rng.randint(3, size=1), rng.rand(1).astype(np.float32),
+                                   rng.rand(1, 6).astype(np.float32), np.array([False]))
+        return agent
+
+    def test_forward_resamples_every_forward(self):
+        agent = make_agent("fnoisy_iqn")
+        self.assertTrue(all(layer.resample for layer in agent.qnetwork_local.noisy_layers()))
+
+    def test_step_fixes_the_noise_between_learn_steps(self):
+        agent = self.make_agent("step")
+        self.assertIs(agent.qnetwork_actor, agent.qnetwork_local)
+        fixed = noise(agent.qnetwork_local)
+        for _ in range(3):
+            agent.act(np.random.rand(1, 6), eps=0.)
+        torch.testing.assert_close(noise(agent.qnetwork_local), fixed)
+        agent.update(NullWriter())
+        self.assertFalse(torch.equal(noise(agent.qnetwork_local), fixed))
+
+    def test_episode_keeps_the_acting_noise_until_reset(self):
+        agent = self.make_agent("episode")
+        self.assertIs(next(agent.qnetwork_actor.parameters()), next(agent.qnetwork_local.parameters()))
+        acting, learning = noise(agent.qnetwork_actor), noise(agent.qnetwork_local)
+        agent.update(NullWriter())
+        agent.act(np.random.rand(1, 6), eps=0.)
+        torch.testing.assert_close(noise(agent.qnetwork_actor), acting)
+        self.assertFalse(torch.equal(noise(agent.qnetwork_local), learning))
+        agent.reset_noise()
+        self.assertFalse(torch.equal(noise(agent.qnetwork_actor), acting))
+
+
+if __name__ == "__main__":
+    unittest.main()
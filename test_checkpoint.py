@@ -0,0 +1,113 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from agent import IQN_Agent
+from checkpoint import CheckpointManager, checkpoint_paths, latest_checkpoint
+
+
+class NullWriter(object):
+    def add_scalar(self, *args):
+        pass
+
+
+def make_agent():
+    with contextlib.redirect_stdout(io.StringIO()):
+        return IQN_Agent((4,), 3, "iqn+per", 1, 32, 1, 8, 500, 1e-3, 1e-3, 0.99, 8, 1, "cpu", 1)
+
+
+def play(agent, steps):
+    """Steps the agent on random transitions drawn from the global RNG, which the checkpoint restores."""
+    for _ in range(steps):
+        state = np.random.rand(1, 4).astype(np.float32)
+        action = agent.act(state, 0.5)
+        agent.step(state, np.array(action), np.random.rand(1), np.random.rand(1, 4).astype(np.float32), np.random.rand(1) < 0.1,
+                   NullWriter())
+
+
+class TestCheckpointManager(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoints = CheckpointManager(self.directory, keep=2)
+
+    def tearDown(self):
+        self.checkpoints.close()
+        shutil.rmtree(self.directory)
+
+    def replay(self, step):
+        def write():
+            os.makedirs(self.checkpoints.replay_path(step))
+        return write
+
+    def test_keeps_the_last_checkpoints_and_their_replays(self):
+        for step in range(4):
+            self.checkpoints.save({"step": torch.tensor(step)}, step, replay=self.replay(step))
+        self.checkpoints.wait()
+        self.assertEqual(checkpoint_paths(self.directory), [self.checkpoints.path(2), self.checkpoints.path(3)])
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(os.path.basename(p) for p in
+                                                                    [self.checkpoints.path(2), self.checkpoints.path(3),
+                                                                     self.checkpoints.replay_path(2), self.checkpoints.replay_path(3)]))
+        self.assertEqual(int(self.checkpoints.load()["step"]), 3)
+
+    def test_failed_write_leaves_no_checkpoint(self):
+        self.checkpoints.save({"step": 0}, 0)
+        self.checkpoints.wait()
+
+        def failing_replay():
+            raise IOError("disk full")
+        self.checkpoints.save({"step": 1}, 1, replay=failing_replay)
+        with self.assertRaises(IOError):
+            self.checkpoints.wait()
+        self.assertEqual(latest_checkpoint(self.directory), self.checkpoints.path(0))
+        # the error is kept and raised again on close
+        with self.assertRaises(IOError):
+            self.checkpoints.close()
+        self.checkpoints = CheckpointManager(self.directory)
+
+    def test_saved_state_is_a_copy(self):
+        tensor = torch.zeros(3)
+        self.checkpoints.save({"tensor": tensor}, 0)
+        tensor += 1
+        self.checkpoints.wait()
+        self.assertTrue(torch.equal(self.checkpoints.load()["tensor"], torch.zeros(3)))
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resumed_agent_continues_bit_identically(self):
+        np.random.seed(0)
+        agent = make_agent()
+        play(agent, 40)
+        checkpoints = CheckpointManager(self.directory)
+        replay_path = checkpoints.replay_path(40)
+        checkpoints.save({"agent": agent.state_dict()}, 40, replay=agent.memory.snapshot(replay_path))
+        # the original keeps filling its memory while the snapshot is written
+        updates = agent.Q_updates
+        play(agent, 20)
+        checkpoints.close()
+        self.assertGreater(agent.Q_updates, updates)
+
+        resumed = make_agent()
+        resumed.load_state_dict(checkpoints.load()["agent"])
+        resumed.memory.load(replay_path)
+        play(resumed, 20)
+        self.assertEqual(resumed.Q_updates, agent.Q_updates)
+        for network in ("qnetwork_local", "qnetwork_target"):
+            for p, q in zip(getattr(agent, network).parameters(), getattr(resumed, network).parameters()):
+                self.assertTrue(torch.equal(p, q))
+        np.testing.assert_array_equal(agent.memory.tree.tree, resumed.memory.tree.tree)
+
+
+if __name__ == "__main__":
+    unittest.main()
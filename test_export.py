@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from export import Policy, export_torchscript, load_network, verify
+from model import IQN, FactorizedNoisyLinear, NoisyLinear
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def saved_network(self, **kwargs):
+        network = IQN((6,), 3, 32, 1, 0, 8, device="cpu", **kwargs)
+        path = os.path.join(self.directory, "model.pth")
+        torch.save(network.state_dict(), path)
+        return network, path
+
+    def test_load_network_recovers_the_config(self):
+        for kwargs in ({}, {"dueling": True}, {"noisy": True}, {"noisy": True, "noise": "factorized", "dueling": True}):
+            with self.subTest(**kwargs):
+                network, path = self.saved_network(**kwargs)
+                loaded, config = load_network(path)
+                self.assertEqual(config["state_size"], (6,))
+                self.assertEqual(config["action_size"], 3)
+                self.assertEqual(config["layer_size"], 32)
+                self.assertEqual(config["dueling"], kwargs.get("dueling", False))
+                self.assertEqual(config["noisy"], kwargs.get("noisy", False))
+                for name, value in network.state_dict().items():
+                    self.assertTrue(torch.equal(loaded.state_dict()[name], value))
+
+    def test_noisy_policy_is_deterministic_mean_network(self):
+        network, _ = self.saved_network(noisy=True, noise="factorized")
+        policy = Policy(network, K=16, return_quantiles=True).eval()
+        self.assertFalse(any(isinstance(m, (NoisyLinear, FactorizedNoisyLinear)) for m in policy.modules()))
+        obs = torch.rand(5, 6)
+        with torch.no_grad():
+            first, second = policy(obs), policy(obs)
+            # the noise free network with sigma = 0 on the same fixed taus
+            for layer in network.noisy_layers():
+                layer.sigma_weight.zero_()
+                layer.sigma_bias.zero_()
+            expected = network.get_qvalues_fixed(obs, 16)
+        self.assertTrue(torch.equal(first[1], second[1]))
+        torch.testing.assert_close(first[1].mean(dim=1), expected)
+        self.assertTrue(torch.equal(first[0], expected.argmax(dim=1)))
+
+    def test_torchscript_round_trip(self):
+        network, path = self.saved_network(dueling=True)
+        loaded, config = load_network(path)
+        policy = Policy(loaded, K=8, return_quantiles=True).eval()
+        out = os.path.join(self.directory, "policy.pt")
+        export_torchscript(policy, torch.zeros(1, 6), out, {"action_size": config["action_size"]})
+        self.assertLess(verify(policy, out, "torchscript", config["state_size"]), 1e-4)
+        files = {"policy.json": ""}
+        torch.jit.load(out, _extra_files=files)
+        self.assertEqual(json.loads(files["policy.json"]), {"action_size": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+
+from ReplayBuffers import ArrayStorage, FrameStorage, ReplayBuffer
+from test_replay_buffers import gather_all, pixel_stream
+
+
+class TestFrameStorage(unittest.TestCase):
+    def check_equal(self, episode_length, capacity=200, steps=600, workers=2, n_step=1):
+        frames = ReplayBuffer(capacity, 8, "cpu", 0, 0.99, n_step, workers, storage=FrameStorage(capacity, workers))
+        arrays = ReplayBuffer(capacity, 8, "cpu", 0, 0.99, n_step, workers, storage=ArrayStorage(capacity))
+        for step in pixel_stream(np.random.RandomState(0), workers, episode_length, steps):
+            frames.add_batch(*step)
+            arrays.add_batch(*step)
+        for x, y in zip(gather_all(frames), gather_all(arrays)):
+            np.testing.assert_allclose(x, y, atol=1e-6)
+
+    def test_equal_to_array_storage(self):
+        self.check_equal(episode_length=50)
+        self.check_equal(episode_length=50, n_step=3)
+
+    def test_equal_across_ring_wrap_with_frequent_resets(self):
+        self.check_equal(episode_length=2)
+        self.check_equal(episode_length=3, n_step=3)
+
+    def test_rejects_feature_vectors(self):
+        with self.assertRaises(AssertionError):
+            FrameStorage(10).encode(np.zeros((1, 12), np.float32), np.zeros((1, 12), np.float32))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import time
+import unittest
+
+from metrics import MetricsWriter
+
+
+class RecordingWriter(object):
+    def __init__(self, fail=False):
+        self.scalars = []
+        self.fail = fail
+        self.closed = False
+
+    def add_scalar(self, tag, value, step):
+        if self.fail:
+            raise IOError("disk full")
+        self.scalars.append((tag, value, step))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestMetricsWriter(unittest.TestCase):
+    def test_windows_are_written_on_close(self):
+        writer = RecordingWriter()
+        metrics = MetricsWriter(writer, windows={"IQN/Q_loss": 2})
+        for step, value in enumerate([1., 3., 5.]):
+            metrics.add_scalar("IQN/Q_loss", value, step)
+        metrics.add_scalar("IQN/Eval Score", 7., 2)
+        metrics.close()
+        self.assertEqual(sorted(writer.scalars), sorted([("IQN/Q_loss", 2., 1), ("IQN/Q_loss_min", 1., 1), ("IQN/Q_loss_max", 3., 1),
+                                                         ("IQN/Eval Score", 7., 2), ("IQN/Q_loss", 5., 2)]))
+        self.assertTrue(writer.closed)
+
+    def test_write_errors_are_raised(self):
+        metrics = MetricsWriter(RecordingWriter(fail=True), max_queue=4)
+        metrics.add_scalar("IQN/Q_loss", 1., 0)
+        deadline = time.time() + 5
+        while metrics.error is None and time.time() < deadline:
+            time.sleep(0.01)
+        with self.assertRaises(RuntimeError):
+            for step in range(100):
+                metrics.add_scalar("IQN/Q_loss", 1., step)
+        with self.assertRaises(RuntimeError):
+            metrics.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from model import IQN, FactorizedNoisyLinear
+
+
+class TestFixedEmbedding(unittest.TestCase):
+    def setUp(self):
+        self.network = IQN((6,), 3, 32, 1, 0, 8, device="cpu")
+
+    def fresh(self, K):
+        self.network.embedding_cache = None
+        return self.network.fixed_embedding(K).clone()
+
+    def test_cached_until_the_weights_change(self):
+        embedding = self.network.fixed_embedding(4)
+        self.assertIs(self.network.fixed_embedding(4), embedding)
+        self.assertEqual(self.network.fixed_embedding(8).shape[1], 8)
+
+    def test_recomputed_after_an_optimizer_step(self):
+        stale = self.network.fixed_embedding(4).clone()
+        optimizer = torch.optim.SGD(self.network.parameters(), lr=0.1)
+        self.network.get_qvalues(torch.rand(5, 6)).sum().backward()
+        optimizer.step()
+        embedding = self.network.fixed_embedding(4)
+        self.assertFalse(torch.equal(embedding, stale))
+        torch.testing.assert_close(embedding, self.fresh(4))
+
+    def test_recomputed_after_loading_weights(self):
+        self.network.fixed_embedding(4)
+        other = IQN((6,), 3, 32, 1, 1, 8, device="cpu")
+        self.network.load_state_dict(other.state_dict())
+        torch.testing.assert_close(self.network.fixed_embedding(4), other.fixed_embedding(4))
+
+
+def f(x):
+    return x.sign() * x.abs().sqrt()
+
+
+class TestFactorizedNoise(unittest.TestCase):
+    def test_noise_is_the_outer_product_of_f(self):
+        layer = FactorizedNoisyLinear(5, 3)
+        torch.manual_seed(0)
+        layer.reset_noise()
+        torch.manual_seed(0)
+        epsilon_in, epsilon_out = f(torch.randn(5)), f(torch.randn(3))
+        torch.testing.assert_close(layer.epsilon_in, epsilon_in)
+        torch.testing.assert_close(layer.epsilon_out, epsilon_out)
+
+        layer.resample = False
+        inputs = torch.rand(4, 5)
+        weight = layer.weight + layer.sigma_weight * epsilon_out.view(3, 1) * epsilon_in.view(1, 5)
+        bias = layer.bias + layer.sigma_bias * epsilon_out
+        torch.testing.assert_close(layer(inputs), F.linear(inputs, weight, bias))
+
+    def test_noise_fixed_until_reset(self):
+        network = IQN((6,), 3, 32, 1, 0, 8, noisy=True, device="cpu", noise="factorized")
+        inputs = torch.rand(5, 6)
+        with torch.no_grad():
+            self.assertFalse(torch.equal(network.get_qvalues_fixed(inputs), network.get_qvalues_fixed(inputs)))
+            network.resample_noise(False)
+            fixed = network.get_qvalues_fixed(inputs)
+            torch.testing.assert_close(network.get_qvalues_fixed(inputs), fixed)
+            network.reset_noise()
+            self.assertFalse(torch.equal(network.get_qvalues_fixed(inputs), fixed))
+
+
+if __name__ == "__main__":
+    unittest.main()
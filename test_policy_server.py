@@ -0,0 +1,57 @@
+import threading
+import unittest
+
+import numpy as np
+import torch
+
+from model import IQN
+from policy_server import PolicyServer
+
+
+class TestPolicyServer(unittest.TestCase):
+    def setUp(self):
+        self.network = IQN((4,), 3, 16, 1, 0, 8, device="cpu")
+
+    def serve(self, server, observations):
+        """Sends every observation batch from its own client thread, returns the actions in the same order."""
+        clients = [server.client() for _ in observations]
+        actions = [None] * len(observations)
+
+        def request(i):
+            actions[i] = clients[i].act(observations[i])
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(len(observations))]
+        for thread in threads:
+            thread.start()
+        server.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        server.close()
+        return actions
+
+    def expected(self, obs):
+        with torch.no_grad():
+            return self.network.get_qvalues_fixed(torch.from_numpy(obs), 8).argmax(dim=1).numpy()
+
+    def test_requests_are_coalesced_into_one_forward(self):
+        server = PolicyServer(self.network, max_batch=5, max_wait_ms=2000., K=8)
+        observations = [np.random.rand(n, 4).astype(np.float32) for n in (1, 2, 1, 1)]
+        actions = self.serve(server, observations)
+        self.assertEqual(server.stats()["batch_size_histogram"], {5: 1})
+        for obs, action in zip(observations, actions):
+            np.testing.assert_array_equal(action, self.expected(obs))
+
+    def test_batches_are_capped_at_max_batch(self):
+        server = PolicyServer(self.network, max_batch=4, max_wait_ms=200., K=8)
+        self.serve(server, [np.random.rand(1, 4).astype(np.float32) for _ in range(6)])
+        self.assertEqual(server.stats()["batch_size_histogram"], {2: 1, 4: 1})
+        self.assertEqual(len(server.latency), 6)
+
+    def test_callers_network_is_left_unchanged(self):
+        server = PolicyServer(self.network, K=8)
+        self.assertTrue(self.network.training)
+        self.assertFalse(server.network.training)
+        self.assertIsNot(server.network, self.network)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ReplayBuffers import MemmapStorage, PrioritizedReplay, ReplayBuffer, SumTree
+
+
+def pixel_stream(rng, workers, episode_length, steps, history=4, size=6):
+    """(state, action, reward, next_state, done) steps of `workers` envs with stacked frames like wrapper.make_env."""
+    def frame():
+        return rng.randint(0, 256, size=(1, size, size)).astype(np.float32) / 255
+
+    def reset():
+        return np.concatenate([np.zeros((history - 1, size, size), dtype=np.float32), frame()])
+
+    state = np.stack([reset() for _ in range(workers)])
+    for t in range(1, steps + 1):
+        next_state = np.stack([np.concatenate([s[1:], frame()]) for s in state])
+        done = np.full(workers, t % episode_length == 0)
+        yield state, rng.randint(4, size=workers), rng.rand(workers).astype(np.float32), next_state, done
+        state = np.stack([reset() for _ in range(workers)]) if done[0] else next_state
+
+
+def feature_stream(rng, workers, steps, size=5):
+    for _ in range(steps):
+        yield (rng.rand(workers, size).astype(np.float32), rng.randint(4, size=workers), rng.rand(workers).astype(np.float32),
+               rng.rand(workers, size).astype(np.float32), rng.rand(workers) < 0.1)
+
+
+def gather_all(buffer):
+    return buffer.memory.gather(np.arange(len(buffer.memory)))
+
+
+class TestSumTree(unittest.TestCase):
+    def test_totals_and_find(self):
+        tree = SumTree(5)
+        tree.update([0, 1, 2, 3, 4], [1., 2., 3., 4., 0.])
+        self.assertAlmostEqual(tree.total(), 10.)
+        np.testing.assert_array_equal(tree.find([0.5, 1.5, 3.5, 9.9]), [0, 1, 2, 3])
+        self.assertEqual(tree.last_nonzero(), 3)
+
+    def test_per_sampling_proportional_to_priority(self):
+        np.random.seed(0)
+        per = PrioritizedReplay(8, 64, seed=0, alpha=1.0, parallel_env=1)
+        for i in range(8):
+            per.add_batch(np.full((1, 2), i, np.float32), np.array([0]), np.array([0.]), np.zeros((1, 2), np.float32), np.array([False]))
+        priorities = np.arange(1, 9, dtype=np.float64)
+        per.update_priorities(np.arange(8), priorities)
+        counts = np.zeros(8)
+        for _ in range(500):
+            counts += np.bincount(per.sample()[5], minlength=8)
+        np.testing.assert_allclose(counts / counts.sum(), priorities / priorities.sum(), atol=0.01)
+
+
+class TestGeneratorSampling(unittest.TestCase):
+    def test_batches_independent_of_global_rng(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for per in (False, True):
+            with self.subTest(per=per):
+                batches = []
+                for global_seed in (0, 1):
+                    rng = np.random.default_rng(3)
+                    if per:
+                        buffer = PrioritizedReplay(50, 8, 0, parallel_env=2, rng=rng)
+                    else:
+                        buffer = ReplayBuffer(50, 8, "cpu", 0, 0.99, 1, 2, storage=MemmapStorage(50, directory, block_size=4), rng=rng)
+                    for step in feature_stream(np.random.RandomState(0), 2, 20):
+                        buffer.add_batch(*step)
+                    np.random.seed(global_seed)
+                    batches.append(buffer.sample()[0] if per else buffer.sample_arrays()[0])
+                np.testing.assert_array_equal(batches[0], batches[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ReplayBuffers import ArrayStorage, CompressedStorage, FrameStorage, MemmapStorage, PrioritizedReplay, ReplayBuffer
+from test_replay_buffers import feature_stream, gather_all, pixel_stream
+
+
+class TestSaveLoad(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def storages(self, name):
+        pixels = name == "frames"
+        return {"array": lambda: ArrayStorage(50),
+                "frames": lambda: FrameStorage(50, 2),
+                "memmap": lambda: MemmapStorage(50, tempfile.mkdtemp(dir=self.directory)),
+                "memmap_record": lambda: MemmapStorage(50, tempfile.mkdtemp(dir=self.directory), layout="record", align=64),
+                "compressed": lambda: CompressedStorage(50, threads=2)}[name], pixels
+
+    def test_round_trip(self):
+        for name in ("array", "frames", "memmap", "memmap_record", "compressed"):
+            for per in (False, True):
+                with self.subTest(storage=name, per=per):
+                    make, pixels = self.storages(name)
+                    if per:
+                        buffers = [PrioritizedReplay(50, 8, 0, n_step=2, parallel_env=2, storage=make()) for _ in range(2)]
+                    else:
+                        buffers = [ReplayBuffer(50, 8, "cpu", 0, 0.99, 2, 2, storage=make()) for _ in range(2)]
+                    rng = np.random.RandomState(0)
+                    steps = pixel_stream(rng, 2, 7, 40) if pixels else feature_stream(rng, 2, 40)
+                    for step in steps:
+                        buffers[0].add_batch(*step)
+                    if per:
+                        buffers[0].update_priorities(np.arange(10), np.arange(1, 11))
+                    path = tempfile.mkdtemp(dir=self.directory)
+                    buffers[0].save(path)
+                    buffers[1].load(path)
+                    self.assertEqual(len(buffers[0]), len(buffers[1]))
+                    for x, y in zip(gather_all(buffers[0]), gather_all(buffers[1])):
+                        np.testing.assert_array_equal(x, y)
+                    if per:
+                        np.testing.assert_array_equal(buffers[0].tree.tree, buffers[1].tree.tree)
+                    # both continue identically after the restore, including the n-step window
+                    step = next(pixel_stream(rng, 2, 7, 1) if pixels else feature_stream(rng, 2, 1))
+                    for buffer in buffers:
+                        buffer.add_batch(*step)
+                    for x, y in zip(gather_all(buffers[0]), gather_all(buffers[1])):
+                        np.testing.assert_array_equal(x, y)
+
+    def test_snapshot_is_unaffected_by_later_adds(self):
+        for name in ("array", "frames", "memmap", "memmap_record", "compressed"):
+            for per in (False, True):
+                with self.subTest(storage=name, per=per):
+                    make, pixels = self.storages(name)
+                    if per:
+                        buffers = [PrioritizedReplay(50, 8, 0, n_step=2, parallel_env=2, storage=make()) for _ in range(3)]
+                    else:
+                        buffers = [ReplayBuffer(50, 8, "cpu", 0, 0.99, 2, 2, storage=make()) for _ in range(3)]
+                    rng = np.random.RandomState(0)
+                    steps = list(pixel_stream(rng, 2, 7, 60) if pixels else feature_stream(rng, 2, 60))
+                    for step in steps[:20]:
+                        buffers[0].add_batch(*step)
+                    expected, path = tempfile.mkdtemp(dir=self.directory), tempfile.mkdtemp(dir=self.directory)
+                    buffers[0].save(expected)
+                    write = buffers[0].snapshot(path)
+                    # wraps the ring, so every slot of the snapshot is overwritten before it is written
+                    for step in steps[20:]:
+                        buffers[0].add_batch(*step)
+                    if per:
+                        buffers[0].update_priorities(np.arange(10), np.arange(1, 11))
+                    write()
+                    buffers[1].load(expected)
+                    buffers[2].load(path)
+                    for x, y in zip(gather_all(buffers[1]), gather_all(buffers[2])):
+                        np.testing.assert_array_equal(x, y)
+                    if per:
+                        np.testing.assert_array_equal(buffers[1].tree.tree, buffers[2].tree.tree)
+
+    def test_memmap_restores_into_own_files(self):
+        directory = tempfile.mkdtemp(dir=self.directory)
+        buffers = [ReplayBuffer(50, 8, "cpu", 0, 0.99, 1, 2, storage=MemmapStorage(50, tempfile.mkdtemp(dir=self.directory))),
+                   ReplayBuffer(50, 8, "cpu", 0, 0.99, 1, 2, storage=MemmapStorage(50, directory))]
+        for step in feature_stream(np.random.RandomState(0), 2, 10):
+            buffers[0].add_batch(*step)
+        path = tempfile.mkdtemp(dir=self.directory)
+        buffers[0].save(path)
+        buffers[1].load(path)
+        for field in buffers[1].memory.fields.values():
+            self.assertIsInstance(field, np.memmap)
+            self.assertEqual(field.mode, "w+")
+            self.assertTrue(field.filename.startswith(directory))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from ReplayBuffers import PrioritizedReplay, ReplayBuffer, SharedMemoryStorage
+
+
+class TestSharedMemoryPER(unittest.TestCase):
+    def setUp(self):
+        self.storage = SharedMemoryStorage(40, (3,), writers=2, guard=4)
+        self.writer = self.storage.for_writer(1)
+
+    def tearDown(self):
+        self.writer.close()
+        self.storage.close()
+
+    def test_samples_only_published_slots(self):
+        np.random.seed(0)
+        actor = ReplayBuffer(40, 8, "cpu", 0, 0.99, 1, 1, storage=self.writer)
+        per = PrioritizedReplay(40, 8, 0, parallel_env=1, storage=self.storage)
+        # only writer 1 writes, 30 transitions wrap its 20 slots
+        for i in range(1, 31):
+            actor.add_batch(np.full((1, 3), i, np.float32), np.array([0]), np.array([1.]), np.full((1, 3), i, np.float32), np.array([False]))
+            if i >= 8:
+                states, _, _, _, _, indices, weights = per.sample()
+                self.assertTrue(np.all((indices >= 20) & (indices < 40)), indices)
+                self.assertFalse(np.isin(indices, self.storage.guard_slots()).any())
+                self.assertTrue(np.all(np.isfinite(weights)))
+                self.assertTrue(np.all(states[:, 0] > 0))
+                per.update_priorities(indices, np.random.rand(len(indices)))
+
+    def test_save_is_not_supported(self):
+        per = PrioritizedReplay(40, 8, 0, parallel_env=1, storage=self.storage)
+        with self.assertRaises(ValueError):
+            per.save(tempfile.mkdtemp())
+
+
+if __name__ == "__main__":
+    unittest.main()